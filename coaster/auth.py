@@ -23,7 +23,8 @@ import collections
 from werkzeug.local import LocalProxy
 from flask import _request_ctx_stack, current_app, has_request_context
 
-__all__ = ['add_auth_attribute', 'add_auth_anchor', 'request_has_auth', 'current_auth']
+__all__ = ['add_auth_attribute', 'add_auth_anchor', 'request_has_auth', 'request_cache', 'cached_permissions',
+    'current_auth']
 
 
 def add_auth_attribute(attr, value, actor=False):
@@ -83,6 +84,56 @@ def request_has_auth():
     return hasattr(_request_ctx_stack.top, 'current_auth')
 
 
+def request_cache(name):
+    """
+    Return a dictionary named ``name`` for caching values for the rest of the
+    request, or ``None`` if there is no request context. Each request starts
+    with empty caches. Call ``clear()`` on the dictionary to invalidate it.
+    """
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        return None
+    caches = getattr(ctx, 'coaster_caches', None)
+    if caches is None:
+        caches = ctx.coaster_caches = {}
+    cache = caches.get(name)
+    if cache is None:
+        cache = caches[name] = {}
+    return cache
+
+
+def cached_permissions(obj, actor, inherited=None):
+    """
+    Return ``obj.permissions(actor, inherited)``, memoized for the duration of
+    the request. The cache is keyed by the object's identity, the actor and the
+    contents of ``inherited``, and is shared by :func:`~coaster.views.load_models`,
+    :class:`~coaster.views.ModelView` and the ``permissions`` method of scoped
+    models, which check their parent's permissions. Permission changes made in
+    the same request after the first check are not seen until the cache is
+    cleared with ``request_cache('permissions').clear()``.
+
+    Returns a new set on each call, so callers may modify it.
+    """
+    if inherited is not None:
+        # Pass a copy, as implementations may modify the inherited set
+        inherited_key = frozenset(inherited)
+        inherited = set(inherited)
+    else:
+        inherited_key = None
+    cache = request_cache('permissions')
+    if cache is None:
+        return set(obj.permissions(actor, inherited=inherited))
+    key = (id(obj), actor, inherited_key)
+    try:
+        entry = cache.get(key)
+    except TypeError:  # Unhashable actor
+        return set(obj.permissions(actor, inherited=inherited))
+    # The entry holds a reference to the object, so its id can't be reused
+    if entry is None or entry[0] is not obj:
+        entry = cache[key] = (obj, frozenset(obj.permissions(actor, inherited=inherited)))
+    return set(entry[1])
+
+
 class AuthAnchors(collections.Set):
     """
     Hosts a set without write access.
@@ -14,13 +14,24 @@ This is a Python port of GitHub code, taken from
 https://gist.github.com/Wilfred/901706
 """
 
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+import six
 from markupsafe import Markup
+import markdown as markdown_module
 from markdown import Markdown
 from markdown.extensions import Extension
 import re
 from .utils import sanitize_html, VALID_TAGS
 
-__all__ = ['gfm', 'markdown']
+# Markdown 3 has a ``__version__`` string. In Markdown 2, ``__version__`` is a
+# submodule and the version string is ``markdown.version``
+markdown_version = getattr(markdown_module, '__version__', None)
+if not isinstance(markdown_version, six.string_types):
+    markdown_version = markdown_module.version
+
+__all__ = ['gfm', 'markdown', 'MarkdownCache', 'markdown_cache']
 
 GFM_TAGS = dict(VALID_TAGS)
 # For syntax highlighting:
@@ -169,14 +180,120 @@ def gfm(text):
     return text
 
 
-def markdown(text, html=False, valid_tags=GFM_TAGS):
+class MarkdownCache(object):
+    """
+    Bounded LRU cache of rendered Markdown, keyed by a hash of the source text
+    and the renderer configuration, for use with :func:`markdown`. Text that
+    recurs across many documents (templates, boilerplate) is rendered once.
+
+    :param int maxsize: Number of rendered documents to hold in this process
+    :param store: Optional shared cache providing ``get(key)`` and
+        ``set(key, value)``, such as a Werkzeug or Flask-Caching cache. It is
+        consulted on a local miss and receives all new renders
+    :param str prefix: Prefix for keys in the shared store. The Markdown
+        library's version is always added, so an upgrade invalidates the store
+    """
+    def __init__(self, maxsize=1000, store=None, prefix='coaster.gfm/'):
+        self.maxsize = maxsize
+        self.store = store
+        self.prefix = prefix + markdown_version + '/'
+        self._data = OrderedDict()
+        self._lock = Lock()
+        #: Renders found in this process
+        self.hits = 0
+        #: Renders found in the shared store
+        self.store_hits = 0
+        #: Renders not found in the cache
+        self.misses = 0
+
+    def key(self, text, html=False, valid_tags=GFM_TAGS):
+        """Return the cache key for the given :func:`markdown` parameters"""
+        if html:
+            config = repr(sorted((tag, sorted(attrs)) for tag, attrs in valid_tags.items()))
+        else:
+            config = ''  # valid_tags is only used when HTML is allowed
+        if isinstance(text, six.text_type):
+            text = text.encode('utf-8')
+        return self.prefix + sha1(config.encode('utf-8') + b'\0' + text).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self._data[key] = value  # Move to the end, as most recently used
+                self.hits += 1
+                return value
+        if self.store is not None:
+            value = self.store.get(key)
+            if value is not None:
+                self._set_local(key, value)
+                with self._lock:
+                    self.store_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        if self.store is not None:
+            self.store.set(key, value)
+        return True
+
+    def clear(self):
+        """Clear this process's cache and statistics (but not the shared store)"""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.store_hits = self.misses = 0
+        return True
+
+    def stats(self):
+        """
+        Return usage statistics as a dictionary, for sizing the cache::
+
+            {'hits': 0, 'store_hits': 0, 'misses': 0, 'size': 0, 'maxsize': 1000}
+        """
+        return {
+            'hits': self.hits,
+            'store_hits': self.store_hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            }
+
+
+#: Default cache used by :func:`markdown`. Replace it with another
+#: :class:`MarkdownCache` to change the size or to add a shared store
+markdown_cache = MarkdownCache()
+
+
+def markdown(text, html=False, valid_tags=GFM_TAGS, cache=True):
     """
     Return Markdown rendered text using GitHub Flavoured Markdown,
     with HTML escaped and syntax-highlighting enabled.
+
+    :param cache: A :class:`MarkdownCache`, or ``True`` to use
+        :data:`markdown_cache`, or ``False`` to render without a cache
     """
     if text is None:
         return None
+    if cache is True:
+        cache = markdown_cache
+    if cache:
+        key = cache.key(text, html, valid_tags)
+        result = cache.get(key)
+        if result is not None:
+            return Markup(result)
     if html:
-        return Markup(sanitize_html(markdown_convert_html(gfm(text)), valid_tags=valid_tags))
+        result = sanitize_html(markdown_convert_html(gfm(text)), valid_tags=valid_tags)
     else:
-        return Markup(markdown_convert_text(gfm(text)))
+        result = markdown_convert_text(gfm(text))
+    if cache:
+        cache.set(key, six.text_type(result))
+    return Markup(result)
@@ -113,6 +113,19 @@ def sync_resources():
     print("Resources synced...")
 
 
+@manager.option('model', help="Name of the model class")
+@manager.option('column', help="Name of the Markdown column in the model")
+@manager.option('-c', '--chunksize', type=int, default=500, help="Rows to render at a time")
+@manager.option('-p', '--processes', type=int, default=None, help="Worker processes (default: number of CPUs)")
+def rendermarkdown(model, column, chunksize=500, processes=None):
+    """Render HTML again for all rows of a Markdown column"""
+    from .sqlalchemy import rerender_markdown
+    cls = manager.db.Model._decl_class_registry[model]
+    count = rerender_markdown(cls, column, session=manager.db.session, chunksize=chunksize,
+        processes=processes)
+    print("Rendered %d rows" % count)
+
+
 def shell_context():
     context = dict(app=manager.app, db=manager.db, flask=flask)
     context.update(manager.context)
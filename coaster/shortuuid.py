@@ -4,8 +4,8 @@
 ShortUUIDs
 ==========
 
-Provides a wrapper around the ShortUUID module with a long-term stable
-alphabet. This module may be used directly or via :mod:`coaster.utils`::
+Provides ShortUUIDs compatible with the ShortUUID module, with a long-term
+stable alphabet. This module may be used directly or via :mod:`coaster.utils`::
 
     import coaster.shortuuid
 
@@ -23,36 +23,67 @@ alphabet. This module may be used directly or via :mod:`coaster.utils`::
 """
 
 from __future__ import absolute_import
-from shortuuid import ShortUUID
+from uuid import UUID, uuid4
 
 __all__ = ['suuid', 'encode', 'decode']
 
-# Create an instance of the ShortUUID class.
-
-# This alphabet is the default, but we make a class instance anyway to (a) not
-# be affected by global changes (from the module's set_alphabet function), and
+# This alphabet is ShortUUID's default, but we keep our own copy to (a) not be
+# affected by global changes (from the module's set_alphabet function), and
 # (b) to be isolated from upstream alphabet changes, unlikely as that may be.
 # We also refuse to expose a set_alphabet function to the outer world, as that
 # invalidates existing ids and so should never be used.
-__su = ShortUUID(alphabet="23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz")
+__alphabet = "23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+# Since the alphabet is fixed, :func:`encode` and :func:`decode` convert two
+# characters at a time using lookup tables, in the same least significant
+# digit first order as ShortUUID 0.x. A 128-bit UUID needs 22 characters.
+# Strings of any length are decoded here, as ShortUUID 1.0 and later decode
+# in the opposite order.
+__base = len(__alphabet)
+__pair_base = __base * __base
+__length = 22
+__pairs = [__alphabet[i % __base] + __alphabet[i // __base] for i in range(__pair_base)]
+__pair_values = {pair: i for i, pair in enumerate(__pairs)}
 
 
 def suuid():
     """
     Return a ShortUUID using the UUIDv4 version
     """
-    return __su.uuid()
+    return encode(uuid4())
 
 
 def encode(uuid):
     """
     Encode a UUID into a ShortUUID
+
+    >>> encode(UUID('33203dd2-f2ef-422f-aeb0-058d6f5f7089'))
+    'LoGtYR49yWJT7tusksAW7B'
     """
-    return __su.encode(uuid)
+    num = uuid.int
+    pairs = []
+    for i in range(__length // 2):
+        num, pair = divmod(num, __pair_base)
+        pairs.append(__pairs[pair])
+    return u''.join(pairs)
 
 
 def decode(uuid):
     """
     Decode a ShortUUID into a UUID
+
+    >>> decode('LoGtYR49yWJT7tusksAW7B')
+    UUID('33203dd2-f2ef-422f-aeb0-058d6f5f7089')
     """
-    return __su.decode(uuid)
+    if len(uuid) > __length:
+        raise ValueError("Invalid ShortUUID: %r" % uuid)
+    # Short strings are accepted as having leading zeroes, which come last
+    # in least significant digit first order
+    uuid = uuid + __alphabet[0] * (__length - len(uuid))
+    num = 0
+    try:
+        for i in range(__length - 2, -1, -2):
+            num = num * __pair_base + __pair_values[uuid[i:i + 2]]
+    except KeyError:
+        raise ValueError("Invalid ShortUUID: %r" % uuid)
+    return UUID(int=num)
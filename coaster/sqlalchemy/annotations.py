@@ -31,25 +31,42 @@ Sample usage::
                     return cls.query.filter_by(**{key: kwargs[key]}).one_or_none()
 
 Annotations are saved to the model's class as an ``__annotations__``
-dictionary, mapping annotation names to a list of attribute names, and to a
-reverse lookup ``__annotations_by_attr__`` of attribute names to annotations.
+mapping of annotation names to a tuple of attribute names, and to a reverse
+lookup ``__annotations_by_attr__`` of attribute names to annotations. Both are
+read-only. Use :func:`annotated_attributes` to find annotated attributes
+across all models.
 """
 
 from __future__ import absolute_import
 import collections
+from weakref import WeakKeyDictionary
 from sqlalchemy import event
 from sqlalchemy.orm import mapper
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from ..signals import coaster_signals
 
+try:
+    from types import MappingProxyType as _frozen
+except ImportError:  # pragma: no cover
+    _frozen = dict  # Python 2 has no read-only dictionary
+
 __all__ = [
     'annotations_configured',
-    'annotation_wrapper'
+    'annotation_wrapper',
+    'annotated_attributes',
     ]
 
 # Global dictionary for temporary storage of annotations until the mapper_configured events
 __cache__ = {}
 
+# Annotations defined in each class's own namespace (not its bases), as a
+# tuple of (name, annotations) pairs. Each class is examined only once, so
+# mixins shared by many models are not examined again for each model
+_own_annotations = WeakKeyDictionary()
+
+# Annotated attributes in all configured models, as {annotation: {cls: (name, ...)}}
+_annotated_models = {}
+
 # --- Signals -----------------------------------------------------------------
 
 annotations_configured = coaster_signals.signal('annotations-configured',
@@ -58,48 +75,61 @@ annotations_configured = coaster_signals.signal('annotations-configured',
 
 # --- SQLAlchemy signals for base class ---------------------------------------
 
+def _class_annotations(cls):
+    """Return annotations defined in a class's own namespace"""
+    try:
+        return _own_annotations[cls]
+    except KeyError:
+        pass
+    result = []
+    for name, attr in cls.__dict__.items():
+        if name.startswith('__'):
+            continue
+
+        # 'data' is a list of string annotations
+        if isinstance(attr, collections.Hashable) and attr in __cache__:
+            data = __cache__[attr]
+            del __cache__[attr]
+        elif isinstance(attr, InstrumentedAttribute) and attr.property in __cache__:
+            data = __cache__[attr.property]
+            del __cache__[attr.property]
+        elif hasattr(attr, '_coaster_annotations'):
+            data = attr._coaster_annotations
+        else:
+            data = None
+        if data is not None:
+            result.append((name, tuple(data)))
+    result = _own_annotations[cls] = tuple(result)
+    return result
+
+
 @event.listens_for(mapper, 'mapper_configured')
 def __configure_annotations(mapper, cls):
     """
-    Run through attributes of the class looking for annotations from
-    :func:`annotation_wrapper` and add them to :attr:`cls.__annotations__`
-    and :attr:`cls.__annotations_by_attr__`
+    Collect annotations from :func:`annotation_wrapper` in the class and its
+    base classes, and add them to :attr:`cls.__annotations__` and
+    :attr:`cls.__annotations_by_attr__`
     """
     annotations = {}
     annotations_by_attr = {}
 
-    # An attribute may be defined more than once in base classes. Only handle the first
-    processed = set()
-
-    # Loop through all attributes in the class and its base classes, looking for annotations
+    # Loop through the class and its base classes. An attribute may be defined
+    # more than once in base classes. Only handle the first
     for base in cls.__mro__:
-        for name, attr in base.__dict__.items():
-            if name in processed or name.startswith('__'):
-                continue
-
-            # 'data' is a list of string annotations
-            if isinstance(attr, collections.Hashable) and attr in __cache__:
-                data = __cache__[attr]
-                del __cache__[attr]
-            elif isinstance(attr, InstrumentedAttribute) and attr.property in __cache__:
-                data = __cache__[attr.property]
-                del __cache__[attr.property]
-            elif hasattr(attr, '_coaster_annotations'):
-                data = attr._coaster_annotations
-            else:
-                data = None
-            if data is not None:
-                annotations_by_attr.setdefault(name, []).extend(data)
+        for name, data in _class_annotations(base):
+            if name not in annotations_by_attr:
+                annotations_by_attr[name] = data
                 for a in data:
                     annotations.setdefault(a, []).append(name)
-                processed.add(name)
 
     # Classes specifying ``__annotations__`` directly isn't supported,
     # so we don't bother preserving existing content, if any.
     if annotations:
-        cls.__annotations__ = annotations
+        cls.__annotations__ = _frozen(dict((a, tuple(names)) for a, names in annotations.items()))
+        for a, names in cls.__annotations__.items():
+            _annotated_models.setdefault(a, {})[cls] = names
     if annotations_by_attr:
-        cls.__annotations_by_attr__ = annotations_by_attr
+        cls.__annotations_by_attr__ = _frozen(annotations_by_attr)
     annotations_configured.send(cls)
 
 
@@ -111,6 +141,20 @@ def __clear_cache():
 
 # --- Helpers -----------------------------------------------------------------
 
+def annotated_attributes(annotation):
+    """
+    Return a read-only mapping of all configured models with an annotation to
+    the names of their attributes that have it::
+
+        for model, attrs in annotated_attributes(immutable).items():
+            ...
+
+    :param annotation: An annotation from :func:`annotation_wrapper`, or its name
+    """
+    name = getattr(annotation, 'name', annotation)
+    return _frozen(_annotated_models.setdefault(name, {}))
+
+
 def annotation_wrapper(annotation, doc=None):
     """
     Defines an annotation, which can be applied to attributes in a database model.
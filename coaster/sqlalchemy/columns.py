@@ -6,17 +6,31 @@ SQLAlchemy column types
 """
 
 from __future__ import absolute_import
+from collections import OrderedDict, namedtuple
+from copy import deepcopy
+from functools import partial
+from multiprocessing import Pool
 import simplejson
-from sqlalchemy import Column, UnicodeText
+from sqlalchemy import (Boolean, Column, Index, UnicodeText, and_, bindparam, cast, event, func, inspect, literal,
+    select)
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql.elements import ColumnElement, _clone
 from sqlalchemy.types import UserDefinedType, TypeDecorator, TEXT
-from sqlalchemy.orm import composite
+from sqlalchemy.orm import Mapper, Session, composite
+from sqlalchemy.orm.attributes import NO_VALUE, set_committed_value
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.mutable import Mutable, MutableComposite
 from sqlalchemy_utils.types import UUIDType  # NOQA
 from flask import Markup
 import six
 from ..gfm import markdown
+from .comparators import _keyset_criteria
 
-__all__ = ['JsonDict', 'MarkdownComposite', 'MarkdownColumn', 'UUIDType']
+__all__ = ['JsonDict', 'JsonCodec', 'json_codecs', 'default_json_codec', 'json_index', 'JsonPathExists',
+    'JsonPathEquals', 'JsonContains', 'JsonPathText', 'MarkdownComposite', 'MarkdownColumn', 'UUIDType',
+    'rerender_markdown']
 
 
 class JsonType(UserDefinedType):
@@ -33,6 +47,51 @@ class JsonbType(UserDefinedType):
         return 'JSONB'
 
 
+def _json_default(value):
+    # Objects that JSON can't encode (dates, UUIDs, etc) are stored as strings
+    return six.text_type(value)
+
+
+#: A JSON encoder and decoder for :class:`JsonDict`. ``dumps`` must return a
+#: string and ``loads`` must accept one
+JsonCodec = namedtuple('JsonCodec', ['name', 'dumps', 'loads'])
+
+#: Available JSON codecs, by name. ``simplejson`` is always available.
+#: ``rapidjson`` and ``orjson`` are added if installed
+json_codecs = {
+    'simplejson': JsonCodec('simplejson',
+        partial(simplejson.dumps, default=_json_default),
+        partial(simplejson.loads, use_decimal=True)),
+    }
+
+try:
+    import rapidjson
+    json_codecs['rapidjson'] = JsonCodec('rapidjson',
+        partial(rapidjson.dumps, default=_json_default,
+            number_mode=rapidjson.NM_NATIVE | rapidjson.NM_DECIMAL),
+        partial(rapidjson.loads, number_mode=rapidjson.NM_DECIMAL))
+except ImportError:  # pragma: no cover
+    pass
+
+try:
+    import orjson
+    # orjson is the fastest, but it decodes decimal numbers as floats and
+    # encodes Decimal objects as strings, so it is never chosen by default
+    json_codecs['orjson'] = JsonCodec('orjson',
+        lambda value: orjson.dumps(value, default=_json_default).decode('utf-8'),
+        orjson.loads)
+except ImportError:  # pragma: no cover
+    pass
+
+#: Default codec for :class:`JsonDict`. This is always simplejson, so that an
+#: installed package can't change what is stored. The faster codecs don't
+#: round-trip the same way: their output isn't byte-identical, rapidjson
+#: rejects ``NaN`` and ``Infinity`` and encodes namedtuples as lists, and
+#: orjson decodes decimal numbers as floats and encodes Decimals as strings.
+#: Request them per column, as in ``JsonDict(codec='rapidjson')``
+default_json_codec = json_codecs['simplejson']
+
+
 # Adapted from http://docs.sqlalchemy.org/en/rel_0_8/orm/extensions/mutable.html#establishing-mutability-on-scalar-column-values
 
 class JsonDict(TypeDecorator):
@@ -45,10 +104,77 @@ class JsonDict(TypeDecorator):
     the server is PostgreSQL 9.4 or later, ``JSON`` if PostgreSQL 9.2 or 9.3,
     and ``TEXT`` for everything else. The column behaves like a JSON store
     regardless of the backing data type.
+
+    JSON is encoded and decoded with :data:`default_json_codec` (simplejson)
+    unless another codec is specified. JSON strings assigned to the column are
+    decoded with the column's codec. Values that the database driver has already decoded
+    (such as from PostgreSQL with psycopg2) are used as is.
+
+    :param codec: A :class:`JsonCodec`, or the name of one in
+        :data:`json_codecs`
+    :param bool lazy: Decode JSON text when the value is first used instead of
+        when it is loaded. This helps when large documents are loaded but
+        rarely read. Unmodified values are saved back without re-encoding.
+        Note that Python's C-level dict operations (``dict(value)``, or
+        ``json.dumps(value)``) do not trigger decoding
+    :param int partial_updates: On PostgreSQL 9.5 or later, if a loaded value
+        was changed in place with up to this many distinct keys set or
+        removed, only those keys are updated, using ``jsonb_set`` and ``#-``,
+        instead of the entire document being written. Use 0 to disable
+
+    The column has methods to filter on its contents, using JSONB operators on
+    PostgreSQL 9.4 or later and ``json_extract`` (from the JSON1 extension)
+    elsewhere. A path is a key, or a tuple of keys and list indexes::
+
+        MyModel.query.filter(MyModel.data.has_key('name'))
+        MyModel.query.filter(MyModel.data.path_equals(('address', 'city'), 'Bangalore'))
+        MyModel.query.filter(MyModel.data.contains({'tags': {'public': True}}))
+        MyModel.query.filter(MyModel.data.path_text('name') == 'Example')
+
+    See :func:`json_index` to index the column or paths within it.
     """
 
     impl = TEXT
 
+    def __init__(self, *args, **kwargs):
+        codec = kwargs.pop('codec', None)
+        self.lazy = kwargs.pop('lazy', False)
+        self.partial_updates = kwargs.pop('partial_updates', 8)
+        super(JsonDict, self).__init__(*args, **kwargs)
+        if codec is None:
+            codec = default_json_codec
+        elif isinstance(codec, six.string_types):
+            codec = json_codecs[codec]
+        self.codec = codec
+
+    class comparator_factory(TypeDecorator.Comparator):
+        def has_key(self, key):
+            """Filter for documents with this top-level key"""
+            return JsonPathExists(self.expr, (key,))
+
+        def has_path(self, path):
+            """Filter for documents with a value at this path"""
+            return JsonPathExists(self.expr, _json_path(path))
+
+        def path_equals(self, path, value):
+            """Filter for documents with this value at this path"""
+            return JsonPathEquals(self.expr, _json_path(path), value)
+
+        def contains(self, value, **kwargs):
+            """
+            Filter for documents containing all of the keys and values in a
+            dictionary, recursively. On PostgreSQL, lists in the value match
+            lists that contain their items. Elsewhere they must be equal
+            """
+            return JsonContains(self.expr, (), value)
+
+        def path_text(self, path):
+            """
+            Return the value at this path as an SQL expression, for comparison
+            or ordering. This is the expression indexed by :func:`json_index`
+            """
+            return JsonPathText(self.expr, _json_path(path))
+
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
             version = tuple(dialect.server_version_info[:2])
@@ -60,23 +186,139 @@ class JsonDict(TypeDecorator):
 
     def process_bind_param(self, value, dialect):
         if value is not None:
-            value = simplejson.dumps(value, default=lambda o: six.text_type(o))
+            if isinstance(value, LazyMutableDict) and value._source is not None:
+                # Never decoded, so the original text can be saved
+                return value._source
+            value = self.codec.dumps(value)
         return value
 
     def process_result_value(self, value, dialect):
-        if value is not None and isinstance(value, six.string_types):
-            # Psycopg2 >= 2.5 will auto-decode JSON columns, so
-            # we only attempt decoding if the value is a string.
-            # Since this column stores dicts only, processed values
-            # can never be strings.
-            value = simplejson.loads(value, use_decimal=True)
+        if value is not None:
+            if isinstance(value, six.string_types):
+                # Psycopg2 >= 2.5 will auto-decode JSON columns, so
+                # we only attempt decoding if the value is a string.
+                # Since this column stores dicts only, processed values
+                # can never be strings.
+                if self.lazy and value:
+                    value = LazyMutableDict(value, self.codec)
+                    value._tracked = True
+                    return value
+                value = self.codec.loads(value)
+            if isinstance(value, dict):
+                # Values from the database can be tracked for partial updates
+                value = MutableDict(value)
+                value._tracked = True
         return value
 
 
-class MutableDict(Mutable, dict):
+# Marker for deleted keys in MutableDict's change log
+_deleted = object()
+
+
+def _unwrap(value):
+    """Copy a tracked dict or list that is being placed elsewhere in the document"""
+    if isinstance(value, _MutableChild):
+        return deepcopy(value)
+    return value
+
+
+def _detach(value):
+    """Stop tracking a dict or list that has been removed from the document"""
+    if isinstance(value, _MutableChild):
+        value._container = None
+
+
+class _TrackedDict(object):
+    """
+    Dictionary methods that report changes with ``self._changed(path, value)``
+    and wrap nested dicts and lists when they are first accessed, so that
+    changes to them are also reported.
+    """
+    def _wrap(self, key, value):
+        cls = _child_types.get(type(value))
+        if cls is None:
+            return value
+        child = cls(value)
+        child._container = self
+        child._key = key
+        dict.__setitem__(self, key, child)
+        return child
+
+    def __getitem__(self, key):
+        return self._wrap(key, dict.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        """Detect dictionary set events and emit change events."""
+
+        value = _unwrap(value)
+        _detach(dict.get(self, key))
+        dict.__setitem__(self, key, value)
+        self._changed((key,), value)
+
+    def __delitem__(self, key):
+        """Detect dictionary del events and emit change events."""
+
+        _detach(dict.get(self, key))
+        dict.__delitem__(self, key)
+        self._changed((key,))
+
+    def update(self, *args, **kwargs):
+        for key, value in six.iteritems(dict(*args, **kwargs)):
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            value = dict.pop(self, key)
+            _detach(value)
+            self._changed((key,))
+            return value
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        _detach(value)
+        self._changed((key,))
+        return key, value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+
+class MutableDict(_TrackedDict, Mutable, dict):
+    """
+    Dictionary that notifies SQLAlchemy of changes, for :class:`JsonDict`.
+    Dictionaries and lists within it are tracked too, by wrapping them when
+    they are first retrieved with ``value[key]`` or ``value.get(key)``.
+    Changes are logged by path for partial updates.
+    """
+    #: True if this value was loaded from the database or has been flushed,
+    #: making changes to it eligible for :class:`JsonDict` partial updates
+    _tracked = False
+    #: Changes since the value was loaded or last flushed, as an ordered
+    #: ``{path: value}`` dictionary (with ``path`` being a tuple of keys).
+    #: ``None`` if there are no changes, ``False`` if there are more than
+    #: :attr:`max_changes` and the value must be written in full
+    _changes = None
+    #: Maximum changes to track between flushes
+    max_changes = 64
+
     @classmethod
-    def coerce(cls, key, value):
-        """Convert plain dictionaries to MutableDict."""
+    def coerce(cls, key, value, codec=None):
+        """
+        Convert plain dictionaries to MutableDict. JSON strings are decoded
+        with ``codec``, or :data:`default_json_codec` if not specified.
+        """
 
         if not isinstance(value, MutableDict):
             if isinstance(value, dict):
@@ -84,7 +326,7 @@ class MutableDict(Mutable, dict):
             elif isinstance(value, six.string_types):
                 # Assume JSON string
                 if value:
-                    return MutableDict(simplejson.loads(value, use_decimal=True))
+                    return MutableDict((codec or default_json_codec).loads(value))
                 else:
                     return MutableDict()  # Empty value is an empty dict
 
@@ -93,41 +335,548 @@ class MutableDict(Mutable, dict):
         else:
             return value
 
-    def __setitem__(self, key, value):
-        """Detect dictionary set events and emit change events."""
+    def _log_change(self, path, value=_deleted):
+        """Record that the value at ``path`` was set (or deleted)."""
+        changes = self._changes
+        if changes is False:
+            return
+        if changes is None:
+            changes = self._changes = OrderedDict()
+        # The new value replaces any earlier change to this path or within it
+        for logged in [logged for logged in changes if logged[:len(path)] == path]:
+            del changes[logged]
+        if len(changes) >= self.max_changes:
+            self._changes = False
+        else:
+            changes[path] = value
 
-        dict.__setitem__(self, key, value)
+    def _changed(self, path, value=_deleted):
+        self._log_change(path, value)
         self.changed()
 
-    def __delitem__(self, key):
-        """Detect dictionary del events and emit change events."""
+    def __getstate__(self):
+        return dict(self)
 
-        dict.__delitem__(self, key)
-        self.changed()
+    def __setstate__(self, state):
+        dict.update(self, state)
+
+
+class _MutableChild(object):
+    """A dict or list within a :class:`MutableDict`, which reports changes to it"""
+    #: Containing dict or list, or ``None`` if this is no longer in the document
+    _container = None
+    #: Key or index of this in the container
+    _key = None
+
+    def _changed(self, path, value=_deleted):
+        node = self
+        while isinstance(node, _MutableChild):
+            if node._container is None:
+                return
+            path = (node._key,) + path
+            node = node._container
+        node._changed(path, value)
+
+    def __reduce_ex__(self, protocol):
+        # Copies and pickles are plain dicts and lists
+        base = dict if isinstance(self, dict) else list
+        return (base, (base(self),))
+
+
+class _MutableChildDict(_TrackedDict, _MutableChild, dict):
+    pass
+
+
+class _MutableChildList(_MutableChild, list):
+    def _wrap(self, index, value):
+        cls = _child_types.get(type(value))
+        if cls is None:
+            return value
+        child = cls(value)
+        child._container = self
+        child._key = index
+        list.__setitem__(self, index, child)
+        return child
+
+    def _rekey(self, previous):
+        """Update indexes after the list was rearranged, and detach removed items"""
+        present = set()
+        for index, value in enumerate(list.__iter__(self)):
+            if isinstance(value, _MutableChild):
+                value._key = index
+                present.add(id(value))
+        for value in previous:
+            if isinstance(value, _MutableChild) and id(value) not in present:
+                _detach(value)
+        # Positions have changed, so the whole list is replaced
+        self._changed((), self)
+
+    def __getitem__(self, index):
+        value = list.__getitem__(self, index)
+        if isinstance(index, slice):
+            return value
+        return self._wrap(index % len(self), value)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            previous = list(list.__iter__(self))
+            list.__setitem__(self, index, [_unwrap(item) for item in value])
+            self._rekey(previous)
+        else:
+            if index < 0:
+                index += len(self)
+            value = _unwrap(value)
+            _detach(list.__getitem__(self, index))
+            list.__setitem__(self, index, value)
+            self._changed((index,), value)
+
+    def __delitem__(self, index):
+        previous = list(list.__iter__(self))
+        list.__delitem__(self, index)
+        self._rekey(previous)
+
+    # Python 2 uses these for simple slices
+    def __setslice__(self, i, j, value):
+        self.__setitem__(slice(i, j), value)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+    def append(self, value):
+        value = _unwrap(value)
+        list.append(self, value)
+        # jsonb_set adds an item past the end of an array
+        self._changed((len(self) - 1,), value)
+
+    def extend(self, values):
+        previous = list(list.__iter__(self))
+        list.extend(self, [_unwrap(value) for value in values])
+        self._rekey(previous)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, count):
+        previous = list(list.__iter__(self))
+        list.__imul__(self, count)
+        self._rekey(previous)
+        return self
+
+    def insert(self, index, value):
+        previous = list(list.__iter__(self))
+        list.insert(self, index, _unwrap(value))
+        self._rekey(previous)
+
+    def pop(self, *args):
+        previous = list(list.__iter__(self))
+        value = list.pop(self, *args)
+        self._rekey(previous)
+        return value
+
+    def remove(self, value):
+        previous = list(list.__iter__(self))
+        list.remove(self, value)
+        self._rekey(previous)
+
+    def reverse(self):
+        list.reverse(self)
+        self._rekey(())
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._rekey(())
+
+
+_child_types = {dict: _MutableChildDict, list: _MutableChildList}
+
+
+class LazyMutableDict(MutableDict):
+    """
+    A :class:`MutableDict` that decodes its JSON source when first used.
+    Used by :class:`JsonDict` columns with ``lazy=True``.
+    """
+    def __init__(self, source, codec=default_json_codec):
+        dict.__init__(self)
+        self._source = source
+        self._codec = codec
+
+    def _decode(self):
+        source = self._source
+        if source is not None:
+            self._source = None
+            dict.update(self, self._codec.loads(source))
+
+    def __reduce_ex__(self, protocol):
+        self._decode()
+        return (MutableDict, (dict(self),))
+
+
+def _decoding(name):
+    method = getattr(MutableDict, name)
 
-MutableDict.associate_with(JsonDict)
+    def wrapper(self, *args, **kwargs):
+        if self._source is not None:
+            self._decode()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__', '__eq__',
+        '__ne__', '__repr__', 'get', 'keys', 'values', 'items', 'copy', 'pop', 'popitem', 'setdefault', 'update',
+        'clear', 'has_key', 'iterkeys', 'itervalues', 'iteritems', 'viewkeys', 'viewvalues', 'viewitems'):
+    if hasattr(dict, _name):
+        setattr(LazyMutableDict, _name, _decoding(_name))
+del _name
+
+
+@event.listens_for(Mapper, 'mapper_configured')
+def _associate_json_columns(mapper, class_):
+    """
+    Track changes in :class:`JsonDict` columns, as
+    ``MutableDict.associate_with(JsonDict)`` would, and decode JSON strings
+    assigned to them with the column's own codec.
+    """
+    partial_update_columns = []
+    for prop in mapper.column_attrs:
+        column_type = prop.columns[0].type
+        if isinstance(column_type, JsonDict):
+            attribute = getattr(class_, prop.key)
+            # Registered ahead of Mutable's own listener, which then receives
+            # a MutableDict and skips its codec-unaware coercion
+            event.listen(attribute, 'set', partial(_coerce_json_set, prop.key, column_type.codec),
+                retval=True, propagate=True)
+            MutableDict.associate_with_attribute(attribute)
+            if column_type.partial_updates and len(prop.columns) == 1:
+                partial_update_columns.append((prop.key, prop.columns[0]))
+    if partial_update_columns:
+        _json_columns[mapper] = partial_update_columns
+        # Only listen to sessions once a model can use partial updates
+        if not event.contains(Session, 'before_flush', __json_partial_updates):
+            event.listen(Session, 'before_flush', __json_partial_updates)
+            event.listen(Session, 'after_flush', __json_partial_updates_flushed)
+            event.listen(Session, 'after_soft_rollback', __json_partial_updates_failed)
+
+
+def _coerce_json_set(key, codec, target, value, oldvalue, initiator):
+    if value is None or value is oldvalue:
+        return value
+    return MutableDict.coerce(key, value, codec)
+
+
+def _json_path(path):
+    if isinstance(path, (tuple, list)):
+        return tuple(path)
+    return (path,)
+
+
+def _render_literal(compiler, text):
+    return compiler.render_literal_value(text, UnicodeText())
+
+
+def _pg_json_path(compiler, path):
+    """Render a path as a PostgreSQL ``text[]`` literal"""
+    return _render_literal(compiler, u'{%s}' % u','.join(
+        u'"%s"' % six.text_type(key).replace(u'\\', u'\\\\').replace(u'"', u'\\"') for key in path))
+
+
+def _sqlite_json_key(key, codec):
+    """Render a key as a SQLite JSON path label"""
+    # SQLite matches labels against keys as they appear in the JSON text, so
+    # keys are escaped the way the column's codec writes them. A quoted label
+    # ends at the first double quote, so keys with one are left unquoted
+    label = codec.dumps(six.text_type(key))[1:-1]
+    if u'"' not in label:
+        return u'."%s"' % label
+    elif u'.' in label or u'[' in label:
+        raise CompileError("JSON key %r can't be used in a SQLite JSON path" % key)
+    return u'.' + label
+
+
+def _sqlite_json_path(compiler, element):
+    """Render the path of an expression as a SQLite JSON path literal"""
+    codec = element.column.type.codec
+    return _render_literal(compiler, u'$' + u''.join(
+        u'[%d]' % key if isinstance(key, six.integer_types) else _sqlite_json_key(key, codec)
+        for key in element.path))
+
+
+def _pg_jsonb(compiler):
+    """Check if JsonDict columns are JSONB (PostgreSQL 9.4 or later), as needed for JSONB operators"""
+    version = compiler.dialect.server_version_info
+    return version is None or version >= (9, 4)
+
+
+def _require_pg_jsonb(compiler, element):
+    if not _pg_jsonb(compiler):
+        raise CompileError("%s requires JSONB, available in PostgreSQL 9.4 or later" % type(element).__name__)
+
+
+def _json_bind(element, value):
+    return bindparam(None, element.column.type.codec.dumps(value), type_=UnicodeText())
+
+
+class _JsonPathElement(ColumnElement):
+    """Base class for expressions on a path within a :class:`JsonDict` column"""
+    type = Boolean()
+    _is_implicitly_boolean = True
+
+    def __init__(self, column, path, value=None):
+        self.column = column
+        self.path = path
+        self.value = value
+
+    @property
+    def _from_objects(self):
+        return self.column._from_objects
+
+    def get_children(self, **kwargs):
+        return (self.column,)
+
+    def _copy_internals(self, clone=_clone, **kw):
+        self.column = clone(self.column, **kw)
+
+
+class JsonPathExists(_JsonPathElement):
+    """A :class:`JsonDict` column has a value at this path"""
+
+
+class JsonPathEquals(_JsonPathElement):
+    """A :class:`JsonDict` column has this value at this path"""
+
+
+class JsonContains(_JsonPathElement):
+    """A :class:`JsonDict` column contains this dictionary"""
+
+
+class JsonPathText(_JsonPathElement):
+    """The value at a path in a :class:`JsonDict` column, as text on PostgreSQL"""
+    type = UnicodeText()
+    _is_implicitly_boolean = False
+
+
+@compiles(JsonPathExists)
+def __json_path_exists_default(element, compiler, **kw):
+    return '(json_type(%s, %s) IS NOT NULL)' % (
+        compiler.process(element.column, **kw), _sqlite_json_path(compiler, element))
+
+
+@compiles(JsonPathExists, 'postgresql')
+def __json_path_exists_postgresql(element, compiler, **kw):
+    if len(element.path) == 1 and isinstance(element.path[0], six.string_types) and _pg_jsonb(compiler):
+        # Supported by GIN indexes, on JSONB only
+        return '(%s ? %s)' % (compiler.process(element.column, **kw), _render_literal(compiler, element.path[0]))
+    return '((%s #> %s) IS NOT NULL)' % (
+        compiler.process(element.column, **kw), _pg_json_path(compiler, element.path))
+
+
+@compiles(JsonPathEquals)
+def __json_path_equals_default(element, compiler, **kw):
+    column = compiler.process(element.column, **kw)
+    path = _sqlite_json_path(compiler, element)
+    value = element.value
+    if value is None or isinstance(value, bool):
+        return "(json_type(%s, %s) = '%s')" % (column, path, {None: 'null', True: 'true', False: 'false'}[value])
+    elif isinstance(value, (dict, list)):
+        return '(json_extract(%s, %s) = json(%s))' % (column, path, compiler.process(_json_bind(element, value), **kw))
+    return '(json_extract(%s, %s) = %s)' % (column, path, compiler.process(bindparam(None, value), **kw))
+
+
+@compiles(JsonPathEquals, 'postgresql')
+def __json_path_equals_postgresql(element, compiler, **kw):
+    _require_pg_jsonb(compiler, element)
+    if isinstance(element.value, (dict, list)) or any(
+            isinstance(key, six.integer_types) for key in element.path):
+        return '((%s #> %s) = CAST(%s AS JSONB))' % (compiler.process(element.column, **kw),
+            _pg_json_path(compiler, element.path), compiler.process(_json_bind(element, element.value), **kw))
+    # A scalar at a path of keys is matched by containment, which GIN indexes support
+    value = element.value
+    for key in reversed(element.path):
+        value = {key: value}
+    return compiler.process(JsonContains(element.column, (), value), **kw)
+
+
+@compiles(JsonContains)
+def __json_contains_default(element, compiler, **kw):
+    def conditions(path, value):
+        for key, item in six.iteritems(value):
+            if isinstance(item, dict) and item:
+                for condition in conditions(path + (key,), item):
+                    yield condition
+            else:
+                yield JsonPathEquals(element.column, path + (key,), item)
+    clauses = list(conditions(element.path, element.value))
+    if not clauses:
+        clauses = [JsonPathExists(element.column, element.path)]
+    return compiler.process(and_(*clauses), **kw)
+
+
+@compiles(JsonContains, 'postgresql')
+def __json_contains_postgresql(element, compiler, **kw):
+    _require_pg_jsonb(compiler, element)
+    return '(%s @> CAST(%s AS JSONB))' % (
+        compiler.process(element.column, **kw), compiler.process(_json_bind(element, element.value), **kw))
+
+
+@compiles(JsonPathText)
+def __json_path_text_default(element, compiler, **kw):
+    return 'json_extract(%s, %s)' % (compiler.process(element.column, **kw), _sqlite_json_path(compiler, element))
+
+
+@compiles(JsonPathText, 'postgresql')
+def __json_path_text_postgresql(element, compiler, **kw):
+    return '(%s #>> %s)' % (compiler.process(element.column, **kw), _pg_json_path(compiler, element.path))
+
+
+def json_index(name, column, path=None, path_ops=False, **kwargs):
+    """
+    Return an index on a :class:`JsonDict` column, for use in a model's
+    ``__table_args__``. Without a path, this is a GIN index on PostgreSQL,
+    which supports :meth:`~JsonDict.comparator_factory.has_key`,
+    :meth:`~JsonDict.comparator_factory.path_equals` and
+    :meth:`~JsonDict.comparator_factory.contains` on JSONB (PostgreSQL 9.4 or
+    later). It is a plain index on SQLite, and can't be created on other
+    databases, which can't index text columns without a length. With a path, this is an index on the value at that path,
+    for use with :meth:`~JsonDict.comparator_factory.path_text`::
+
+        class MyModel(db.Model):
+            data = db.Column(JsonDict)
+            __table_args__ = (
+                json_index('ix_my_model_data', data),
+                json_index('ix_my_model_data_name', data, 'name'),
+                )
+
+    :param str name: Name of the index
+    :param column: The column
+    :param path: Optional key, or tuple of keys and list indexes
+    :param bool path_ops: Use PostgreSQL's smaller and faster
+        ``jsonb_path_ops`` operator class for the GIN index, which supports
+        containment but not :meth:`~JsonDict.comparator_factory.has_key`
+    :param kwargs: Additional parameters for :class:`~sqlalchemy.schema.Index`
+    """
+    if path is None:
+        kwargs.setdefault('postgresql_using', 'gin')
+        if path_ops:
+            kwargs['postgresql_ops'] = {column.name: 'jsonb_path_ops'}
+        index = Index(name, column, **kwargs)
+        index.info['json_index'] = True
+        return index
+    return Index(name, JsonPathText(column, _json_path(path)), **kwargs)
+
+
+@compiles(CreateIndex)
+def __create_json_index(create, compiler, **kw):
+    """Refuse to create a :func:`json_index` without a path where it is unsupported"""
+    if create.element.info.get('json_index'):
+        dialect = compiler.dialect
+        if dialect.name == 'postgresql':
+            if not _pg_jsonb(compiler):
+                raise CompileError("JSON index %s requires JSONB, available in PostgreSQL 9.4 or later" %
+                    create.element.name)
+        elif dialect.name != 'sqlite':
+            raise CompileError("JSON index %s without a path is not supported on %s" % (
+                create.element.name, dialect.name))
+    return compiler.visit_create_index(create, **kw)
+
+
+# JsonDict columns with partial updates in each mapper, as {mapper: [(key, column), ...]}
+_json_columns = {}
+
+
+def _json_partial_update(column, changes, codec):
+    """Return a SQL expression applying changes from a MutableDict to a JSONB column"""
+    expr = column
+    for path, value in changes.items():
+        keys = cast(literal([six.text_type(key) for key in path], ARRAY(UnicodeText)), ARRAY(UnicodeText))
+        if value is _deleted:
+            expr = expr.op('#-')(keys)
+        else:
+            expr = func.jsonb_set(expr, keys, cast(codec.dumps(value), JsonbType()))
+    return expr
+
+
+def __json_partial_updates(session, flush_context, instances):
+    """Replace small in-place changes to JsonDict values with jsonb_set expressions"""
+    # Values being flushed, as [(state, key, value, expression), ...], with
+    # expression being None if the value is written in full
+    flushing = session.info['coaster_json_updates'] = []
+    for instance in list(session.new) + list(session.dirty):
+        state = inspect(instance)
+        mapper = state.mapper
+        columns = _json_columns.get(mapper)
+        if columns is None:
+            continue
+        partial = False
+        if state.persistent:
+            dialect = session.get_bind(mapper).dialect
+            partial = dialect.name == 'postgresql' and (dialect.server_version_info or ()) >= (9, 5)
+        for key, column in columns:
+            value = state.dict.get(key)
+            if not isinstance(value, MutableDict):
+                continue
+            changes = value._changes
+            expression = None
+            # Only changes to the value in the database can be applied to it. That
+            # is a tracked value, changed in place (committed state is NO_VALUE,
+            # from flag_modified) and not shared with another instance
+            if (partial and changes and value._tracked and len(changes) <= column.type.partial_updates and
+                    state.committed_state.get(key) is NO_VALUE and len(value._parents) == 1):
+                expression = state.dict[key] = _json_partial_update(column, changes, column.type.codec)
+            flushing.append((state, key, value, expression))
+
+
+def __json_partial_updates_flushed(session, flush_context):
+    """Restore JsonDict values after partial updates, so they need not be reloaded"""
+    for state, key, value, expression in session.info.pop('coaster_json_updates', ()):
+        if expression is not None:
+            set_committed_value(state.obj(), key, value)
+        # The value now matches the database
+        value._tracked = True
+        value._changes = None
+
+
+def __json_partial_updates_failed(session, previous_transaction):
+    """Restore JsonDict values if the flush failed, keeping their pending changes"""
+    for state, key, value, expression in session.info.pop('coaster_json_updates', ()):
+        if expression is not None and state.dict.get(key) is expression:
+            state.dict[key] = value
 
 
 @six.python_2_unicode_compatible
 class MarkdownComposite(MutableComposite):
     """
     Represents GitHub-flavoured Markdown text and rendered HTML as a composite column.
+
+    HTML is rendered when the text changes, but not immediately: it is
+    rendered once, when first accessed or when the parent is flushed to the
+    database. HTML missing from the database is rendered on access.
     """
     def __init__(self, text, html=None):
-        if html is None:
-            self.text = text  # This will regenerate HTML
-        else:
-            object.__setattr__(self, 'text', text)
-            object.__setattr__(self, '_html', html)
+        object.__setattr__(self, 'text', text)
+        object.__setattr__(self, '_html', html)
+        object.__setattr__(self, '_html_stale', html is None)
 
-    # If the text value is set, regenerate HTML, then notify parents of the change
+    # If the text value is set, mark the HTML for regeneration, then notify parents of the change
     def __setattr__(self, key, value):
         if key == 'text':
-            object.__setattr__(self, '_html', markdown(value))
+            object.__setattr__(self, '_html', None)
+            object.__setattr__(self, '_html_stale', True)
+        elif key == '_html':
+            object.__setattr__(self, '_html_stale', False)
         object.__setattr__(self, key, value)
         self.changed()
 
-    # Return column values for SQLAlchemy to insert into the database
+    def render(self):
+        """Render HTML from the text, if the text has changed since the HTML was last rendered"""
+        if self._html_stale:
+            object.__setattr__(self, '_html', markdown(self.text))
+            object.__setattr__(self, '_html_stale', False)
+
+    # Return column values for SQLAlchemy to insert into the database.
+    # HTML is rendered before the parent is flushed (see below), not here,
+    # as this is also called on every change
     def __composite_values__(self):
         return (self.text, self._html)
 
@@ -137,11 +886,13 @@ class MarkdownComposite(MutableComposite):
 
     # Return a HTML representation of the text
     def __html__(self):
+        self.render()
         return self._html or u''
 
     # Return a Markup string of the HTML
     @property
     def html(self):
+        self.render()
         return Markup(self._html or u'')
 
     # Compare text value
@@ -153,12 +904,14 @@ class MarkdownComposite(MutableComposite):
 
     # Return state for pickling
     def __getstate__(self):
+        self.render()
         return (self.text, self._html)
 
     # Set state from pickle
     def __setstate__(self, state):
         object.__setattr__(self, 'text', state[0])
         object.__setattr__(self, '_html', state[1])
+        object.__setattr__(self, '_html_stale', state[1] is None)
         self.changed()
 
     def __bool__(self):
@@ -172,6 +925,84 @@ class MarkdownComposite(MutableComposite):
         return cls(value)
 
 
+# Markdown composites in each mapper, as {mapper: [(key, html_key), ...]}, with
+# html_key being the attribute for the HTML column
+_markdown_composites = {}
+
+
+@event.listens_for(Session, 'before_flush')
+def __render_markdown(session, flush_context, instances):
+    """Render HTML for changed Markdown composites before they are saved"""
+    for instance in list(session.new) + list(session.dirty):
+        mapper = inspect(instance).mapper
+        keys = _markdown_composites.get(mapper)
+        if keys is None:
+            keys = _markdown_composites[mapper] = [(prop.key, prop.props[1].key) for prop in mapper.composites
+                if issubclass(prop.composite_class, MarkdownComposite)]
+        for key, html_key in keys:
+            value = instance.__dict__.get(key)
+            if value is not None:
+                value.render()
+                # Update the columns if they don't have the rendered HTML yet
+                if instance.__dict__.get(html_key) != value._html:
+                    value.changed()
+
+
+def rerender_markdown(model, name, session=None, chunksize=500, processes=None):
+    """
+    Render HTML again for all rows of a :func:`MarkdownColumn`, as may be
+    required after an upgrade to the Markdown renderer. Rows are processed in
+    chunks of ``chunksize`` using SQL queries (bypassing the ORM), and are
+    rendered by a pool of worker processes. Each chunk is committed. Also
+    available as the ``rendermarkdown`` command in :mod:`coaster.manage`.
+
+    :param model: Model containing the Markdown column
+    :param str name: Name of the Markdown column
+    :param session: Database session. Defaults to the model's query session
+    :param int chunksize: Number of rows to process at a time
+    :param int processes: Number of worker processes. Defaults to the number
+        of CPUs. If 1, rows are rendered in this process
+    :return: Number of rows processed
+    """
+    if session is None:
+        session = model.query.session
+    mapper = inspect(model)
+    text_column, html_column = mapper.get_property(name).columns
+    primary_key = mapper.primary_key
+    update = html_column.table.update().where(and_(*[column == bindparam('_pk%d' % index)
+        for index, column in enumerate(primary_key)])).values({html_column.name: bindparam('_html')})
+    pk_length = len(primary_key)
+
+    pool = Pool(processes) if processes != 1 else None
+    render = pool.map if pool is not None else lambda func, items: [func(item) for item in items]
+    count = 0
+    last = None
+    try:
+        while True:
+            query = select(list(primary_key) + [text_column]).order_by(*primary_key).limit(chunksize)
+            if last is not None:
+                # Rows after the last one, by the (possibly composite) primary key
+                query = query.where(_keyset_criteria([(column, False) for column in primary_key], last, False))
+            rows = session.execute(query, mapper=mapper).fetchall()
+            if not rows:
+                break
+            htmls = render(markdown, [row[pk_length] for row in rows])
+            params = []
+            for row, html in zip(rows, htmls):
+                values = {'_pk%d' % index: row[index] for index in range(pk_length)}
+                values['_html'] = html
+                params.append(values)
+            session.execute(update, params, mapper=mapper)
+            session.commit()
+            count += len(rows)
+            last = rows[-1][:pk_length]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return count
+
+
 def MarkdownColumn(name, deferred=False, group=None, **kwargs):
     """
     Create a composite column that autogenerates HTML from Markdown text,
@@ -6,16 +6,67 @@ Enhanced query and custom comparators
 """
 
 from __future__ import absolute_import
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from decimal import Decimal
+from hashlib import sha1
+from time import time
 import uuid as uuid_
+from pytz import utc
+import simplejson
+from sqlalchemy import Boolean, and_, any_, bindparam, cast, inspect, or_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.hybrid import Comparator
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.elements import ClauseElement, ColumnElement, UnaryExpression, _clone
 from flask import abort
 from flask_sqlalchemy import BaseQuery
 import six
-from ..utils import buid2uuid, suuid2uuid
+from ..utils import buid2uuid, suuid2uuid, uuid2buid, parse_isoformat
 
 
-__all__ = ['Query', 'SplitIndexComparator',
-    'SqlSplitIdComparator', 'SqlHexUuidComparator', 'SqlBuidComparator', 'SqlSuuidComparator']
+__all__ = ['Query', 'CountCache', 'KeysetPagination', 'ExplainJson', 'SplitIndexComparator',
+    'InValues', 'SqlSplitIdComparator', 'SqlHexUuidComparator', 'SqlBuidComparator', 'SqlSuuidComparator']
+
+
+class CountCache(object):
+    """
+    Minimal in-process cache for :meth:`Query.cached_count`, providing the
+    ``get`` and ``set`` methods of Werkzeug and Flask-Caching caches.
+
+    :param int maxsize: Number of entries to hold. Expired entries are removed
+        when the cache is full, and if all are current, the cache is cleared
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = {}
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires is None or expires > time():
+                return value
+            self._data.pop(key, None)
+
+    def set(self, key, value, timeout=None):
+        if len(self._data) >= self.maxsize:
+            now = time()
+            for k, (expires, v) in list(self._data.items()):
+                if expires is not None and expires <= now:
+                    del self._data[k]
+            if len(self._data) >= self.maxsize:
+                self._data.clear()
+        # As with Werkzeug's caches, a timeout of 0 means the entry never expires
+        self._data[key] = (time() + timeout if timeout else None, value)
+        return True
+
+    def clear(self):
+        self._data.clear()
+        return True
 
 
 class Query(BaseQuery):
@@ -23,6 +74,12 @@ class Query(BaseQuery):
     Extends flask_sqlalchemy.BaseQuery to add additional helper methods.
     """
 
+    #: Cache used by :meth:`cached_count`. This can be replaced with any object
+    #: that provides ``get(key)`` and ``set(key, value, timeout)``, such as a
+    #: Flask-Caching instance, to share counts between processes. The default
+    #: is a small in-process cache
+    count_cache = CountCache()
+
     def notempty(self):
         """
         Returns the equivalent of ``bool(query.count())`` but using an efficient
@@ -39,6 +96,53 @@ class Query(BaseQuery):
         """
         return not self.session.query(self.exists()).scalar()
 
+    def approx_count(self, exact_below=None):
+        """
+        Returns an estimate of the number of rows this query will return, from
+        the PostgreSQL query planner. This is much faster than
+        :meth:`~sqlalchemy.orm.query.Query.count` on large tables as the rows
+        are not scanned, but is only as accurate as the table statistics. Other
+        databases get an exact count.
+
+        :param int exact_below: If the estimate is below this number, return an
+            exact count instead. Small counts are cheap to get exactly and are
+            where estimation errors are most visible
+        """
+        bind = self.session.get_bind(clause=self.statement)
+        if bind.dialect.name != 'postgresql':
+            return self.count()
+        plan = self.session.execute(ExplainJson(self.statement), bind=bind).scalar()
+        if isinstance(plan, six.string_types):
+            plan = simplejson.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if exact_below is not None and estimate < exact_below:
+            return self.count()
+        return estimate
+
+    def cached_count(self, ttl=300, cache=None):
+        """
+        Returns :meth:`~sqlalchemy.orm.query.Query.count`, caching the result
+        for ``ttl`` seconds. The cache key is derived from the database URL
+        and the query's SQL and parameters, so queries that differ only in (say)
+        a filter value or database are cached separately. Counts will be stale for up to ``ttl`` seconds after
+        rows are added or removed.
+
+        :param int ttl: Seconds to cache the count for
+        :param cache: Cache to use instead of :attr:`count_cache`
+        """
+        if cache is None:
+            cache = self.count_cache
+        bind = self.session.get_bind(clause=self.statement)
+        compiled = self.statement.compile(dialect=bind.dialect)
+        key = 'coaster/count/' + sha1((
+            six.text_type(bind.url) + '\n' + six.text_type(compiled) + '\n' +
+            repr(sorted(compiled.params.items()))).encode('utf-8')).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = self.count()
+            cache.set(key, count, timeout=ttl)
+        return count
+
     def one_or_404(self):
         """
         Extends :meth:`~sqlalchemy.orm.query.Query.one_or_none` to raise a 404
@@ -51,6 +155,246 @@ class Query(BaseQuery):
             abort(404)
         return result
 
+    def keyset_paginate(self, cursor=None, per_page=20, order_by=None, reverse=False, error_out=True):
+        """
+        Returns a page of ``per_page`` items using keyset (seek) pagination.
+        Unlike :meth:`~flask_sqlalchemy.BaseQuery.paginate`, which uses SQL
+        ``OFFSET`` and gets slower with every page, this filters on the values
+        of the ordering columns in the last item of the previous page, which
+        an index can satisfy directly. Usage::
+
+            page = Document.query.keyset_paginate(request.args.get('cursor'))
+            for document in page.items:
+                ...
+            if page.has_next:
+                next_url = url_for('documents', cursor=page.next_cursor)
+
+        Any existing ordering on the query is replaced. The query must be for a
+        single model, and the ordering columns must not contain NULLs.
+
+        :param cursor: An opaque cursor from :attr:`KeysetPagination.next_cursor`
+            or :attr:`KeysetPagination.prev_cursor`. If not specified, returns
+            the first page
+        :param int per_page: Number of items per page
+        :param order_by: Model attributes to order by, optionally with
+            ``.desc()``. The last attribute must be unique. Defaults to
+            ``(created_at, <primary key>)`` for models with
+            :class:`~coaster.sqlalchemy.mixins.TimestampMixin` and the primary
+            key for other models
+        :param bool reverse: Reverse the ordering, so that (for example) the
+            first page has the newest items
+        :param bool error_out: Abort with a 404 if the cursor is invalid. If
+            False, an invalid cursor returns the first page
+        :return: :class:`KeysetPagination`
+        """
+        if order_by is None:
+            order_by = self._keyset_default_order()
+        keys = []
+        for column in order_by:
+            descending = isinstance(column, UnaryExpression) and column.modifier is operators.desc_op
+            if isinstance(column, UnaryExpression):
+                column = column.element
+            keys.append((column, descending != bool(reverse)))
+
+        values = None
+        before = False
+        if cursor:
+            try:
+                before, values = _decode_keyset_cursor(cursor, [column for column, descending in keys])
+            except ValueError:
+                if error_out:
+                    abort(404)
+
+        query = self.order_by(None)
+        if values is not None:
+            query = query.filter(_keyset_criteria(keys, values, before))
+        # When paging backwards, fetch in the opposite order and then flip the results
+        query = query.order_by(*[column.desc() if descending != before else column.asc()
+            for column, descending in keys])
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if before:
+            items.reverse()
+            has_next, has_prev = values is not None, more
+        else:
+            has_next, has_prev = more, values is not None
+
+        return KeysetPagination(items, per_page,
+            next_cursor=_encode_keyset_cursor(False, items[-1], keys) if has_next and items else None,
+            prev_cursor=_encode_keyset_cursor(True, items[0], keys) if has_prev and items else None)
+
+    def _keyset_default_order(self):
+        from .mixins import TimestampMixin  # Avoid circular import
+
+        entity = self.column_descriptions[0]['type']
+        mapper = inspect(entity)
+        order_by = [mapper.get_property_by_column(column).class_attribute for column in mapper.primary_key]
+        if issubclass(entity, TimestampMixin):
+            order_by.insert(0, entity.created_at)
+        return order_by
+
+
+class KeysetPagination(object):
+    """
+    A page of results from :meth:`Query.keyset_paginate`.
+    """
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None):
+        #: The items in this page
+        self.items = items
+        #: The number of items requested per page
+        self.per_page = per_page
+        #: Cursor for the next page, or None if this is the last page
+        self.next_cursor = next_cursor
+        #: Cursor for the previous page, or None if this is the first page
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        """True if there is a next page"""
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        """True if there is a previous page"""
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _keyset_criteria(keys, values, before):
+    """
+    Returns criteria for rows after (or before) the given values, as
+    ``(a > x) OR (a = x AND b > y) OR ...``. This is more portable than a
+    row value comparison, and supports mixed ordering.
+    """
+    clauses = []
+    for index, (column, descending) in enumerate(keys):
+        if descending != before:
+            condition = column < values[index]
+        else:
+            condition = column > values[index]
+        clauses.append(and_(*([keys[i][0] == values[i] for i in range(index)] + [condition])))
+    return or_(*clauses)
+
+
+def _encode_keyset_cursor(before, item, keys):
+    mapper = inspect(item).mapper
+    values = []
+    for column, descending in keys:
+        # The mapped attribute can have a different name from the column
+        value = getattr(item, mapper.get_property_by_column(column.expression).key)
+        if isinstance(value, uuid_.UUID):
+            value = uuid2buid(value)
+        elif isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(utc).replace(tzinfo=None)
+            value = value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        values.append(value)
+    # Encode like a BUID, as URL-safe Base64 without padding
+    cursor = urlsafe_b64encode(simplejson.dumps([int(before), values], separators=(',', ':')).encode('utf-8'))
+    return cursor.decode('ascii').rstrip('=')
+
+
+def _decode_keyset_cursor(cursor, columns):
+    """Returns (before, values) from a cursor. Raises ValueError if the cursor is invalid"""
+    try:
+        before, values = simplejson.loads(
+            urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)).decode('utf-8'), use_decimal=True)
+    except (TypeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError("Invalid cursor")
+    for index, column in enumerate(columns):
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            continue
+        value = values[index]
+        if value is None:
+            # Ordering columns can't contain NULLs
+            raise ValueError("Invalid cursor")
+        try:
+            if python_type is uuid_.UUID:
+                values[index] = buid2uuid(value)
+            elif python_type is datetime:
+                values[index] = parse_isoformat(value)
+                if getattr(column.type, 'timezone', False):
+                    values[index] = utc.localize(values[index])
+            elif python_type is bool or isinstance(value, bool):
+                # JSON booleans are only valid for boolean columns
+                if python_type is not bool or not isinstance(value, bool):
+                    raise ValueError("Invalid cursor")
+            elif issubclass(python_type, six.integer_types):
+                if not isinstance(value, six.integer_types):
+                    raise ValueError("Invalid cursor")
+            elif python_type in (float, Decimal):
+                if not isinstance(value, six.integer_types + (float, Decimal)):
+                    raise ValueError("Invalid cursor")
+                values[index] = python_type(value)
+            elif issubclass(python_type, six.string_types):
+                if not isinstance(value, six.string_types):
+                    raise ValueError("Invalid cursor")
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+    return bool(before), values
+
+
+class ExplainJson(Executable, ClauseElement):
+    """
+    PostgreSQL ``EXPLAIN (FORMAT JSON)`` for a statement, used by
+    :meth:`Query.approx_count` to get the planner's row estimate.
+    """
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(ExplainJson, 'postgresql')
+def __explain_json_postgresql(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+class InValues(ColumnElement):
+    """
+    Equivalent to ``column.in_(values)``, but rendered on PostgreSQL as
+    ``column = ANY(CAST(:values AS type[]))``, with all the values in a single
+    array parameter. This keeps the SQL statement the same size regardless of
+    the number of values. Used by :meth:`SplitIndexComparator.in_` for long
+    lists.
+    """
+    type = Boolean()
+    _is_implicitly_boolean = True
+
+    def __init__(self, column, values):
+        self.column = column
+        self.values = values
+
+    @property
+    def _from_objects(self):
+        return self.column._from_objects
+
+    def get_children(self, **kwargs):
+        return (self.column,)
+
+    def _copy_internals(self, clone=_clone, **kw):
+        self.column = clone(self.column, **kw)
+
+
+@compiles(InValues)
+def __in_values_default(element, compiler, **kw):
+    return compiler.process(element.column.in_(element.values), **kw)
+
+
+@compiles(InValues, 'postgresql')
+def __in_values_postgresql(element, compiler, **kw):
+    array_type = postgresql.ARRAY(element.column.type)
+    return compiler.process(
+        element.column == any_(cast(bindparam(None, element.values, type_=array_type), array_type)), **kw)
+
 
 class SplitIndexComparator(Comparator):
     """
@@ -58,6 +402,10 @@ class SplitIndexComparator(Comparator):
     comparing with one of the split values.
     """
 
+    #: In :meth:`in_`, lists longer than this are sent to PostgreSQL as a
+    #: single array parameter. See :class:`InValues`
+    array_threshold = 100
+
     def __init__(self, expression, splitindex=None):
         super(SplitIndexComparator, self).__init__(expression)
         self.splitindex = splitindex
@@ -79,17 +427,46 @@ class SplitIndexComparator(Comparator):
             return True
         return self.__clause_element__() != other
 
-    def in_(self, other):
-        _marker = []
-
-        def errordecode(val):
+    def _decode_many(self, others):
+        """
+        Decode a sequence of values, dropping those that can't be decoded.
+        Subclasses may override this with a faster implementation.
+        """
+        decode = self._decode
+        result = []
+        for other in others:
             try:
-                return self._decode(val)
+                result.append(decode(other))
             except (ValueError, TypeError):
-                return _marker
+                pass
+        return result
 
-        otherlist = (v for v in (errordecode(val) for val in other) if v is not _marker)
-        return self.__clause_element__().in_(otherlist)
+    def in_(self, other):
+        values = self._decode_many(other)
+        column = self.__clause_element__()
+        if len(values) > self.array_threshold:
+            if hasattr(column, '__clause_element__'):
+                column = column.__clause_element__()
+            return InValues(column, values)
+        return column.in_(values)
+
+
+def _decode_uuids(others, splitindex, decoder):
+    """Batch version of ``_decode`` for comparators that work with UUIDs"""
+    UUID = uuid_.UUID
+    result = []
+    append = result.append
+    for other in others:
+        if other is None or isinstance(other, UUID):
+            append(other)
+            continue
+        try:
+            if splitindex is not None:
+                other = other.split('-')[splitindex]
+            append(decoder(other))
+        except (ValueError, TypeError):
+            pass
+    return result
 
 
 class SqlSplitIdComparator(SplitIndexComparator):
@@ -105,6 +482,20 @@ class SqlSplitIdComparator(SplitIndexComparator):
             other = int(other.split('-')[self.splitindex])
         return other
 
+    def _decode_many(self, others):
+        splitindex = self.splitindex
+        if splitindex is None:
+            return list(others)
+        result = []
+        for other in others:
+            if isinstance(other, six.string_types):
+                try:
+                    other = int(other.split('-')[splitindex])
+                except ValueError:
+                    continue
+            result.append(other)
+        return result
+
 
 class SqlHexUuidComparator(SplitIndexComparator):
     """
@@ -119,6 +510,9 @@ class SqlHexUuidComparator(SplitIndexComparator):
             other = uuid_.UUID(other)
         return other
 
+    def _decode_many(self, others):
+        return _decode_uuids(others, self.splitindex, uuid_.UUID)
+
 
 class SqlBuidComparator(SplitIndexComparator):
     """
@@ -134,6 +528,9 @@ class SqlBuidComparator(SplitIndexComparator):
             other = buid2uuid(other)
         return other
 
+    def _decode_many(self, others):
+        return _decode_uuids(others, self.splitindex, buid2uuid)
+
 
 class SqlSuuidComparator(SplitIndexComparator):
     """
@@ -147,3 +544,6 @@ class SqlSuuidComparator(SplitIndexComparator):
                 other = other.split('-')[self.splitindex]
             other = suuid2uuid(other)
         return other
+
+    def _decode_many(self, others):
+        return _decode_uuids(others, self.splitindex, suuid2uuid)
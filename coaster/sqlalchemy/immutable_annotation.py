@@ -32,23 +32,25 @@ class ImmutableColumnError(AttributeError):
                     column_name=column_name, class_name=class_name, old_value=old_value, new_value=new_value))
 
 
+def _immutable_set_listener(target, value, old_value, initiator):
+    # Shared by all immutable attributes.
+    # NEVER_SET is for columns getting a default value during a commit.
+    # NO_VALUE is for columns that have no value (either never set, or not loaded).
+    # Because of this ambiguity, we pair NO_VALUE with a has_identity test.
+    if old_value == value:
+        pass
+    elif old_value is NEVER_SET:
+        pass
+    elif old_value is NO_VALUE and inspect(target).has_identity is False:
+        pass
+    else:
+        raise ImmutableColumnError(type(target).__name__, initiator.key, old_value, value)
+
+
 @annotations_configured.connect
 def __make_immutable(cls):
     if hasattr(cls, '__annotations__') and immutable.name in cls.__annotations__:
         for attr in cls.__annotations__[immutable.name]:
             col = getattr(cls, attr)
-
-            @event.listens_for(col, 'set')
-            def immutable_column_set_listener(target, value, old_value, initiator):
-                # Note:
-                # NEVER_SET is for columns getting a default value during a commit.
-                # NO_VALUE is for columns that have no value (either never set, or not loaded).
-                # Because of this ambiguity, we pair NO_VALUE with a has_identity test.
-                if old_value == value:
-                    pass
-                elif old_value is NEVER_SET:
-                    pass
-                elif old_value is NO_VALUE and inspect(target).has_identity is False:
-                    pass
-                else:
-                    raise ImmutableColumnError(cls.__name__, col.name, old_value, value)
+            if not event.contains(col, 'set', _immutable_set_listener):
+                event.listen(col, 'set', _immutable_set_listener)
@@ -21,20 +21,29 @@ Mixin classes must always appear *before* ``db.Model`` in your model's base clas
 """
 
 from __future__ import absolute_import
+import math
 import uuid as uuid_
-from sqlalchemy import Column, Integer, DateTime, Unicode, CheckConstraint, Numeric, inspect
+from itertools import groupby
+from operator import attrgetter
+from weakref import WeakKeyDictionary
+from sqlalchemy import Column, Integer, DateTime, Float, Unicode, CheckConstraint, Numeric, and_, cast, inspect, or_
 from sqlalchemy import event
-from sqlalchemy.sql import select, func
+from sqlalchemy.sql import bindparam, select, func
+from sqlalchemy.sql.elements import ClauseElement
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import synonym
+from sqlalchemy.orm import Session, synonym, joinedload, object_session, RelationshipProperty, SynonymProperty
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.interfaces import MANYTOONE
 from sqlalchemy_utils.types import UUIDType
 from werkzeug.routing import BuildError
-from flask import current_app, url_for
+from flask import _request_ctx_stack, current_app, url_for
 import six
-from ..utils import make_name, uuid2suuid, uuid2buid, buid2uuid, suuid2uuid, InspectableSet
-from ..utils.misc import _punctuation_re
-from ..auth import current_auth
+from ..utils import make_name, uuid2suuid, uuid2buid, buid2uuid, suuid2uuid, uuid4_many, uuid7, InspectableSet
+from ..utils import geohash as make_geohash
+from ..utils.misc import _punctuation_re, _earth_radius, _geohash_cover, _geohash_next
+from ..auth import current_auth, cached_permissions, request_cache
 from .immutable_annotation import immutable
 from .roles import RoleMixin, with_roles
 from .comparators import Query, SqlSplitIdComparator, SqlHexUuidComparator, SqlBuidComparator, SqlSuuidComparator
@@ -47,7 +56,82 @@ __all__ = ['IdMixin', 'TimestampMixin', 'PermissionMixin', 'UrlForMixin',
     'UuidMixin', 'RoleMixin']
 
 
-class IdMixin(object):
+def _uuid_default(cls):
+    """Default for UUID columns in :class:`IdMixin` and :class:`UuidMixin`"""
+    return uuid7 if cls.__uuid_time_ordered__ else uuid_.uuid4
+
+
+class _BulkInsertMixin(object):
+    """
+    Provides :meth:`bulk_values` and :meth:`bulk_insert` to :class:`IdMixin`
+    and :class:`UuidMixin`
+    """
+    @classmethod
+    def _bulk_uuid_columns(cls):
+        """Names of UUID columns that are generated in Python"""
+        if getattr(cls, '__uuid_primary_key__', False):
+            # The ``uuid`` column, if present, is an alias for ``id``
+            return ('id',)
+        elif issubclass(cls, UuidMixin):
+            return ('uuid',)
+        return ()
+
+    @classmethod
+    def bulk_values(cls, rows):
+        """
+        Returns a list of new dictionaries with the given column values,
+        adding new UUIDs for UUID ``id`` and ``uuid`` columns where not
+        already specified, and the geohash for :class:`CoordinatesMixin`
+        models with coordinates. Random UUIDs are generated together with
+        :func:`~coaster.utils.uuid4_many`, without the per-instance events of
+        model construction. Use this to prepare values for an ``INSERT`` via
+        SQLAlchemy Core.
+
+        :param rows: Iterable of dictionaries of column values
+        """
+        rows = [dict(row) for row in rows]
+        for column in cls._bulk_uuid_columns():
+            missing = [row for row in rows if row.get(column) is None]
+            if cls.__uuid_time_ordered__:
+                values = [uuid7() for row in missing]
+            else:
+                values = uuid4_many(len(missing))
+            for row, value in zip(missing, values):
+                row[column] = value
+        if issubclass(cls, CoordinatesMixin):
+            for row in rows:
+                if 'geohash' not in row and row.get('latitude') is not None and row.get('longitude') is not None:
+                    row['geohash'] = make_geohash(row['latitude'], row['longitude'])
+        return rows
+
+    @classmethod
+    def bulk_insert(cls, rows, session=None, chunksize=100):
+        """
+        Inserts rows into this model's table using multi-row ``INSERT``
+        statements from SQLAlchemy Core, bypassing the ORM, and returns the
+        values inserted (from :meth:`bulk_values`) so the caller has the
+        generated UUIDs. Integer primary keys are left to the database.
+        Column defaults are applied by SQLAlchemy as usual, but ORM events
+        and validators are not called. Consecutive rows with the same columns
+        share a statement, as a multi-row ``INSERT`` takes its columns from
+        the first row.
+
+        :param rows: Iterable of dictionaries of column values
+        :param session: Session to use. Defaults to the model's query session
+        :param int chunksize: Maximum number of rows per statement
+        """
+        rows = cls.bulk_values(rows)
+        if session is None:
+            session = cls.query.session
+        table = cls.__table__
+        mapper = inspect(cls)
+        for offset in range(0, len(rows), chunksize):
+            for keys, chunk in groupby(rows[offset:offset + chunksize], key=lambda row: set(row)):
+                session.execute(table.insert().values(list(chunk)), mapper=mapper)
+        return rows
+
+
+class IdMixin(_BulkInsertMixin):
     """
     Provides the :attr:`id` primary key column
     """
@@ -55,6 +139,11 @@ class IdMixin(object):
     #: Use UUID primary key? If yes, UUIDs are automatically generated without
     #: the need to commit to the database
     __uuid_primary_key__ = False
+    #: Use time-ordered UUIDs? If yes, UUIDs are generated with
+    #: :func:`~coaster.utils.uuid7`, which keeps inserts at the end of the
+    #: index instead of fragmenting it. The creation time can be recovered
+    #: with :func:`~coaster.utils.uuid7_to_datetime`
+    __uuid_time_ordered__ = False
 
     @declared_attr
     def id(cls):
@@ -62,7 +151,8 @@ class IdMixin(object):
         Database identity for this model, used for foreign key references from other models
         """
         if cls.__uuid_primary_key__:
-            return immutable(Column(UUIDType(binary=False), default=uuid_.uuid4, primary_key=True, nullable=False))
+            return immutable(Column(UUIDType(binary=False), default=_uuid_default(cls),
+                primary_key=True, nullable=False))
         else:
             return immutable(Column(Integer, primary_key=True, nullable=False))
 
@@ -99,13 +189,22 @@ class IdMixin(object):
         return '<%s %s>' % (self.__class__.__name__, self.id)
 
 
-class UuidMixin(object):
+_uuid_hex = attrgetter('hex')
+
+
+class UuidMixin(_BulkInsertMixin):
     """
     Provides a ``uuid`` attribute that is either a SQL UUID column or an alias
     to the existing ``id`` column if the class uses UUID primary keys. Also
     provides hybrid properties ``huuid``, ``buid`` and ``suuid`` that provide
     hex, URL-safe Base64 and ShortUUID representations of the ``uuid`` column.
     """
+    #: Cache the hex, BUID and ShortUUID representations in each instance?
+    #: Useful when these are read repeatedly, as in API responses
+    __uuid_cache__ = False
+    #: Use time-ordered UUIDs? See :attr:`IdMixin.__uuid_time_ordered__`
+    __uuid_time_ordered__ = False
+
     @with_roles(read={'all'})
     @declared_attr
     def uuid(cls):
@@ -113,12 +212,12 @@ class UuidMixin(object):
         if hasattr(cls, '__uuid_primary_key__') and cls.__uuid_primary_key__:
             return synonym('id')
         else:
-            return immutable(Column(UUIDType(binary=False), default=uuid_.uuid4, unique=True, nullable=False))
+            return immutable(Column(UUIDType(binary=False), default=_uuid_default(cls), unique=True, nullable=False))
 
     @hybrid_property
     def huuid(self):
         """URL-friendly UUID representation as a hex string"""
-        return self.uuid.hex
+        return self._encoded_uuid('huuid', _uuid_hex)
 
     @huuid.comparator
     def huuid(cls):
@@ -134,7 +233,7 @@ class UuidMixin(object):
     @hybrid_property
     def buid(self):
         """URL-friendly UUID representation, using URL-safe Base64 (BUID)"""
-        return uuid2buid(self.uuid)
+        return self._encoded_uuid('buid', uuid2buid)
 
     @buid.setter
     def buid(self, value):
@@ -149,7 +248,7 @@ class UuidMixin(object):
     @hybrid_property
     def suuid(self):
         """URL-friendly UUID representation, using ShortUUID"""
-        return uuid2suuid(self.uuid)
+        return self._encoded_uuid('suuid', uuid2suuid)
 
     @suuid.setter
     def suuid(self, value):
@@ -161,6 +260,20 @@ class UuidMixin(object):
 
     suuid = with_roles(suuid, read={'all'})
 
+    def _encoded_uuid(self, key, encoder):
+        """Return an encoded representation of :attr:`uuid`, cached if requested"""
+        uuid = self.uuid
+        if not self.__uuid_cache__:
+            return encoder(uuid)
+        cache = self.__dict__.get('_encoded_uuid_cache')
+        if cache is None or cache[0] is not uuid:
+            # The UUID was changed or reloaded, so discard the cache
+            cache = self.__dict__['_encoded_uuid_cache'] = (uuid, {})
+        values = cache[1]
+        if key not in values:
+            values[key] = encoder(uuid)
+        return values[key]
+
 
 # Also see functions.make_timestamp_columns
 class TimestampMixin(object):
@@ -174,6 +287,145 @@ class TimestampMixin(object):
     updated_at = Column(DateTime, default=func.utcnow(), onupdate=func.utcnow(), nullable=False)
 
 
+def _parent_relationship(cls):
+    """Return the relationship named (or aliased as) ``parent`` in the model, or None"""
+    mapper = inspect(cls)
+    name = 'parent'
+    while mapper.has_property(name):
+        prop = mapper.get_property(name)
+        if isinstance(prop, SynonymProperty):
+            name = prop.name
+        elif isinstance(prop, RelationshipProperty):
+            return prop
+        else:
+            break
+
+
+def _load_parent_chain(cls, instances):
+    """
+    Load the parent chain for instances of a model with a many-to-one
+    ``parent`` relationship. See :meth:`BaseScopedNameMixin.load_parents`
+    """
+    relationship = _parent_relationship(cls)
+    if relationship is None or relationship.direction is not MANYTOONE:
+        return
+    # Detached instances can't load their parents, and are skipped
+    instances = [instance for instance in instances
+        if relationship.key not in instance.__dict__ and object_session(instance) is not None]
+    if not instances:
+        return
+    # Multi-column foreign keys are matched on all of their columns
+    mapper = inspect(cls)
+    local_keys = [mapper.get_property_by_column(local).key for local, remote in relationship.local_remote_pairs]
+    remote_attrs = [relationship.mapper.get_property_by_column(remote).class_attribute
+        for local, remote in relationship.local_remote_pairs]
+
+    def local_value(instance):
+        value = tuple(getattr(instance, key) for key in local_keys)
+        return None if None in value else value
+
+    # Eager load the rest of the chain, stopping if a model recurs
+    loader = None
+    seen = set([cls])
+    parent_class = relationship.mapper.class_
+    while parent_class not in seen:
+        seen.add(parent_class)
+        parent_relationship = _parent_relationship(parent_class)
+        if parent_relationship is None:
+            break
+        attr = getattr(parent_class, parent_relationship.key)
+        loader = joinedload(attr) if loader is None else loader.joinedload(attr)
+        parent_class = parent_relationship.mapper.class_
+
+    values = set(local_value(instance) for instance in instances)
+    values.discard(None)
+    parents = {}
+    if values:
+        if len(remote_attrs) == 1:
+            condition = remote_attrs[0].in_([value[0] for value in values])
+        else:
+            condition = or_(*[and_(*[attr == item for attr, item in zip(remote_attrs, value)])
+                for value in values])
+        query = object_session(instances[0]).query(relationship.mapper).filter(condition)
+        if loader is not None:
+            query = query.options(loader)
+        parents = {tuple(getattr(parent, attr.key) for attr in remote_attrs): parent for parent in query}
+    for instance in instances:
+        set_committed_value(instance, relationship.key, parents.get(local_value(instance)))
+
+
+# Cache of compiled queries used by :func:`_get_instance`
+_bakery = baked.bakery()
+
+
+def _get_query(cls, attr, value_is_null=False, relationship=None, parent_is_null=False):
+    """
+    Return a baked query for instances of ``cls`` by ``attr``, and by the parent
+    if the parent ``relationship`` is given. None values are compared with
+    ``IS NULL`` in a separate baked variant, as ``= NULL`` matches nothing.
+    Bind parameters are ``value`` and ``parent_0``, ``parent_1``, etc for
+    each column of the parent's foreign key.
+    """
+    query = _bakery(lambda session: session.query(cls),
+        cls, attr, value_is_null, relationship is not None and relationship.key, parent_is_null)
+    if value_is_null:
+        query += lambda q: q.filter(getattr(cls, attr).is_(None))
+    else:
+        query += lambda q: q.filter(getattr(cls, attr) == bindparam('value'))
+    if relationship is not None:
+        if parent_is_null:
+            query += lambda q: q.filter(*[local.is_(None) for local, remote in relationship.local_remote_pairs])
+        else:
+            query += lambda q: q.filter(*[local == bindparam('parent_%d' % index)
+                for index, (local, remote) in enumerate(relationship.local_remote_pairs)])
+    return query
+
+
+def _get_instance(cls, attr, value, parent=None, scoped=False):
+    """
+    Return the instance of ``cls`` with ``attr`` matching ``value`` (within
+    ``parent`` if ``scoped``), or None. Used by the ``get`` classmethods of
+    :class:`BaseNameMixin`, :class:`BaseScopedNameMixin` and
+    :class:`BaseScopedIdMixin`.
+
+    The query is baked, so it is only constructed once. If the model's
+    ``__get_cache__`` is True, the primary key of the instance is remembered
+    for the rest of the request, and repeated lookups return the instance from
+    the session's identity map without a query.
+    """
+    session = cls.query.session
+    cache_key = None
+    cache = request_cache('model_lookups') if cls.__get_cache__ else None
+    if cache is not None:
+        parent_identity = inspect(parent).identity if scoped and parent is not None else None
+        if not scoped or parent_identity is not None:
+            cache_key = (cls, attr, value, parent_identity)
+            identity = cache.get(cache_key)
+            if identity is not None:
+                instance = session.identity_map.get(identity)
+                # The instance may have been renamed, moved or deleted since
+                if (instance is not None and getattr(instance, attr) == value and
+                        (not scoped or instance.parent is parent) and instance not in session.deleted):
+                    return instance
+
+    params = {} if value is None else {'value': value}
+    if scoped:
+        relationship = _parent_relationship(cls)
+        if relationship is None or relationship.direction is not MANYTOONE:
+            return cls.query.filter_by(**{'parent': parent, attr: value}).one_or_none()
+        if parent is not None:
+            for index, (local, remote) in enumerate(relationship.local_remote_pairs):
+                params['parent_%d' % index] = getattr(
+                    parent, relationship.mapper.get_property_by_column(remote).key)
+        query = _get_query(cls, attr, value is None, relationship, parent is None)
+    else:
+        query = _get_query(cls, attr, value is None)
+    instance = query(session).params(params).one_or_none()
+    if instance is not None and cache_key is not None:
+        cache[cache_key] = inspect(instance).key
+    return instance
+
+
 class PermissionMixin(object):
     """
     Provides the :meth:`permissions` method used by BaseMixin and derived classes
@@ -197,6 +449,87 @@ class PermissionMixin(object):
         return InspectableSet(self.permissions(current_auth.actor))
 
 
+class _UrlForEndpoint(object):
+    """
+    Compiled form of an endpoint registered via :meth:`UrlForMixin.is_url_for`.
+    Parameter attributes are converted into :func:`~operator.attrgetter`
+    lookups, so that repeated calls to :meth:`UrlForMixin.url_for` skip the
+    generic lookups in :func:`flask.url_for`.
+    """
+    def __init__(self, source):
+        #: The ``(endpoint, paramattrs, _external)`` tuple this was compiled from
+        self.source = source
+        self.endpoint, paramattrs, self._external = source
+        #: List of (param, getter) for attributes on the instance
+        self.getters = []
+        #: List of (param, kwarg, getter) for attributes on objects passed in kwargs
+        self.entity_getters = []
+
+        for param, attr in paramattrs.items():
+            if isinstance(attr, tuple):
+                # attr is a tuple containing:
+                # 1. ('parent', 'name') --> self.parent.name
+                # 2. ('**entity', 'name') --> kwargs['entity'].name
+                if attr[0].startswith('**'):
+                    self.entity_getters.append((param, attr[0][2:],
+                        attrgetter('.'.join(attr[1:])) if len(attr) > 1 else None))
+                else:
+                    self.getters.append((param, attrgetter('.'.join(attr))))
+            elif callable(attr):
+                self.getters.append((param, attr))
+            else:
+                self.getters.append((param, attrgetter(attr)))
+
+    def params(self, obj, kwargs):
+        """
+        Return parameters for the URL to ``obj``. Entity parameters are removed
+        from ``kwargs`` and the rest override the registered parameters.
+        """
+        params = {param: getter(obj) for param, getter in self.getters}
+        for param, key, getter in self.entity_getters:
+            item = kwargs.pop(key)
+            params[param] = getter(item) if getter is not None else item
+        if self._external is not None:
+            params['_external'] = self._external
+        params.update(kwargs)  # Let kwargs override params
+        return params
+
+    def builder(self):
+        """
+        Return a function that accepts the parameters from :meth:`params` and
+        returns a URL. Within a request, the URL is built with the request's
+        URL adapter, skipping the lookups in :func:`flask.url_for`. Anything
+        unusual is handed over to :func:`flask.url_for`.
+        """
+        endpoint = self.endpoint
+        reqctx = _request_ctx_stack.top
+        if reqctx is None or reqctx.url_adapter is None or endpoint.startswith('.'):
+            return self.generic_build
+        app = reqctx.app
+        adapter = reqctx.url_adapter
+        generic_build = self.generic_build
+
+        def build(params):
+            if not _url_for_special_params.isdisjoint(params):
+                return generic_build(params)
+            values = dict(params)
+            external = values.pop('_external', False)
+            app.inject_url_defaults(endpoint, values)
+            try:
+                return adapter.build(endpoint, values, force_external=external)
+            except BuildError:
+                # Let Flask report the error, or handle it with the app's url_build_error_handlers
+                return generic_build(params)
+        return build
+
+    def generic_build(self, params):
+        return url_for(self.endpoint, **params)
+
+
+# Parameters to url_for that need Flask's handling
+_url_for_special_params = frozenset(['_anchor', '_method', '_scheme'])
+
+
 class UrlForMixin(object):
     """
     Provides a :meth:`url_for` method used by BaseMixin-derived classes
@@ -206,42 +539,58 @@ class UrlForMixin(object):
     #: Each subclass will get its own dictionary. This particular dictionary is only used as an inherited fallback.
     url_for_endpoints = {None: {}}
 
+    @classmethod
+    def _url_for_endpoint(cls, action, kwargs):
+        """
+        Return the compiled endpoint for the given action in the current app
+        """
+        app = current_app._get_current_object() if current_app else None
+        if app is None or action not in cls.url_for_endpoints.get(app, {}):
+            app = None
+        try:
+            source = cls.url_for_endpoints[app][action]
+        except KeyError:
+            raise BuildError(action, kwargs, 'GET')
+
+        by_app = cls.__dict__.get('_url_for_compiled')
+        if by_app is None:
+            # Compiled endpoints, as {app: {action: endpoint}}. Apps are weakly referenced,
+            # and the fallback endpoints (for app None) are kept under the class itself
+            by_app = cls._url_for_compiled = WeakKeyDictionary()
+        compiled = by_app.setdefault(app if app is not None else cls, {})
+        endpoint = compiled.get(action)
+        # Recompile if is_url_for has replaced the registration since
+        if endpoint is None or endpoint.source is not source:
+            endpoint = _UrlForEndpoint(source)
+            compiled[action] = endpoint
+        return endpoint
+
     def url_for(self, action='view', **kwargs):
         """
         Return public URL to this instance for a given action (default 'view')
         """
-        app = current_app._get_current_object() if current_app else None
-        if app is not None and action in self.url_for_endpoints.get(app, {}):
-            endpoint, paramattrs, _external = self.url_for_endpoints[app][action]
-        else:
-            try:
-                endpoint, paramattrs, _external = self.url_for_endpoints[None][action]
-            except KeyError:
-                raise BuildError(action, kwargs, 'GET')
-        params = {}
-        for param, attr in list(paramattrs.items()):
-            if isinstance(attr, tuple):
-                # attr is a tuple containing:
-                # 1. ('parent', 'name') --> self.parent.name
-                # 2. ('**entity', 'name') --> kwargs['entity'].name
-                if attr[0].startswith('**'):
-                    item = kwargs.pop(attr[0][2:])
-                    attr = attr[1:]
-                else:
-                    item = self
-                for subattr in attr:
-                    item = getattr(item, subattr)
-                params[param] = item
-            elif callable(attr):
-                params[param] = attr(self)
-            else:
-                params[param] = getattr(self, attr)
-        if _external is not None:
-            params['_external'] = _external
-        params.update(kwargs)  # Let kwargs override params
+        endpoint = self._url_for_endpoint(action, kwargs)
+        return endpoint.builder()(endpoint.params(self, kwargs))
 
-        # url_for from flask
-        return url_for(endpoint, **params)
+    @classmethod
+    def url_for_many(cls, instances, action='view', _external=None, **kwargs):
+        """
+        Return a list of public URLs to the given instances for a given action
+        (default 'view'). This is equivalent to calling :meth:`url_for` on each
+        instance, but the endpoint and URL adapter are resolved only once.
+
+        :param instances: Iterable of instances of this model
+        :param action: Action to generate URLs for
+        :param _external: If specified, overrides the endpoint's ``_external`` setting
+        :param kwargs: Additional parameters shared by all URLs. These override
+            parameters from the instances, as in :meth:`url_for`
+        """
+        if _external is not None:
+            kwargs['_external'] = _external
+        endpoint = cls._url_for_endpoint(action, kwargs)
+        build = endpoint.builder()
+        params = endpoint.params
+        return [build(params(obj, dict(kwargs))) for obj in instances]
 
     @property
     def absolute_url(self):
@@ -314,6 +663,11 @@ class BaseNameMixin(BaseMixin):
     __name_blank_allowed__ = False
     #: How long should names and titles be?
     __name_length__ = __title_length__ = 250
+    #: Make names when flushed, in a batch with other new instances, instead
+    #: of when constructed?
+    __name_deferred__ = False
+    #: Remember instances found by :meth:`get` for the rest of the request?
+    __get_cache__ = False
 
     @declared_attr
     def name(cls):
@@ -330,7 +684,7 @@ class BaseNameMixin(BaseMixin):
 
     def __init__(self, *args, **kw):
         super(BaseNameMixin, self).__init__(*args, **kw)
-        if not self.name:
+        if not self.name and not self.__name_deferred__:
             self.make_name()
 
     def __repr__(self):
@@ -339,7 +693,7 @@ class BaseNameMixin(BaseMixin):
     @classmethod
     def get(cls, name):
         """Get an instance matching the name"""
-        return cls.query.filter_by(name=name).one_or_none()
+        return _get_instance(cls, 'name', name)
 
     @classmethod
     def upsert(cls, name, **fields):
@@ -407,6 +761,11 @@ class BaseScopedNameMixin(BaseMixin):
     __name_blank_allowed__ = False
     #: How long should names and titles be?
     __name_length__ = __title_length__ = 250
+    #: Make names when flushed, in a batch with other new instances, instead
+    #: of when constructed?
+    __name_deferred__ = False
+    #: Remember instances found by :meth:`get` for the rest of the request?
+    __get_cache__ = False
 
     @declared_attr
     def name(cls):
@@ -423,7 +782,7 @@ class BaseScopedNameMixin(BaseMixin):
 
     def __init__(self, *args, **kw):
         super(BaseScopedNameMixin, self).__init__(*args, **kw)
-        if self.parent and not self.name:
+        if self.parent and not self.name and not self.__name_deferred__:
             self.make_name()
 
     def __repr__(self):
@@ -433,7 +792,7 @@ class BaseScopedNameMixin(BaseMixin):
     @classmethod
     def get(cls, parent, name):
         """Get an instance matching the parent and name"""
-        return cls.query.filter_by(parent=parent, name=name).one_or_none()
+        return _get_instance(cls, 'name', name, parent, scoped=True)
 
     @classmethod
     def upsert(cls, parent, name, **fields):
@@ -446,6 +805,17 @@ class BaseScopedNameMixin(BaseMixin):
             instance = failsafe_add(cls.query.session, instance, parent=parent, name=name)
         return instance
 
+    @classmethod
+    def load_parents(cls, instances):
+        """
+        Load the parents of the given instances, and their parents in turn, in a
+        single query, so that :attr:`parent` and :meth:`permissions` do not
+        query the database once per instance. Instances that are not in a
+        session are skipped. Returns ``instances``.
+        """
+        _load_parent_chain(cls, instances)
+        return instances
+
     def make_name(self, reserved=[]):
         """
         Autogenerates a :attr:`name` from the :attr:`title`. If the auto-generated name is already
@@ -486,7 +856,7 @@ class BaseScopedNameMixin(BaseMixin):
         if inherited is not None:
             return inherited | super(BaseScopedNameMixin, self).permissions(actor)
         elif self.parent is not None and isinstance(self.parent, PermissionMixin):
-            return self.parent.permissions(actor) | super(BaseScopedNameMixin, self).permissions(actor)
+            return cached_permissions(self.parent, actor) | super(BaseScopedNameMixin, self).permissions(actor)
         else:
             return super(BaseScopedNameMixin, self).permissions(actor)
 
@@ -513,6 +883,9 @@ class BaseIdNameMixin(BaseMixin):
     __name_blank_allowed__ = False
     #: How long should names and titles be?
     __name_length__ = __title_length__ = 250
+    #: Make names when flushed, in a batch with other new instances, instead
+    #: of when constructed?
+    __name_deferred__ = False
 
     @declared_attr
     def name(cls):
@@ -529,7 +902,7 @@ class BaseIdNameMixin(BaseMixin):
 
     def __init__(self, *args, **kw):
         super(BaseIdNameMixin, self).__init__(*args, **kw)
-        if not self.name:
+        if not self.name and not self.__name_deferred__:
             self.make_name()
 
     def __repr__(self):
@@ -586,7 +959,20 @@ class BaseScopedIdMixin(BaseMixin):
             event = db.relationship(Event)
             parent = db.synonym('event')
             __table_args__ = (db.UniqueConstraint('event_id', 'url_id'),)
+
+    By default, :attr:`url_id` is set with a SQL expression that is evaluated
+    when the row is inserted. Models with ``__url_id_deferred__ = True`` are
+    instead numbered when flushed, with one query per parent for all new
+    instances in the flush. This is faster for bulk inserts, but numbers are
+    picked by the client, so concurrent writers depend on the unique
+    constraint to fail rather than conflict.
     """
+    #: Remember instances found by :meth:`get` for the rest of the request?
+    __get_cache__ = False
+    #: Number new instances when flushed, in a batch with other new instances,
+    #: instead of with a SQL expression when inserted?
+    __url_id_deferred__ = False
+
     @with_roles(read={'all'})
     @declared_attr
     def url_id(cls):
@@ -595,7 +981,7 @@ class BaseScopedIdMixin(BaseMixin):
 
     def __init__(self, *args, **kw):
         super(BaseScopedIdMixin, self).__init__(*args, **kw)
-        if self.parent:
+        if self.parent and not self.__url_id_deferred__:
             self.make_id()
 
     def __repr__(self):
@@ -605,7 +991,18 @@ class BaseScopedIdMixin(BaseMixin):
     @classmethod
     def get(cls, parent, url_id):
         """Get an instance matching the parent and url_id"""
-        return cls.query.filter_by(parent=parent, url_id=url_id).one_or_none()
+        return _get_instance(cls, 'url_id', url_id, parent, scoped=True)
+
+    @classmethod
+    def load_parents(cls, instances):
+        """
+        Load the parents of the given instances, and their parents in turn, in a
+        single query, so that :attr:`parent` and :meth:`permissions` do not
+        query the database once per instance. Instances that are not in a
+        session are skipped. Returns ``instances``.
+        """
+        _load_parent_chain(cls, instances)
+        return instances
 
     def make_id(self):
         """Create a new URL id that is unique to the parent container"""
@@ -620,7 +1017,7 @@ class BaseScopedIdMixin(BaseMixin):
         if inherited is not None:
             return inherited | super(BaseScopedIdMixin, self).permissions(actor)
         elif self.parent is not None and isinstance(self.parent, PermissionMixin):
-            return self.parent.permissions(actor) | super(BaseScopedIdMixin, self).permissions(actor)
+            return cached_permissions(self.parent, actor) | super(BaseScopedIdMixin, self).permissions(actor)
         else:
             return super(BaseScopedIdMixin, self).permissions(actor)
 
@@ -657,6 +1054,9 @@ class BaseScopedIdNameMixin(BaseScopedIdMixin):
     __name_blank_allowed__ = False
     #: How long should names and titles be?
     __name_length__ = __title_length__ = 250
+    #: Make names when flushed, in a batch with other new instances, instead
+    #: of when constructed?
+    __name_deferred__ = False
 
     @declared_attr
     def name(cls):
@@ -673,9 +1073,9 @@ class BaseScopedIdNameMixin(BaseScopedIdMixin):
 
     def __init__(self, *args, **kw):
         super(BaseScopedIdNameMixin, self).__init__(*args, **kw)
-        if self.parent:
+        if self.parent and not self.__url_id_deferred__:
             self.make_id()
-        if not self.name:
+        if not self.name and not self.__name_deferred__:
             self.make_name()
 
     def __repr__(self):
@@ -721,11 +1121,20 @@ class BaseScopedIdNameMixin(BaseScopedIdMixin):
 class CoordinatesMixin(object):
     """
     Adds :attr:`latitude` and :attr:`longitude` columns with a shorthand :attr:`coordinates`
-    property that returns both.
+    property that returns both, and an indexed :attr:`geohash` column that is
+    updated when the model is saved. The geohash is used by the location query
+    helpers :meth:`within_box`, :meth:`near` and :meth:`nearest`::
+
+        Event.query.filter(Event.within_box(12.8, 77.4, 13.1, 77.8))
+        Event.near(12.9716, 77.5946, 5000)  # Returns [(event, distance), ...]
+
+    Distances are in metres.
     """
 
     latitude = Column(Numeric)
     longitude = Column(Numeric)
+    #: Geohash of the coordinates, for indexed location queries
+    geohash = Column(Unicode(12), nullable=True, index=True)
 
     @property
     def coordinates(self):
@@ -735,6 +1144,173 @@ class CoordinatesMixin(object):
     def coordinates(self, value):
         self.latitude, self.longitude = value
 
+    def update_geohash(self):
+        """Update :attr:`geohash` from the coordinates. Called when the model is saved"""
+        if self.latitude is None or self.longitude is None:
+            geohash = None
+        else:
+            geohash = make_geohash(self.latitude, self.longitude)
+        if self.geohash != geohash:
+            self.geohash = geohash
+
+    @classmethod
+    def backfill_geohash(cls, session=None, chunksize=1000):
+        """
+        Fills in :attr:`geohash` for rows that have coordinates but no geohash,
+        such as rows saved before the column was added, or inserted via
+        SQLAlchemy Core. The location query helpers skip these rows until
+        then. Changes are flushed, but not committed. Returns the number of
+        rows updated.
+
+        :param session: Session to use. Defaults to the model's query session
+        :param int chunksize: Number of rows to load and flush at a time
+        """
+        if session is None:
+            session = cls.query.session
+        count = 0
+        while True:
+            instances = session.query(cls).filter(
+                cls.geohash.is_(None), cls.latitude.isnot(None), cls.longitude.isnot(None)).limit(chunksize).all()
+            if not instances:
+                return count
+            for instance in instances:
+                instance.update_geohash()
+            session.flush()
+            count += len(instances)
+
+    @classmethod
+    def within_box(cls, south, west, north, east):
+        """
+        Returns a SQL filter for locations within the given bounding box. The
+        box may cross the antimeridian, with ``west`` greater than ``east``.
+        """
+        if west > east:
+            longitude = or_(cls.longitude >= west, cls.longitude <= east)
+        else:
+            longitude = cls.longitude.between(west, east)
+        criteria = [cls.latitude.between(south, north), longitude]
+        cells = _geohash_cover(south, west, north, east)
+        if cells is not None:
+            # Range comparisons on the geohash use its index
+            ranges = []
+            for cell in cells:
+                upper = _geohash_next(cell)
+                if upper is None:
+                    ranges.append(cls.geohash >= cell)
+                else:
+                    ranges.append(and_(cls.geohash >= cell, cls.geohash < upper))
+            criteria.insert(0, or_(*ranges))
+        return and_(*criteria)
+
+    @classmethod
+    def within_radius(cls, latitude, longitude, radius):
+        """
+        Returns a SQL filter for locations within the bounding box of a circle of
+        ``radius`` metres around the given point. Locations in the corners of
+        the box are included, so use :meth:`near` for exact results.
+        """
+        latitude = float(latitude)
+        longitude = float(longitude)
+        dlat = math.degrees(float(radius) / _earth_radius)
+        south = latitude - dlat
+        north = latitude + dlat
+        if south <= -90 or north >= 90:
+            # The circle includes a pole, and hence all longitudes
+            return cls.within_box(max(south, -90), -180, min(north, 90), 180)
+        dlon = math.degrees(math.asin(min(math.sin(float(radius) / _earth_radius) /
+            math.cos(math.radians(latitude)), 1)))
+        west = longitude - dlon
+        east = longitude + dlon
+        if dlon >= 180:
+            west, east = -180, 180
+        else:
+            if west < -180:
+                west += 360
+            if east > 180:
+                east -= 360
+        return cls.within_box(south, west, north, east)
+
+    @classmethod
+    def distance_from(cls, latitude, longitude):
+        """
+        Returns a SQL expression for the distance from the given point, using
+        the haversine formula. This requires trigonometric functions in the
+        database, as available in PostgreSQL
+        """
+        lat = math.radians(float(latitude))
+        lon = math.radians(float(longitude))
+        row_lat = func.radians(cast(cls.latitude, Float))
+        row_lon = func.radians(cast(cls.longitude, Float))
+        return 2 * _earth_radius * func.asin(func.sqrt(
+            func.power(func.sin((row_lat - lat) / 2), 2) +
+            math.cos(lat) * func.cos(row_lat) * func.power(func.sin((row_lon - lon) / 2), 2)))
+
+    @staticmethod
+    def distances(instances, latitude, longitude):
+        """
+        Returns the distances of the given instances from the given point, as a
+        list in the same order, with None for instances without coordinates.
+        The point's trigonometry is computed once for all instances.
+        """
+        lat = math.radians(float(latitude))
+        lon = math.radians(float(longitude))
+        cos_lat = math.cos(lat)
+        sin, cos, asin, sqrt, radians = math.sin, math.cos, math.asin, math.sqrt, math.radians
+        diameter = 2 * _earth_radius
+        result = []
+        for instance in instances:
+            if instance.latitude is None or instance.longitude is None:
+                result.append(None)
+                continue
+            row_lat = radians(float(instance.latitude))
+            a = (sin((row_lat - lat) / 2) ** 2 +
+                cos_lat * cos(row_lat) * sin((radians(float(instance.longitude)) - lon) / 2) ** 2)
+            result.append(diameter * asin(sqrt(min(a, 1.0))))
+        return result
+
+    @classmethod
+    def near(cls, latitude, longitude, radius, query=None, limit=None):
+        """
+        Returns a list of ``(instance, distance)`` for locations within
+        ``radius`` metres of the given point, nearest first. On PostgreSQL, the
+        distance is computed in the database. Elsewhere, locations are loaded
+        using :meth:`within_radius` and the distance is computed in Python.
+
+        :param query: Query to filter. Defaults to ``cls.query``
+        :param int limit: Maximum number of results
+        """
+        if query is None:
+            query = cls.query
+        query = query.filter(cls.within_radius(latitude, longitude, radius))
+        bind = query.session.get_bind(mapper=inspect(cls))
+        if bind.dialect.name == 'postgresql':
+            distance = cls.distance_from(latitude, longitude).label('distance')
+            query = query.add_columns(distance).filter(distance <= radius).order_by(distance)
+            if limit is not None:
+                query = query.limit(limit)
+            return [(instance, value) for instance, value in query]
+        instances = query.all()
+        results = sorted(
+            ((value, index, instance) for index, (instance, value) in enumerate(
+                zip(instances, cls.distances(instances, latitude, longitude))) if value <= radius))
+        return [(instance, value) for value, index, instance in results[:limit]]
+
+    @classmethod
+    def nearest(cls, latitude, longitude, limit=10, query=None, radius=1000):
+        """
+        Returns a list of the ``limit`` nearest locations to the given point as
+        ``(instance, distance)``, nearest first. This searches with :meth:`near`
+        within ``radius`` metres, doubling it until enough locations are found.
+
+        :param query: Query to filter. Defaults to ``cls.query``
+        """
+        while True:
+            results = cls.near(latitude, longitude, radius, query=query, limit=limit)
+            # Half the Earth's circumference covers the whole globe
+            if len(results) >= limit or radius >= math.pi * _earth_radius:
+                return results
+            radius *= 2
+
 
 # --- Auto-populate columns ---------------------------------------------------
 
@@ -756,6 +1332,15 @@ event.listen(IdMixin, 'mapper_configured', __configure_id_listener, propagate=Tr
 event.listen(UuidMixin, 'mapper_configured', __configure_uuid_listener, propagate=True)
 
 
+# Update the geohash of locations
+def __update_geohash(mapper, connection, target):
+    target.update_geohash()
+
+
+event.listen(CoordinatesMixin, 'before_insert', __update_geohash, propagate=True)
+event.listen(CoordinatesMixin, 'before_update', __update_geohash, propagate=True)
+
+
 # Populate name and url_id columns
 def __make_name(mapper, connection, target):
     if target.name is None:
@@ -772,6 +1357,164 @@ def __make_scoped_id(mapper, connection, target):
         target.make_id()
 
 
+# Name and number new instances of models with ``__name_deferred__`` or
+# ``__url_id_deferred__`` in a batch before flushing. The insert listeners
+# above remain for instances that the batch doesn't handle
+
+
+def _uses_mixin_method(cls, mixin, name):
+    """Is ``cls`` using ``mixin``'s implementation of method ``name``?"""
+    return six.get_unbound_function(getattr(cls, name)) is six.get_unbound_function(getattr(mixin, name))
+
+
+def _column_owner(cls, key):
+    """
+    Return the model whose table holds column ``key``, so that models sharing
+    a table through single table inheritance are numbered and named together
+    """
+    return inspect(cls).get_property(key).parent.class_
+
+
+def __batch_make_names(session, instances):
+    """
+    Make names for new instances, with one query for existing names per model
+    (or per model and parent, for scoped names)
+    """
+    slugs = {}  # Cache of (text, maxlength): name, as titles often repeat
+    groups = {}
+    for instance in instances:
+        cls = instance.__class__
+        # Names are unique in BaseNameMixin and BaseScopedNameMixin models only
+        if isinstance(instance, BaseScopedIdNameMixin):
+            kind, unique = BaseScopedIdNameMixin, False
+        elif isinstance(instance, BaseIdNameMixin):
+            kind, unique = BaseIdNameMixin, False
+        elif isinstance(instance, BaseNameMixin):
+            kind, unique = BaseNameMixin, True
+        elif isinstance(instance, BaseScopedNameMixin):
+            kind, unique = BaseScopedNameMixin, True
+        else:
+            continue
+        if not cls.__name_deferred__ or not _uses_mixin_method(cls, kind, 'make_name'):
+            continue
+        if not unique:
+            if instance.name is None and instance.title:
+                key = (instance.title, cls.__name_length__)
+                if key not in slugs:
+                    slugs[key] = six.text_type(make_name(instance.title, maxlength=cls.__name_length__))
+                instance.name = slugs[key]
+            continue
+        parent = instance.parent if kind is BaseScopedNameMixin else None
+        if kind is BaseScopedNameMixin and parent is None:
+            continue
+        group = groups.setdefault((_column_owner(cls, 'name'), parent), ([], set()))
+        if instance.name is None:
+            if instance.title:
+                group[0].append(instance)
+        else:
+            # Names given to other new instances are also unavailable
+            group[1].add(instance.name)
+
+    for (cls, parent), (pending, taken) in groups.items():
+        if not pending:
+            continue
+        maxlength = cls.__name_length__
+        texts = [instance.short_title() if parent is not None else instance.title for instance in pending]
+        # The names make_name will try first: the slug, then the slug with
+        # counters, skipping names given to other new instances, up to one
+        # more than the number of instances sharing a title
+        candidates = set()
+        for text in set(texts):
+            tried = []
+
+            def collect(candidate, tried=tried, count=texts.count(text)):
+                if candidate in taken:
+                    return True
+                tried.append(candidate)
+                return len(tried) <= count
+            make_name(text, maxlength=maxlength, checkused=collect)
+            candidates.update(tried)
+
+        def exists(candidate, cls=cls, parent=parent):
+            query = session.query(cls.name).filter(cls.name == candidate)
+            if parent is not None:
+                query = query.filter(cls.parent == parent)
+            return session.query(query.exists()).scalar()
+
+        if parent is None or inspect(parent).has_identity:
+            query = session.query(cls.name).filter(cls.name.in_(candidates))
+            if parent is not None:
+                query = query.filter(cls.parent == parent)
+            taken.update(name for (name,) in query)
+        else:
+            # A new parent has no existing children
+            exists = None
+        taken.update(cls.reserved_names)
+        for instance, text in zip(pending, texts):
+            def checkused(candidate):
+                if candidate in taken:
+                    return True
+                if exists is not None and candidate not in candidates:
+                    return exists(candidate)
+                return False
+            instance.name = six.text_type(make_name(text, maxlength=maxlength, checkused=checkused))
+            taken.add(instance.name)
+
+
+def __batch_make_ids(session, instances):
+    """
+    Number new instances of scoped id models in blocks, with one query for the
+    highest existing id per model and parent
+    """
+    groups = {}
+    for instance in instances:
+        cls = instance.__class__
+        if (not isinstance(instance, BaseScopedIdMixin) or not cls.__url_id_deferred__ or
+                instance.parent is None):
+            continue
+        group = groups.setdefault((_column_owner(cls, 'url_id'), instance.parent), ([], set()))
+        url_id = instance.url_id
+        # :meth:`BaseScopedIdMixin.make_id` sets a SQL expression that is replaced here
+        if url_id is None or isinstance(url_id, ClauseElement):
+            if _uses_mixin_method(cls, BaseScopedIdMixin, 'make_id'):
+                group[0].append(instance)
+        else:
+            group[1].add(url_id)
+
+    for (cls, parent), (pending, taken) in groups.items():
+        if not pending:
+            continue
+        if inspect(parent).has_identity:
+            last = session.query(func.max(cls.url_id)).filter(cls.parent == parent).scalar() or 0
+        else:
+            last = 0
+        for instance in pending:
+            last += 1
+            while last in taken:
+                last += 1
+            instance.url_id = last
+
+
+def __batch_names_and_ids(session, flush_context, instances):
+    new = sorted(session.new, key=lambda instance: inspect(instance).insert_order)
+    if new:
+        with session.no_autoflush:
+            __batch_make_ids(session, new)
+            __batch_make_names(session, new)
+
+
+def __listen_for_batches(mapper, cls):
+    # Only listen to sessions once a model uses batches
+    if ((getattr(cls, '__name_deferred__', False) or getattr(cls, '__url_id_deferred__', False)) and
+            not event.contains(Session, 'before_flush', __batch_names_and_ids)):
+        event.listen(Session, 'before_flush', __batch_names_and_ids)
+
+
+event.listen(BaseNameMixin, 'mapper_configured', __listen_for_batches, propagate=True)
+event.listen(BaseScopedNameMixin, 'mapper_configured', __listen_for_batches, propagate=True)
+event.listen(BaseIdNameMixin, 'mapper_configured', __listen_for_batches, propagate=True)
+event.listen(BaseScopedIdMixin, 'mapper_configured', __listen_for_batches, propagate=True)
+
 event.listen(BaseNameMixin, 'before_insert', __make_name, propagate=True)
 event.listen(BaseIdNameMixin, 'before_insert', __make_name, propagate=True)
 event.listen(BaseScopedIdMixin, 'before_insert', __make_scoped_id, propagate=True)
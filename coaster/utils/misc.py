@@ -7,12 +7,14 @@ Miscellaneous utilities
 
 from __future__ import absolute_import
 import collections
+import os
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from random import randint, randrange
 import uuid
 from base64 import urlsafe_b64encode, urlsafe_b64decode, b64encode, b64decode
 import hashlib
+import math
 import re
 import binascii
 import email.utils
@@ -42,6 +44,23 @@ _username_valid_re = re.compile('^[a-z0-9]([a-z0-9-]*[a-z0-9])?$')
 _ipv4_re = re.compile(r'^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$')
 _tag_re = re.compile('<.*?>')
 
+# Translation tables between standard and URL-safe Base64, for BUIDs
+if six.PY3:  # pragma: no cover
+    _buid_encode_table = bytes.maketrans(b'+/', b'-_')
+    _buid_decode_table = bytes.maketrans(b'-_', b'+/')
+
+# Version and variant bits for UUID4s made by :func:`uuid4_many` and UUID7s
+_uuid4_clear_bits = _uuid7_clear_bits = ~((0xc000 << 48) | (0xf000 << 64))
+_uuid4_set_bits = (0x8000 << 48) | (4 << 76)
+_uuid7_set_bits = (0x8000 << 48) | (7 << 76)
+
+# Reference time for UUID7 timestamps
+_epoch = datetime(1970, 1, 1)
+
+# Geohash alphabet, and the mean radius of the Earth in metres
+_geohash_alphabet = '0123456789bcdefghjkmnpqrstuvwxyz'
+_earth_radius = 6371008.8
+
 
 # --- Utilities ---------------------------------------------------------------
 
@@ -88,10 +107,30 @@ def buid():
     >>> isinstance(buid(), six.text_type)
     True
     """
+    return uuid2buid(uuid.uuid4())
+
+
+def uuid4_many(count):
+    """
+    Return a list of ``count`` random UUID4s. This is faster than calling
+    :func:`uuid.uuid4` repeatedly as the random bytes for all the UUIDs are
+    read from :func:`os.urandom` in a single call.
+
+    >>> uuids = uuid4_many(3)
+    >>> len(set(uuids))
+    3
+    >>> [u.version for u in uuids]
+    [4, 4, 4]
+    >>> uuid4_many(0)
+    []
+    """
+    data = os.urandom(16 * count)
     if six.PY3:  # pragma: no cover
-        return urlsafe_b64encode(uuid.uuid4().bytes).decode('utf-8').rstrip('=')
+        # Set the version and variant bits directly, as UUID(bytes=..., version=4) does
+        return [uuid.UUID(int=(int.from_bytes(data[offset:offset + 16], 'big') & _uuid4_clear_bits) | _uuid4_set_bits)
+            for offset in range(0, 16 * count, 16)]
     else:  # pragma: no cover
-        return six.text_type(urlsafe_b64encode(uuid.uuid4().bytes).rstrip('='))
+        return [uuid.UUID(bytes=data[offset:offset + 16], version=4) for offset in range(0, 16 * count, 16)]
 
 
 def uuid1mc():
@@ -145,6 +184,56 @@ def uuid1mc_from_datetime(dt):
     return uuid.UUID(fields=tuple(fields))
 
 
+def uuid7():
+    """
+    Return a time-ordered UUID, using the UUID version 7 layout: the first 48
+    bits are the Unix timestamp in milliseconds and the rest are random (apart
+    from the version and variant bits). UUID7s sort in order of creation, so
+    they are inserted at the end of database indexes, unlike random UUID4s.
+
+    >>> u1 = uuid7()
+    >>> u1.version
+    7
+    >>> u1 == uuid7()
+    False
+    >>> abs(uuid7_to_datetime(u1) - datetime.utcnow()) < timedelta(seconds=1)
+    True
+    """
+    value = (int(time.time() * 1000) << 80) | int(binascii.hexlify(os.urandom(10)), 16)
+    return uuid.UUID(int=(value & _uuid7_clear_bits) | _uuid7_set_bits)
+
+
+def uuid7_from_datetime(dt):
+    """
+    Return the lowest UUID7 for the given datetime (naive datetimes are
+    assumed to be in UTC). This is not a unique id, but can be used to find
+    UUID7s created after (or before) a given time::
+
+        Model.query.filter(Model.id >= uuid7_from_datetime(start))
+
+    >>> uuid7_from_datetime(datetime(2018, 10, 18, 10, 13, 0, 123456))
+    UUID('016686aa-005b-7000-8000-000000000000')
+    >>> uuid7_to_datetime(uuid7_from_datetime(datetime(2018, 10, 18, 10, 13, 0, 123456)))
+    datetime.datetime(2018, 10, 18, 10, 13, 0, 123000)
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    delta = dt - _epoch
+    milliseconds = (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+    return uuid.UUID(int=(milliseconds << 80) | _uuid7_set_bits)
+
+
+def uuid7_to_datetime(value):
+    """
+    Return the creation time of a UUID7, as a naive datetime in UTC, with
+    millisecond precision.
+
+    >>> uuid7_to_datetime(uuid.UUID('016686aa-005b-7d3c-92d7-e6e1e06f2a2b'))
+    datetime.datetime(2018, 10, 18, 10, 13, 0, 123000)
+    """
+    return _epoch + timedelta(milliseconds=value.int >> 80)
+
+
 def uuid2buid(value):
     """
     Convert a UUID object to a 22-char BUID string
@@ -154,7 +243,8 @@ def uuid2buid(value):
     'MyA90vLvQi-usAWNb19wiQ'
     """
     if six.PY3:  # pragma: no cover
-        return urlsafe_b64encode(value.bytes).decode('utf-8').rstrip('=')
+        # Same as ``urlsafe_b64encode(value.bytes).decode().rstrip('=')``, minus the overhead
+        return binascii.b2a_base64(value.bytes)[:22].translate(_buid_encode_table).decode('ascii')
     else:
         return six.text_type(urlsafe_b64encode(value.bytes).rstrip('='))
 
@@ -167,7 +257,11 @@ def buid2uuid(value):
     >>> buid2uuid(b)
     UUID('33203dd2-f2ef-422f-aeb0-058d6f5f7089')
     """
-    return uuid.UUID(bytes=urlsafe_b64decode(str(value) + '=='))
+    if six.PY3:  # pragma: no cover
+        return uuid.UUID(bytes=binascii.a2b_base64(
+            str(value).encode('ascii').translate(_buid_decode_table) + b'=='))
+    else:
+        return uuid.UUID(bytes=urlsafe_b64decode(str(value) + '=='))
 
 
 def newsecret():
@@ -804,3 +898,114 @@ def domain_namespace_match(domain, namespace):
     True
     """
     return base_domain_matches(domain, ".".join(namespace.split(".")[::-1]))
+
+
+def geohash(latitude, longitude, precision=12):
+    """
+    Return the `geohash <https://en.wikipedia.org/wiki/Geohash>`_ of the given
+    coordinates. Nearby locations share a geohash prefix, so geohashes can be
+    used for indexed location queries.
+
+    >>> geohash(57.64911, 10.40744, 11)
+    'u4pruydqqvj'
+    >>> geohash(12.9716, 77.5946, 6)
+    'tdr1v9'
+    """
+    south, north = -90.0, 90.0
+    west, east = -180.0, 180.0
+    latitude = float(latitude)
+    longitude = float(longitude)
+    chars = []
+    bits = 0
+    index = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        if even:
+            middle = (west + east) / 2
+            if longitude >= middle:
+                index = index * 2 + 1
+                west = middle
+            else:
+                index = index * 2
+                east = middle
+        else:
+            middle = (south + north) / 2
+            if latitude >= middle:
+                index = index * 2 + 1
+                south = middle
+            else:
+                index = index * 2
+                north = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_geohash_alphabet[index])
+            bits = 0
+            index = 0
+    return ''.join(chars)
+
+
+def _geohash_cell_size(precision):
+    """Return the (height, width) in degrees of geohash cells of the given precision"""
+    bits = precision * 5
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def _geohash_cover(south, west, north, east, maxcells=16):
+    """
+    Return the longest geohash prefixes, at most ``maxcells`` in number, that
+    together cover the given bounding box, or None if the box is too large (or
+    crosses the antimeridian).
+    """
+    if west > east:
+        return None
+    for precision in range(12, 0, -1):
+        height, width = _geohash_cell_size(precision)
+        # The north and east edges of the world are in the last row and column
+        last_row = int(round(180 / height)) - 1
+        last_column = int(round(360 / width)) - 1
+        first_row = min(int(math.floor((south + 90) / height)), last_row)
+        first_column = min(int(math.floor((west + 180) / width)), last_column)
+        rows = min(int(math.floor((north + 90) / height)), last_row) - first_row + 1
+        columns = min(int(math.floor((east + 180) / width)), last_column) - first_column + 1
+        if rows * columns <= maxcells:
+            break
+    else:
+        return None
+    cells = set()
+    for row in range(first_row, first_row + rows):
+        for column in range(first_column, first_column + columns):
+            # Use the center of each cell to find its geohash
+            cells.add(geohash((row + 0.5) * height - 90, (column + 0.5) * width - 180, precision))
+    return sorted(cells)
+
+
+def _geohash_next(prefix):
+    """
+    Return the lowest string that sorts after all geohashes with the given
+    prefix, or None if there is no such geohash.
+    """
+    while prefix:
+        last = _geohash_alphabet.index(prefix[-1])
+        if last < len(_geohash_alphabet) - 1:
+            return prefix[:-1] + _geohash_alphabet[last + 1]
+        prefix = prefix[:-1]
+    return None
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    """
+    Return the great-circle distance in metres between two points, using the
+    haversine formula.
+
+    >>> int(haversine(12.9716, 77.5946, 13.0827, 80.2707))
+    290172
+    >>> haversine(12.9716, 77.5946, 12.9716, 77.5946)
+    0.0
+    """
+    lat1 = math.radians(float(latitude1))
+    lat2 = math.radians(float(latitude2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+        math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(float(longitude2) - float(longitude1)) / 2) ** 2)
+    return 2 * _earth_radius * math.asin(math.sqrt(a))
@@ -16,7 +16,7 @@ from sqlalchemy.orm.descriptor_props import SynonymProperty
 from werkzeug.routing import parse_rule
 from werkzeug.local import LocalProxy
 from flask import _request_ctx_stack, has_request_context, request, redirect, make_response, Blueprint
-from ..auth import current_auth, add_auth_attribute
+from ..auth import current_auth, add_auth_attribute, cached_permissions
 from ..utils import InspectableSet
 
 __all__ = [
@@ -513,7 +513,7 @@ class ModelView(ClassView):
                 perms = None
                 for subobj in self.obj:
                     if hasattr(subobj, 'permissions'):
-                        perms = subobj.permissions(current_auth.actor, perms)
+                        perms = cached_permissions(subobj, current_auth.actor, perms)
                 perms = InspectableSet(perms or set())
             elif hasattr(self.obj, 'current_permissions'):
                 # current_permissions always returns an InspectableSet
@@ -10,15 +10,27 @@ All items in this module can be imported directly from :mod:`coaster.views`.
 """
 
 from __future__ import absolute_import
+from collections import namedtuple, OrderedDict
 from functools import wraps
+from operator import attrgetter
+import inspect
+import sys
+from threading import Lock
+from weakref import WeakKeyDictionary
 import six
-from werkzeug.datastructures import Headers
+from werkzeug.datastructures import Headers, MIMEAccept
 from werkzeug.exceptions import BadRequest
+from werkzeug.http import parse_accept_header
 from werkzeug.wrappers import Response as WerkzeugResponse
+from sqlalchemy import bindparam
+from sqlalchemy.orm import aliased, class_mapper
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
+from sqlalchemy.orm.descriptor_props import SynonymProperty
 from flask import (abort, current_app, g, jsonify, make_response, redirect, render_template,
     request, Response, url_for)
 from ..utils import is_collection
-from ..auth import current_auth, add_auth_attribute
+from ..auth import current_auth, add_auth_attribute, cached_permissions
 from .misc import jsonp
 
 __all__ = [
@@ -39,6 +51,49 @@ class RequestValueError(BadRequest, ValueError):
     pass
 
 
+# Request attributes for each requestargs source
+_request_sources = {None: 'values', 'form': 'form', 'query': 'args'}
+
+# Wrappers created by requestargs: (target, sources, required), for combining
+# stacked requestargs decorators
+_requestargs_wrappers = WeakKeyDictionary()
+
+
+def _filter_list(filt, items):
+    """Apply a requestargs filter to each item, dropping invalid items"""
+    result = []
+    for item in items:
+        try:
+            result.append(filt(item))
+        except ValueError:
+            pass
+    return result
+
+
+def _required_params(f):
+    """
+    Return ``(position, name)`` for each parameter of ``f`` that has no default
+    (with keyword-only parameters at position :attr:`sys.maxsize`), or ``None``
+    if this can't be determined. Decorators wrapping ``f`` are not looked
+    through, as they may supply parameters themselves.
+    """
+    try:
+        if six.PY2:  # pragma: no cover
+            spec = inspect.getargspec(f)
+            return list(enumerate(spec.args[:len(spec.args) - len(spec.defaults or ())]))
+        parameters = inspect.signature(f, follow_wrapped=False).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    required = []
+    for position, param in enumerate(parameters):
+        if param.default is param.empty:
+            if param.kind == param.POSITIONAL_OR_KEYWORD:
+                required.append((position, param.name))
+            elif param.kind == param.KEYWORD_ONLY:
+                required.append((sys.maxsize, param.name))
+    return required
+
+
 def requestargs(*vars, **config):
     """
     Decorator that loads parameters from request.values if not specified in the
@@ -51,15 +106,19 @@ def requestargs(*vars, **config):
     requestargs takes a list of parameters to pass to the wrapped function, with
     an optional filter (useful to convert incoming string request data into integers
     and other common types). If a required parameter is missing and your function does
-    not specify a default value, Python will raise TypeError. requestargs recasts this
-    as :exc:`RequestTypeError`, which returns HTTP 400 Bad Request.
+    not specify a default value, requestargs raises :exc:`RequestTypeError`, which
+    returns HTTP 400 Bad Request. Other errors from your function are not affected.
 
     If the parameter name ends in ``[]``, requestargs will attempt to read a list from
     the incoming data. Filters are applied to each member of the list, not to the whole
     list.
 
-    If the filter raises a ValueError, this is recast as a :exc:`RequestValueError`,
-    which also returns HTTP 400 Bad Request.
+    If the filter raises a ValueError, the parameter is left as ``None``, and invalid
+    members of a list are dropped.
+
+    Parameters and the function's signature are examined once, when decorating.
+    When :func:`requestargs`, :func:`requestform` and :func:`requestquery` are
+    stacked, they are combined into a single wrapper.
 
     Tests::
 
@@ -93,39 +152,53 @@ def requestargs(*vars, **config):
         raise TypeError("Unrecognised parameters: %s" % repr(config.keys()))
 
     def inner(f):
-        namefilt = [(name[:-2], filt, True) if name.endswith('[]') else (name, filt, False)
-            for name, filt in
-                [(v[0], v[1]) if isinstance(v, (list, tuple)) else (v, None) for v in vars]]
-
-        if config and config.get('source') == 'form':
-            def datasource():
-                return request.form if request else {}
-        elif config and config.get('source') == 'query':
-            def datasource():
-                return request.args if request else {}
+        # {name: (filter, is_list)} for parameters from this source
+        fields = {}
+        for v in vars:
+            name, filt = (v[0], v[1]) if isinstance(v, (list, tuple)) else (v, None)
+            if name.endswith('[]'):
+                fields[name[:-2]] = (filt, True)
+            else:
+                fields[name] = (filt, False)
+        sources = [(_request_sources[config.get('source')], fields)]
+
+        # Look up the registry rather than an attribute, as :func:`~functools.wraps`
+        # copies attributes to the wrappers of other decorators
+        stacked = _requestargs_wrappers.get(f)
+        if stacked is not None:
+            # Call the original function directly, loading its parameters here
+            target, inner_sources, required = stacked
+            sources.extend(inner_sources)
         else:
-            def datasource():
-                return request.values if request else {}
+            target = f
+            required = _required_params(f)
 
         @wraps(f)
         def decorated_function(*args, **kw):
-            values = datasource()
-            for name, filt, is_list in namefilt:
-                # Process name if
-                # (a) it's not in the function's parameters, and
-                # (b) is in the form/query
-                if name not in kw and name in values:
-                    try:
-                        if is_list:
-                            kw[name] = values.getlist(name, type=filt)
-                        else:
-                            kw[name] = values.get(name, type=filt)
-                    except ValueError as e:
-                        raise RequestValueError(e)
-            try:
-                return f(*args, **kw)
-            except TypeError as e:
-                raise RequestTypeError(e)
+            if request:
+                for source, fields in sources:
+                    # Make a single pass over the request's data
+                    for name, items in getattr(request, source).lists():
+                        field = fields.get(name)
+                        if field is not None and name not in kw:
+                            filt, is_list = field
+                            if filt is None:
+                                kw[name] = items if is_list else items[0]
+                            elif is_list:
+                                kw[name] = _filter_list(filt, items)
+                            else:
+                                try:
+                                    kw[name] = filt(items[0])
+                                except ValueError:
+                                    kw[name] = None
+            if required:
+                count = len(args)
+                for position, name in required:
+                    if position >= count and name not in kw:
+                        raise RequestTypeError("Missing parameter: %s" % name)
+            return target(*args, **kw)
+
+        _requestargs_wrappers[decorated_function] = (target, sources, required)
         return decorated_function
     return inner
 
@@ -203,6 +276,195 @@ def load_model(model, attributes=None, parameter=None,
         kwargs=kwargs, permission=permission, addlperms=addlperms, urlcheck=urlcheck)
 
 
+#: A step in a :func:`load_models` chain, with the attribute sources compiled into
+#: getters that take ``(result, kw)`` and return the value to filter on
+_ChainStep = namedtuple('_ChainStep', ['models', 'attributes', 'getters', 'parameter', 'to_g'])
+
+
+def _chain_getter(v):
+    """Compile an attribute source in a :func:`load_models` chain into a getter"""
+    if callable(v):
+        return v
+    if '.' in v:
+        first, attrs = v.split('.', 1)
+        getter = attrgetter(attrs)
+        return lambda result, kw: getter(result.get(first))
+    return lambda result, kw: result[v] if v in result else kw.get(v)
+
+
+def _compile_chain(chain):
+    """Pre-process a :func:`load_models` chain into a list of :class:`_ChainStep`"""
+    steps = []
+    for models, attributes, parameter in chain:
+        if not isinstance(models, (list, tuple)):
+            models = (models,)
+        attributes = list(attributes.items())
+        to_g = parameter.startswith('g.')
+        if to_g:
+            parameter = parameter[2:]
+        steps.append(_ChainStep(tuple(models), attributes,
+            [_chain_getter(v) for k, v in attributes], parameter, to_g))
+    return steps
+
+
+def _attribute_filter(model, entity, key, name):
+    """
+    Return a ``(name, template, isnull, attr)`` filter for ``entity.key``. Plain
+    columns get a criterion template with a bind parameter named ``name`` and an
+    ``IS NULL`` criterion for None. Other attributes (relationships and hybrid
+    properties) have no template and are compared with ``attr`` on each request.
+    """
+    attr = getattr(entity, key)
+    prop = _join_property(model, key)
+    if isinstance(prop, ColumnProperty) and len(prop.columns) == 1:
+        return (name, attr == bindparam(name, type_=prop.columns[0].type), attr.is_(None), attr)
+    return (name, None, None, attr)
+
+
+def _filter_query(query, filters, values):
+    """Apply filters from :func:`_attribute_filter` to a query with the given values"""
+    criteria = []
+    params = {}
+    for (name, template, isnull, attr), value in zip(filters, values):
+        if template is None:
+            criteria.append(attr == value)
+        elif value is None:
+            criteria.append(isnull)
+        else:
+            criteria.append(template)
+            params[name] = value
+    query = query.filter(*criteria)
+    if params:
+        query = query.params(params)
+    return query
+
+
+def _load_models_filters(steps):
+    """Compile filters for every candidate model in every step of a chain"""
+    return [
+        [[_attribute_filter(model, model, k, 'lm_%d_%s' % (index, k)) for k, v in step.attributes]
+            for model in step.models]
+        for index, step in enumerate(steps)]
+
+
+def _join_property(model, key):
+    """Return the mapper property for ``model.key``, following synonyms, or None"""
+    mapper = class_mapper(model)
+    if not mapper.has_property(key):
+        return None
+    prop = mapper.get_property(key)
+    while isinstance(prop, SynonymProperty):
+        prop = mapper.get_property(prop.name)
+    return prop
+
+
+def _join_relationship(prop):
+    """Return local columns keyed by remote column for a many-to-one relationship"""
+    if not isinstance(prop, RelationshipProperty) or prop.direction is not MANYTOONE:
+        return None
+    return dict((remote, local) for local, remote in prop.local_remote_pairs)
+
+
+def _join_condition(model, alias, key, ref_model, ref_alias, ref_attr=None):
+    """
+    Return a list of SQL conditions that link ``alias.key`` to the entity loaded
+    as ``ref_alias`` (or to ``ref_alias.ref_attr``), or None if they can't be
+    expressed without loading the referenced entity.
+    """
+    prop = _join_property(model, key)
+    if ref_attr is None:
+        # ``{'parent': 'folder'}``: alias.parent is a relationship to the folder
+        pairs = _join_relationship(prop)
+        if pairs is None or not prop.mapper.common_parent(class_mapper(ref_model)):
+            return None
+        ref_mapper = class_mapper(ref_model)
+        return [
+            getattr(alias, prop.parent.get_property_by_column(local).key) ==
+            getattr(ref_alias, ref_mapper.get_property_by_column(remote).key)
+            for remote, local in pairs.items()]
+    ref_prop = _join_property(ref_model, ref_attr)
+    if isinstance(ref_prop, ColumnProperty):
+        # ``{'folder_id': 'folder.id'}``: a plain column comparison
+        if not isinstance(prop, ColumnProperty):
+            return None
+        return [getattr(alias, key) == getattr(ref_alias, ref_attr)]
+    # ``{'parent': 'document.middle'}``: both sides refer to the same row,
+    # so compare the foreign keys instead of loading the middle entity
+    pairs = _join_relationship(prop)
+    ref_pairs = _join_relationship(ref_prop)
+    if pairs is None or ref_pairs is None or set(pairs) != set(ref_pairs):
+        return None
+    return [
+        getattr(alias, prop.parent.get_property_by_column(pairs[remote]).key) ==
+        getattr(ref_alias, ref_prop.parent.get_property_by_column(ref_pairs[remote]).key)
+        for remote in pairs]
+
+
+def _load_models_join_plan(steps):
+    """
+    Compile the longest prefix of a :func:`load_models` chain that can be loaded with
+    a single query. Returns a list of ``(model, alias, conditions, kwfilters)`` tuples,
+    where ``conditions`` are join conditions against earlier entities and ``kwfilters``
+    is a list of ``(filter, view_arg)`` pairs to be filtered on at request time.
+    Steps after the prefix are loaded sequentially.
+    """
+    plan = []
+    aliases = {}
+    for index, step in enumerate(steps):
+        if len(step.models) != 1:
+            break  # Candidate models are tried in order; can't express that in a join
+        model = step.models[0]
+        if hasattr(model, 'redirect_view_args'):
+            break
+        alias = aliased(model)
+        conditions = []
+        kwfilters = []
+        for k, v in step.attributes:
+            if callable(v):
+                conditions = None
+                break
+            first, _sep, attr = v.partition('.')
+            if first in aliases:
+                if '.' in attr:
+                    conditions = None
+                    break
+                ref_model, ref_alias = aliases[first]
+                condition = _join_condition(model, alias, k, ref_model, ref_alias, attr or None)
+                if condition is None:
+                    conditions = None
+                    break
+                conditions.extend(condition)
+            elif attr:
+                conditions = None  # Dotted reference to something that isn't in the chain
+                break
+            else:
+                kwfilters.append((_attribute_filter(model, alias, k, 'lm_%d_%s' % (index, k)), v))
+        if conditions is None:
+            break
+        plan.append((model, alias, conditions, kwfilters))
+        aliases[step.parameter] = (model, alias)
+    return plan
+
+
+def _load_models_join(plan, kw):
+    """Load all entities in a join plan with a single query"""
+    query = plan[0][0].query.session.query(*[alias for model, alias, conditions, kwfilters in plan])
+    filters = []
+    values = []
+    for model, alias, conditions, kwfilters in plan:
+        if conditions:
+            query = query.filter(*conditions)
+        for attrfilter, v in kwfilters:
+            filters.append(attrfilter)
+            values.append(kw.get(v))
+    row = _filter_query(query, filters, values).first()
+    if row is None:
+        abort(404)
+    if len(plan) == 1:
+        return (row,)
+    return tuple(row)
+
+
 def load_models(*chain, **kwargs):
     """
     Decorator to load a chain of models from the given parameters. This works just like
@@ -221,6 +483,12 @@ def load_models(*chain, **kwargs):
         while the ``comment`` can revoke ``edit`` and retain ``delete`` if the current user
         owns the page but not the comment
 
+    :param join: If ``True``, load the chain with a single query that joins each model to
+        the models before it through the attributes that refer to them, instead of one
+        query per model. Steps that can't be expressed as a join (callable attributes,
+        models that provide ``redirect_view_args``, or multiple candidate models) and
+        all steps after them are loaded sequentially as usual
+
     In the following example, load_models loads a Folder with a name matching the name in the
     URL, then loads a Page with a matching name and with the just-loaded Folder as parent.
     If the Page provides a 'view' permission to the current user, the decorated
@@ -234,46 +502,53 @@ def load_models(*chain, **kwargs):
         def show_page(folder, page):
             return render_template('page.html', folder=folder, page=page)
     """
+    permission_required = kwargs.get('permission')
+    if isinstance(permission_required, six.string_types):
+        permission_required = frozenset([permission_required])
+    elif permission_required is not None:
+        permission_required = frozenset(permission_required)
+    addlperms = kwargs.get('addlperms') or []
+    url_check_attributes = frozenset(kwargs.get('urlcheck') or ())
+    pass_kwargs = kwargs.get('kwargs')
+    use_join = kwargs.get('join')
+    steps = _compile_chain(chain)
+    # SQL criteria need configured mappers, so they are compiled on first use
+    compiled = []
+
     def inner(f):
         @wraps(f)
         def decorated_function(*args, **kw):
+            if not compiled:
+                compiled.append((
+                    _load_models_filters(steps),
+                    _load_models_join_plan(steps) if use_join else None))
+            filters, join_plan = compiled[0]
             permissions = None
-            permission_required = kwargs.get('permission')
-            url_check_attributes = kwargs.get('urlcheck', [])
-            if isinstance(permission_required, six.string_types):
-                permission_required = set([permission_required])
-            elif permission_required is not None:
-                permission_required = set(permission_required)
+            extra_permissions = None
+            preloaded = _load_models_join(join_plan, kw) if join_plan else ()
             result = {}
-            for models, attributes, parameter in chain:
-                if not isinstance(models, (list, tuple)):
-                    models = (models,)
-                item = None
-                for model in models:
-                    query = model.query
-                    url_check = False
-                    url_check_paramvalues = {}
-                    for k, v in attributes.items():
-                        if callable(v):
-                            query = query.filter_by(**{k: v(result, kw)})
-                        else:
-                            if '.' in v:
-                                first, attrs = v.split('.', 1)
-                                val = result.get(first)
-                                for attr in attrs.split('.'):
-                                    val = getattr(val, attr)
-                            else:
-                                val = result.get(v, kw.get(v))
-                            query = query.filter_by(**{k: val})
-                        if k in url_check_attributes:
-                            url_check = True
-                            url_check_paramvalues[k] = (v, val)
-                    item = query.first()
-                    if item is not None:
-                        # We found it, so don't look in additional models
-                        break
-                if item is None:
-                    abort(404)
+            for index, step in enumerate(steps):
+                if index < len(preloaded):
+                    item = preloaded[index]
+                    # Only evaluate attributes needed for urlcheck, to avoid loading
+                    # relationships that the joined query has already matched
+                    url_check_paramvalues = dict(
+                        (k, (v, getter(result, kw)))
+                        for (k, v), getter in zip(step.attributes, step.getters)
+                        if k in url_check_attributes)
+                else:
+                    values = [getter(result, kw) for getter in step.getters]
+                    item = None
+                    for model, model_filters in zip(step.models, filters[index]):
+                        item = _filter_query(model.query, model_filters, values).first()
+                        if item is not None:
+                            # We found it, so don't look in additional models
+                            break
+                    if item is None:
+                        abort(404)
+                    url_check_paramvalues = dict(
+                        (k, (v, val)) for (k, v), val in zip(step.attributes, values)
+                        if k in url_check_attributes)
 
                 if hasattr(item, 'redirect_view_args'):
                     # This item is a redirect object. Redirect to destination
@@ -285,16 +560,15 @@ def load_models(*chain, **kwargs):
                     return redirect(location, code=307)
 
                 if permission_required:
-                    permissions = item.permissions(current_auth.actor, inherited=permissions)
-                    addlperms = kwargs.get('addlperms') or []
-                    if callable(addlperms):
-                        addlperms = addlperms() or []
-                    permissions.update(addlperms)
+                    permissions = cached_permissions(item, current_auth.actor, inherited=permissions)
+                    if extra_permissions is None:
+                        extra_permissions = (addlperms() or []) if callable(addlperms) else addlperms
+                    permissions.update(extra_permissions)
                 if g:  # XXX: Deprecated
                     g.permissions = permissions
                 if request:
                     add_auth_attribute('permissions', permissions)
-                if url_check and request.method == 'GET':  # Only do urlcheck redirects on GET requests
+                if url_check_paramvalues and request.method == 'GET':  # Only do urlcheck redirects on GET requests
                     url_redirect = False
                     view_args = None
                     for k, v in url_check_paramvalues.items():
@@ -309,13 +583,12 @@ def load_models(*chain, **kwargs):
                         if request.query_string:
                             location = location + u'?' + request.query_string.decode()
                         return redirect(location, code=302)
-                if parameter.startswith('g.'):
-                    parameter = parameter[2:]
-                    setattr(g, parameter, item)
-                result[parameter] = item
+                if step.to_g:
+                    setattr(g, step.parameter, item)
+                result[step.parameter] = item
             if permission_required and not (permission_required & permissions):
                 abort(403)
-            if kwargs.get('kwargs'):
+            if pass_kwargs:
                 return f(*args, kwargs=kw, **result)
             else:
                 return f(*args, **result)
@@ -323,14 +596,59 @@ def load_models(*chain, **kwargs):
     return inner
 
 
-def _best_mimetype_match(available_list, accept_mimetypes, default=None):
+def _best_mimetype_match(available, accept_mimetypes, default=None):
+    """
+    Return the first of the client's accepted mimetypes (in order of preference)
+    that is in ``available``, a collection of lowercase mimetypes
+    """
     for use_mimetype, quality in accept_mimetypes:
-        for mimetype in available_list:
-            if use_mimetype.lower() == mimetype.lower():
-                return use_mimetype.lower()
+        use_mimetype = use_mimetype.lower()
+        if use_mimetype in available:
+            return use_mimetype
     return default
 
 
+class _MimetypeNegotiator(object):
+    """
+    Matches ``Accept`` headers against the mimetypes available to :func:`render_with`.
+    Results for the most common headers are computed when the view is decorated,
+    and others are remembered in a bounded LRU cache keyed by the raw header.
+
+    :param mimetypes: Available mimetypes, excluding ``*/*``, which is the result
+        when nothing else matches
+    :param int maxsize: Number of distinct ``Accept`` headers to remember
+    """
+    #: Headers sent by browsers and API clients in the common case (or not sent at all)
+    common_headers = ('', '*/*', 'text/html', 'application/json')
+
+    def __init__(self, mimetypes, maxsize=128):
+        self.mimetypes = frozenset(m.lower() for m in mimetypes)
+        self.maxsize = maxsize
+        self.table = dict((header, self.match(header)) for header in self.common_headers)
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def match(self, header):
+        """Return the best available mimetype for the given ``Accept`` header"""
+        return _best_mimetype_match(self.mimetypes, parse_accept_header(header, MIMEAccept), '*/*')
+
+    def __call__(self, header):
+        mimetype = self.table.get(header)
+        if mimetype is not None:
+            return mimetype
+        with self._lock:
+            mimetype = self._data.pop(header, None)
+            if mimetype is not None:
+                self._data[header] = mimetype  # Move to the end, as most recently used
+                return mimetype
+        mimetype = self.match(header)
+        with self._lock:
+            self._data[header] = mimetype
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return mimetype
+
+
 def dict_jsonify(param):
     """Convert the parameter into a dictionary before calling jsonify, if it's not already one"""
     if not isinstance(param, dict):
@@ -424,6 +742,8 @@ def render_with(template=None, json=False, jsonp=False):
     else:  # pragma: no cover
         raise ValueError("Expected string or dict for template")
 
+    # Mimetypes are matched in lowercase, so normalize the keys once here
+    templates = dict((mimetype.lower(), handler) for mimetype, handler in templates.items())
     default_mimetype = '*/*'
     if '*/*' not in templates:
         templates['*/*'] = six.text_type
@@ -434,8 +754,13 @@ def render_with(template=None, json=False, jsonp=False):
                 default_mimetype = mimetype  # Remember which mimetype's handler is serving for */*
                 break
 
-    template_mimetypes = list(templates.keys())
-    template_mimetypes.remove('*/*')  # */* messes up matching, so supply it only as last resort
+    # */* messes up matching, so it is left out of negotiation and supplied only as a last resort
+    negotiate = _MimetypeNegotiator([mimetype for mimetype in templates if mimetype != '*/*'])
+    # mimetype: (handler, is_callable, response mimetype)
+    renderers = dict(
+        (mimetype, (handler, callable(handler), default_mimetype if mimetype == '*/*' else mimetype))
+        for mimetype, handler in templates.items())
+    vary_accept = len(templates) > 1
 
     def inner(f):
         @wraps(f)
@@ -466,7 +791,7 @@ def render_with(template=None, json=False, jsonp=False):
                 status_code = None
                 headers = Headers()
 
-            if len(templates) > 1:  # If we have more than one template handler
+            if vary_accept:  # If we have more than one template handler
                 if 'Vary' in headers:
                     vary_values = [item.strip() for item in headers['Vary'].split(',')]
                     if 'Accept' not in vary_values:
@@ -480,13 +805,13 @@ def render_with(template=None, json=False, jsonp=False):
             if render and request:
                 # We do not use request.accept_mimetypes.best_match because it turns out to
                 # be buggy: it returns the least match instead of the best match.
-                # use_mimetype = request.accept_mimetypes.best_match(template_mimetypes, '*/*')
-                use_mimetype = _best_mimetype_match(template_mimetypes, request.accept_mimetypes, '*/*')
+                use_mimetype = negotiate(request.headers.get('Accept', ''))
 
             # Now render the result with the template for the mimetype
             if use_mimetype is not None:
-                if callable(templates[use_mimetype]):
-                    rendered = templates[use_mimetype](result)
+                handler, is_callable, response_mimetype = renderers[use_mimetype]
+                if is_callable:
+                    rendered = handler(result)
                     if isinstance(rendered, Response):
                         if status_code is not None:
                             rendered.status_code = status_code
@@ -497,12 +822,12 @@ def render_with(template=None, json=False, jsonp=False):
                             rendered,
                             status=status_code,
                             headers=headers,
-                            mimetype=default_mimetype if use_mimetype == '*/*' else use_mimetype)
+                            mimetype=response_mimetype)
                 else:  # Not a callable mimetype. Render as a jinja2 template
                     rendered = current_app.response_class(
-                        render_template(templates[use_mimetype], **result),
+                        render_template(handler, **result),
                         status=status_code or 200, headers=headers,
-                        mimetype=default_mimetype if use_mimetype == '*/*' else use_mimetype)
+                        mimetype=response_mimetype)
                 return rendered
             else:
                 return result
@@ -607,14 +932,16 @@ def requires_permission(permission):
     :param permission: Permission that is required. If an iterable is provided,
         any one permission must be available
     """
+    permission_set = frozenset(permission) if is_collection(permission) else None
+
     def inner(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             add_auth_attribute('login_required', True)
             if not hasattr(current_auth, 'permissions'):
                 test = False
-            elif is_collection(permission):
-                test = bool(current_auth.permissions.intersection(permission))
+            elif permission_set is not None:
+                test = not permission_set.isdisjoint(current_auth.permissions)
             else:
                 test = permission in current_auth.permissions
             if not test:
@@ -3,11 +3,12 @@
 from __future__ import unicode_literals
 import unittest
 import warnings
-from sqlalchemy import inspect
-from sqlalchemy.orm.attributes import NO_VALUE
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.attributes import NO_VALUE, set_attribute
 import sqlalchemy.exc
 from flask import Flask
-from coaster.sqlalchemy import BaseMixin, UuidMixin, immutable, cached, ImmutableColumnError
+from coaster.sqlalchemy import BaseMixin, UuidMixin, immutable, cached, ImmutableColumnError, annotated_attributes
+from coaster.sqlalchemy.immutable_annotation import _immutable_set_listener
 from coaster.db import db
 
 app = Flask(__name__)
@@ -62,6 +63,17 @@ class UuidOnly(UuidMixin, BaseMixin, db.Model):
     referral_target = immutable(db.relationship(ReferralTarget))
 
 
+class ImmutableOwner(BaseMixin, db.Model):
+    __tablename__ = 'immutable_owner'
+
+
+class ImmutableThing(BaseMixin, db.Model):
+    __tablename__ = 'immutable_thing'
+    owner_id = db.Column(None, db.ForeignKey('immutable_owner.id'), nullable=True)
+    # Changes made via the backref are also blocked
+    owner = immutable(db.relationship(ImmutableOwner, backref='things'))
+
+
 class PolymorphicParent(BaseMixin, db.Model):
     __tablename__ = 'polymorphic_parent'
     type = immutable(db.Column(db.Unicode(30), index=True))
@@ -127,6 +139,48 @@ class TestCoasterAnnotations(unittest.TestCase):
                 self.assertIn(attr, model.__annotations__['immutable'])
         self.assertIn('uuid', IdUuid.__annotations__['immutable'])
 
+    def test_annotations_readonly(self):
+        self.assertIsInstance(IdOnly.__annotations__['immutable'], tuple)
+        with self.assertRaises(TypeError):
+            IdOnly.__annotations__['immutable'] = ()
+        with self.assertRaises(TypeError):
+            IdOnly.__annotations_by_attr__['is_regular'] = ('cached',)
+
+    def test_annotated_attributes(self):
+        immutables = annotated_attributes(immutable)
+        self.assertIs(immutables[IdOnly], IdOnly.__annotations__['immutable'])
+        self.assertIn('uuid', immutables[IdUuid])
+        self.assertIn('also_immutable', immutables[PolymorphicChild])
+        self.assertEqual(annotated_attributes('cached')[UuidOnly], ('is_cached',))
+        self.assertNotIn(ReferralTarget, annotated_attributes(cached))
+        self.assertEqual(dict(annotated_attributes('no_such_annotation')), {})
+
+    def test_immutable_listener(self):
+        """Immutable attributes share one set listener, registered once per attribute"""
+        for model in (IdOnly, IdUuid, UuidOnly):
+            for attr in ('id', 'is_immutable'):
+                self.assertTrue(event.contains(getattr(model, attr), 'set', _immutable_set_listener))
+                self.assertEqual(len(getattr(model, attr).dispatch.set), 1)
+        self.assertFalse(event.contains(IdOnly.is_regular, 'set', _immutable_set_listener))
+
+    def test_immutable_backref(self):
+        """Immutable relationships can't be changed via a backref"""
+        owner1 = ImmutableOwner()
+        owner2 = ImmutableOwner()
+        thing = ImmutableThing(owner=owner1)
+        self.session.add_all([owner1, owner2, thing])
+        self.session.commit()
+        with self.assertRaises(ImmutableColumnError):
+            owner2.things.append(thing)
+
+    def test_immutable_set_attribute(self):
+        """Immutable attributes can't be changed via the attribute API"""
+        i1 = IdOnly(is_immutable=1)
+        self.session.add(i1)
+        self.session.commit()
+        with self.assertRaises(ImmutableColumnError):
+            set_attribute(i1, 'is_immutable', 2)
+
     def test_init_immutability(self):
         i1 = IdOnly(is_regular=1, is_immutable=2, is_cached=3)
         i2 = IdUuid(is_regular='a', is_immutable='b', is_cached='c')
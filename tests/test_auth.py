@@ -4,7 +4,8 @@ from __future__ import absolute_import, unicode_literals
 import unittest
 from flask import Flask, has_request_context, _request_ctx_stack
 from flask_sqlalchemy import SQLAlchemy
-from coaster.auth import add_auth_attribute, add_auth_anchor, request_has_auth, current_auth, AuthAnchors
+from coaster.auth import (add_auth_attribute, add_auth_anchor, request_has_auth, request_cache, cached_permissions,
+    current_auth, AuthAnchors)
 from coaster.sqlalchemy import BaseMixin
 
 
@@ -240,3 +241,53 @@ class TestCurrentUserWithLoginManager(unittest.TestCase):
         self.assertFalse(request_has_auth())
         current_auth.is_anonymous  # Invoke current_auth
         self.assertTrue(request_has_auth())
+
+    def test_cached_permissions(self):
+        """Permissions are memoized per object, actor and inherited set for the request"""
+        calls = []
+
+        class Document(object):
+            def permissions(self, actor, inherited=None):
+                calls.append((actor, inherited))
+                perms = set(inherited) if inherited is not None else set()
+                perms.add('view')
+                return perms
+
+        doc1 = Document()
+        doc2 = Document()
+        user = User(username='foo')
+        self.assertEqual(cached_permissions(doc1, user), {'view'})
+        self.assertEqual(cached_permissions(doc1, user), {'view'})
+        self.assertEqual(len(calls), 1)
+        # Each object, actor and inherited set has its own entry
+        cached_permissions(doc2, user)
+        cached_permissions(doc1, None)
+        self.assertEqual(cached_permissions(doc1, user, {'edit'}), {'view', 'edit'})
+        self.assertEqual(cached_permissions(doc1, user, ['edit']), {'view', 'edit'})
+        self.assertEqual(len(calls), 4)
+        # The returned set is a copy
+        cached_permissions(doc1, user).add('delete')
+        self.assertEqual(cached_permissions(doc1, user), {'view'})
+        # A new request starts with an empty cache
+        with self.app.test_request_context():
+            cached_permissions(doc1, user)
+        self.assertEqual(len(calls), 5)
+        # The cache can be cleared within a request
+        request_cache('permissions').clear()
+        cached_permissions(doc1, user)
+        self.assertEqual(len(calls), 6)
+
+    def test_request_cache(self):
+        """Request caches are named dictionaries that last for the request"""
+        cache = request_cache('test')
+        self.assertEqual(cache, {})
+        cache['key'] = 'value'
+        self.assertIs(request_cache('test'), cache)
+        self.assertEqual(request_cache('other'), {})
+        with self.app.test_request_context():
+            self.assertEqual(request_cache('test'), {})
+        self.ctx.pop()
+        try:
+            self.assertIsNone(request_cache('test'))
+        finally:
+            self.ctx.push()
@@ -55,6 +55,85 @@ class TestCoordinatesColumn(unittest.TestCase):
 
         warnings.resetwarnings()
 
+    def make_locations(self):
+        warnings.simplefilter('ignore', category=sqlalchemy.exc.SAWarning)
+        self.locations = {
+            'bangalore': CoordinatesData(coordinates=(12.9716, 77.5946)),
+            'mysore': CoordinatesData(coordinates=(12.2958, 76.6394)),
+            'chennai': CoordinatesData(coordinates=(13.0827, 80.2707)),
+            'delhi': CoordinatesData(coordinates=(28.7041, 77.1025)),
+            'suva': CoordinatesData(coordinates=(-18.1248, 178.4501)),
+            'apia': CoordinatesData(coordinates=(-13.8506, -171.7513)),
+            'nowhere': CoordinatesData(),
+            }
+        db.session.add_all(self.locations.values())
+        db.session.commit()
+        return self.locations
+
+    def test_geohash_bulk_and_backfill(self):
+        """Rows inserted in bulk get a geohash, and rows without one can be backfilled"""
+        CoordinatesData.bulk_insert([{'latitude': 12.9716, 'longitude': 77.5946}, {}])
+        self.assertEqual(sorted(d.geohash or u'' for d in CoordinatesData.query.all()), [u'', u'tdr1v9qtj1x2'])
+        # Simulate rows saved before the geohash column existed
+        db.session.execute(CoordinatesData.__table__.insert().values(latitude=12.2958, longitude=76.6394))
+        self.assertEqual(CoordinatesData.query.filter(CoordinatesData.within_radius(12.2958, 76.6394, 1000)).count(), 0)
+        self.assertEqual(CoordinatesData.backfill_geohash(chunksize=1), 1)
+        self.assertEqual(CoordinatesData.query.filter(CoordinatesData.within_radius(12.2958, 76.6394, 1000)).count(), 1)
+        self.assertEqual(CoordinatesData.backfill_geohash(), 0)
+
+    def names(self, instances):
+        lookup = {location.id: name for name, location in self.locations.items()}
+        return [lookup[instance.id] for instance in instances]
+
+    def test_geohash(self):
+        locations = self.make_locations()
+        self.assertEqual(locations['bangalore'].geohash, u'tdr1v9qtj1x2')
+        self.assertIsNone(locations['nowhere'].geohash)
+        locations['nowhere'].coordinates = (12.9716, 77.5946)
+        locations['bangalore'].coordinates = (None, None)
+        db.session.commit()
+        self.assertEqual(locations['nowhere'].geohash, u'tdr1v9qtj1x2')
+        self.assertIsNone(locations['bangalore'].geohash)
+
+    def test_within_box(self):
+        self.make_locations()
+        self.assertEqual(set(self.names(CoordinatesData.query.filter(
+            CoordinatesData.within_box(12, 76, 14, 81)))), set(['bangalore', 'mysore', 'chennai']))
+        self.assertEqual(set(self.names(CoordinatesData.query.filter(
+            CoordinatesData.within_box(12.9, 77.5, 13.0, 77.7)))), set(['bangalore']))
+        self.assertEqual(set(self.names(CoordinatesData.query.filter(
+            CoordinatesData.within_box(-90, -180, 90, 180)))), set(self.locations) - set(['nowhere']))
+        # Across the antimeridian
+        self.assertEqual(set(self.names(CoordinatesData.query.filter(
+            CoordinatesData.within_box(-20, 170, -10, -170)))), set(['suva', 'apia']))
+
+    def test_near(self):
+        self.make_locations()
+        results = CoordinatesData.near(12.9716, 77.5946, 300000)
+        self.assertEqual(self.names(instance for instance, distance in results), ['bangalore', 'mysore', 'chennai'])
+        self.assertAlmostEqual(results[0][1], 0, places=3)
+        self.assertAlmostEqual(results[2][1], 290172, places=0)
+        self.assertEqual(len(CoordinatesData.near(12.9716, 77.5946, 300000, limit=2)), 2)
+        self.assertEqual(self.names(instance for instance, distance in CoordinatesData.near(
+            -16, 179, 1500000)), ['suva', 'apia'])
+        self.assertEqual(self.names(instance for instance, distance in CoordinatesData.near(
+            12.9716, 77.5946, 300000, query=CoordinatesData.query.filter(
+                CoordinatesData.id != self.locations['mysore'].id))), ['bangalore', 'chennai'])
+
+    def test_nearest(self):
+        self.make_locations()
+        self.assertEqual(self.names(instance for instance, distance in CoordinatesData.nearest(
+            28, 77, limit=2)), ['delhi', 'bangalore'])
+        self.assertEqual(len(CoordinatesData.nearest(28, 77, limit=100)), 6)
+
+    def test_distances(self):
+        locations = self.make_locations()
+        distances = CoordinatesData.distances(
+            [locations['bangalore'], locations['chennai'], locations['nowhere']], 12.9716, 77.5946)
+        self.assertAlmostEqual(distances[0], 0, places=3)
+        self.assertAlmostEqual(distances[1], 290172, places=0)
+        self.assertIsNone(distances[2])
+
 
 class TestCoordinatesColumn2(TestCoordinatesColumn):
     app = app2
@@ -1,5 +1,5 @@
 import unittest
-from coaster.gfm import gfm, markdown
+from coaster.gfm import gfm, markdown, markdown_cache, MarkdownCache
 
 
 class TestMarkdown(unittest.TestCase):
@@ -186,3 +186,66 @@ class TestMarkdown(unittest.TestCase):
     def test_empty_markdown(self):
         """Don't choke on None"""
         self.assertEqual(markdown(None), None)
+
+
+class DictStore(object):
+    """Minimal shared store for testing MarkdownCache"""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+
+class TestMarkdownCache(unittest.TestCase):
+    def test_cache_stats(self):
+        cache = MarkdownCache(maxsize=2)
+        self.assertEqual(markdown('hello', cache=cache), '<p>hello</p>')
+        self.assertEqual(markdown('hello', cache=cache), '<p>hello</p>')
+        self.assertEqual(cache.stats(), {'hits': 1, 'store_hits': 0, 'misses': 1, 'size': 1, 'maxsize': 2})
+        cache.clear()
+        self.assertEqual(cache.stats(), {'hits': 0, 'store_hits': 0, 'misses': 0, 'size': 0, 'maxsize': 2})
+
+    def test_cache_config(self):
+        cache = MarkdownCache()
+        text = 'hello <del>there</del>'
+        self.assertNotEqual(cache.key(text), cache.key(text, html=True))
+        self.assertNotEqual(cache.key(text, html=True), cache.key(text, html=True, valid_tags={'p': []}))
+        # valid_tags is not used when HTML is escaped
+        self.assertEqual(cache.key(text), cache.key(text, valid_tags={'p': []}))
+        self.assertEqual(markdown(text, cache=cache), '<p>hello &lt;del&gt;there&lt;/del&gt;</p>')
+        self.assertEqual(markdown(text, html=True, cache=cache), '<p>hello <del>there</del></p>')
+        self.assertEqual(cache.misses, 2)
+
+    def test_cache_lru(self):
+        cache = MarkdownCache(maxsize=2)
+        markdown('one', cache=cache)
+        markdown('two', cache=cache)
+        markdown('one', cache=cache)
+        markdown('three', cache=cache)  # Evicts 'two', the least recently used
+        self.assertIn(cache.key('one'), cache._data)
+        self.assertNotIn(cache.key('two'), cache._data)
+        self.assertEqual(len(cache._data), 2)
+
+    def test_cache_store(self):
+        store = DictStore()
+        cache1 = MarkdownCache(store=store)
+        cache2 = MarkdownCache(store=store)
+        result = markdown('shared', cache=cache1)
+        self.assertEqual(markdown('shared', cache=cache2), result)
+        self.assertEqual(cache2.store_hits, 1)
+        self.assertEqual(cache2.misses, 0)
+        # Values are found locally on the next call
+        markdown('shared', cache=cache2)
+        self.assertEqual(cache2.hits, 1)
+
+    def test_default_cache(self):
+        markdown_cache.clear()
+        markdown('default', cache=False)
+        self.assertEqual(markdown_cache.stats()['misses'], 0)
+        markdown('default')
+        markdown('default')
+        self.assertEqual(markdown_cache.stats()['hits'], 1)
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from decimal import Decimal
+import pickle
+import unittest
+
+from sqlalchemy import Column, Integer, event, inspect
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import CompileError, IntegrityError
+from sqlalchemy.schema import CreateIndex
+import six
+
+from coaster.db import db
+from coaster.sqlalchemy import JsonCodec, JsonDict, default_json_codec, json_codecs, json_index
+from coaster.sqlalchemy.columns import LazyMutableDict, MutableDict, _json_columns
+
+from .test_models import Container, app1, app2
+
+
+class JsonData(db.Model):
+    __tablename__ = 'json_data'
+    id = Column(Integer, primary_key=True)
+    data = Column(JsonDict)
+    lazydata = Column(JsonDict(lazy=True))
+
+    __table_args__ = (
+        json_index('ix_json_data_data', data),
+        json_index('ix_json_data_data_name', data, ('user', 'name')),
+        )
+
+
+calls = []
+
+
+def counting_loads(value):
+    calls.append(value)
+    return default_json_codec.loads(value)
+
+
+counting_codec = JsonCodec('counting', default_json_codec.dumps, counting_loads)
+
+
+class CountingJsonData(db.Model):
+    __tablename__ = 'counting_json_data'
+    id = Column(Integer, primary_key=True)
+    data = Column(JsonDict(codec=counting_codec, lazy=True))
+
+
+# -- Tests --------------------------------------------------------------------
+
+
+class JsonDictTestCase(unittest.TestCase):
+    app = app1
+
+    def setUp(self):
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+        self.session = db.session
+        del calls[:]
+
+    def tearDown(self):
+        self.session.rollback()
+        db.drop_all()
+        self.ctx.pop()
+
+
+class TestJsonDict(JsonDictTestCase):
+    def test_codecs(self):
+        self.assertIn('simplejson', json_codecs)
+        self.assertIn(default_json_codec, list(json_codecs.values()))
+        self.assertIs(JsonDict().codec, default_json_codec)
+        self.assertIs(default_json_codec, json_codecs['simplejson'])
+        self.assertIs(JsonDict(codec='simplejson').codec, json_codecs['simplejson'])
+        self.assertEqual(default_json_codec.loads(default_json_codec.dumps({'a': Decimal('1.5')})),
+            {'a': Decimal('1.5')})
+
+    def test_roundtrip(self):
+        self.session.add(JsonData(id=1, data={'a': 1, 'b': [1.5, 'x']}, lazydata={'c': {'d': None}}))
+        self.session.commit()
+        self.session.expunge_all()
+        item = JsonData.query.get(1)
+        self.assertIsInstance(item.data, MutableDict)
+        self.assertEqual(item.data, {'a': 1, 'b': [Decimal('1.5'), 'x']})
+        self.assertEqual(item.lazydata, {'c': {'d': None}})
+
+    def test_dict_methods(self):
+        """All dictionary methods that change the value are saved"""
+        self.session.add(JsonData(id=1, data={'a': 1, 'b': 2, 'c': 3}))
+        self.session.commit()
+        item = JsonData.query.get(1)
+        item.data.update(d=4)
+        self.session.commit()
+        self.assertEqual(item.data.pop('a'), 1)
+        self.session.commit()
+        self.assertEqual(item.data.setdefault('e', 5), 5)
+        self.session.commit()
+        self.session.expunge_all()
+        item = JsonData.query.get(1)
+        self.assertEqual(item.data, {'b': 2, 'c': 3, 'd': 4, 'e': 5})
+        item.data.clear()
+        self.session.commit()
+        self.session.expunge_all()
+        self.assertEqual(JsonData.query.get(1).data, {})
+
+    def test_nested_changes(self):
+        self.session.add(JsonData(id=1, data={'a': {'b': {'c': 1}}, 'l': [1, {'x': 1}]}))
+        self.session.commit()
+        item = JsonData.query.get(1)
+        item.data['a']['b']['c'] = 2
+        item.data['a']['d'] = [1]
+        item.data['a']['d'].append(2)
+        item.data['l'][1]['x'] = 2
+        self.session.commit()
+        self.session.expunge_all()
+        item = JsonData.query.get(1)
+        self.assertEqual(item.data, {'a': {'b': {'c': 2}, 'd': [1, 2]}, 'l': [1, {'x': 2}]})
+        # Items that move in a list are tracked in their new position
+        child = item.data['l'][1]
+        item.data['l'].insert(0, 0)
+        child['y'] = 3
+        self.session.commit()
+        self.session.expunge_all()
+        item = JsonData.query.get(1)
+        self.assertEqual(item.data['l'], [0, 1, {'x': 2, 'y': 3}])
+
+    def test_nested_detach(self):
+        """Changes to containers removed from the document are not tracked"""
+        self.session.add(JsonData(id=1, data={'a': {'b': 1}, 'c': {}}))
+        self.session.commit()
+        item = JsonData.query.get(1)
+        removed = item.data['a']
+        del item.data['a']
+        self.session.commit()
+        removed['b'] = 2
+        self.assertNotIn(item, self.session.dirty)
+        # Placing a tracked container elsewhere makes a copy
+        item.data['c']['d'] = {'e': 1}
+        item.data['f'] = item.data['c']['d']
+        item.data['f']['e'] = 2
+        self.session.commit()
+        self.session.expunge_all()
+        self.assertEqual(JsonData.query.get(1).data, {'c': {'d': {'e': 1}}, 'f': {'e': 2}})
+
+    def test_queries(self):
+        self.session.add_all([
+            JsonData(id=1, data={'user': {'name': u'alice', 'age': 30, 'admin': True}, 'tags': [u'a', u'b']}),
+            JsonData(id=2, data={'user': {'name': u'bob', 'age': 25, 'admin': False}, 'tags': [u'b']}),
+            JsonData(id=3, data={'user': None, 'it\'s': 1}),
+            ])
+        self.session.commit()
+
+        def ids(condition):
+            return sorted(item.id for item in JsonData.query.filter(condition))
+
+        self.assertEqual(ids(JsonData.data.has_key('user')), [1, 2, 3])
+        self.assertEqual(ids(JsonData.data.has_key('tags')), [1, 2])
+        self.assertEqual(ids(JsonData.data.has_key('it\'s')), [3])
+        self.assertEqual(ids(JsonData.data.has_path(('user', 'name'))), [1, 2])
+        self.assertEqual(ids(JsonData.data.has_path(('tags', 1))), [1])
+        self.assertEqual(ids(JsonData.data.path_equals(('user', 'name'), u'bob')), [2])
+        self.assertEqual(ids(JsonData.data.path_equals(('user', 'age'), 30)), [1])
+        self.assertEqual(ids(JsonData.data.path_equals(('user', 'admin'), True)), [1])
+        self.assertEqual(ids(JsonData.data.path_equals('user', None)), [3])
+        self.assertEqual(ids(JsonData.data.path_equals('tags', [u'b'])), [2])
+        self.assertEqual(ids(JsonData.data.path_equals(('tags', 0), u'a')), [1])
+        self.assertEqual(ids(JsonData.data.contains({'user': {'admin': False, 'age': 25}})), [2])
+        self.assertEqual(ids(JsonData.data.contains({'user': {'name': u'carol'}})), [])
+        self.assertEqual(ids(JsonData.data.path_text(('user', 'name')) == u'alice'), [1])
+        self.assertEqual(
+            [item.id for item in JsonData.query.filter(JsonData.data.has_path(('user', 'name'))).order_by(
+                JsonData.data.path_text(('user', 'name')).desc())],
+            [2, 1])
+
+    def test_query_quoted_keys(self):
+        self.session.add(JsonData(id=1, data={u'say "hi"': {u'back\\slash': u'x'}, u'a.b': 2}))
+        self.session.add(JsonData(id=2, data={u'say hi': 1}))
+        self.session.commit()
+
+        def ids(condition):
+            return sorted(item.id for item in JsonData.query.filter(condition))
+
+        self.assertEqual(ids(JsonData.data.has_key(u'say "hi"')), [1])
+        self.assertEqual(ids(JsonData.data.has_key(u'a.b')), [1])
+        self.assertEqual(ids(JsonData.data.path_equals((u'say "hi"', u'back\\slash'), u'x')), [1])
+        self.assertEqual(ids(JsonData.data.path_text((u'say "hi"', u'back\\slash')) == u'x'), [1])
+
+    def test_pickle(self):
+        self.session.add(JsonData(id=1, data={'a': 1}))
+        self.session.commit()
+        data = pickle.loads(pickle.dumps(JsonData.query.get(1).data))
+        self.assertEqual(type(data), MutableDict)
+        self.assertEqual(data, {'a': 1})
+
+
+class TestJsonDictDialects(unittest.TestCase):
+    """JSON expressions and indexes that some databases can't support"""
+
+    def test_sqlite_unquotable_key(self):
+        with self.assertRaises(CompileError):
+            JsonData.data.has_key(u'"a.b"').compile(dialect=sqlite.dialect())
+
+    def test_postgresql_json(self):
+        dialect = postgresql.dialect()
+        dialect.server_version_info = (9, 3)
+        self.assertIn('#>', six.text_type(JsonData.data.has_key('a').compile(dialect=dialect)))
+        with self.assertRaises(CompileError):
+            JsonData.data.contains({'a': 1}).compile(dialect=dialect)
+        with self.assertRaises(CompileError):
+            JsonData.data.path_equals('a', 1).compile(dialect=dialect)
+        index = [index for index in JsonData.__table__.indexes if index.name == 'ix_json_data_data'][0]
+        with self.assertRaises(CompileError):
+            CreateIndex(index).compile(dialect=dialect)
+        dialect.server_version_info = (9, 6)
+        self.assertIn('?', six.text_type(JsonData.data.has_key('a').compile(dialect=dialect)))
+        self.assertIn('gin', six.text_type(CreateIndex(index).compile(dialect=dialect)))
+
+    def test_index_other_databases(self):
+        indexes = dict((index.name, index) for index in JsonData.__table__.indexes)
+        with self.assertRaises(CompileError):
+            CreateIndex(indexes['ix_json_data_data']).compile(dialect=mysql.dialect())
+        CreateIndex(indexes['ix_json_data_data']).compile(dialect=sqlite.dialect())
+        CreateIndex(indexes['ix_json_data_data_name']).compile(dialect=mysql.dialect())
+
+
+class TestJsonDict2(TestJsonDict):
+    app = app2
+
+    def updates(self):
+        """Record UPDATE statements"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE'):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    def test_partial_update(self):
+        self.session.add(JsonData(id=1, data={'a': 1, 'b': {'c': 2}, 'd': 3}))
+        self.session.commit()
+        statements = self.updates()
+        item = JsonData.query.get(1)
+        item.data['a'] = {'x': [1, 2]}
+        item.data['e'] = u'new'
+        del item.data['d']
+        self.session.flush()
+        self.assertEqual(len(statements), 1)
+        self.assertIn('jsonb_set', statements[0])
+        self.assertIn('#-', statements[0])
+        # The value was restored after the update and is still tracked
+        self.assertIn('data', item.__dict__)
+        item.data.pop('e')
+        self.session.commit()
+        self.assertIn('#-', statements[1])
+        self.session.expunge_all()
+        self.assertEqual(JsonData.query.get(1).data, {'a': {'x': [1, 2]}, 'b': {'c': 2}})
+
+    def test_partial_update_mappers(self):
+        """Flushes only look at models with JsonDict columns that allow partial updates"""
+        self.assertEqual(_json_columns[inspect(JsonData)], [
+            ('data', JsonData.__table__.c.data), ('lazydata', JsonData.__table__.c.lazydata)])
+        self.assertNotIn(inspect(Container), _json_columns)
+
+    def test_partial_update_failed(self):
+        """A failed flush leaves the value and its pending changes in place"""
+        self.session.add_all([JsonData(id=1, data={'a': 1}), JsonData(id=2)])
+        self.session.commit()
+        self.session.expunge_all()
+        item = JsonData.query.get(1)
+        value = item.data
+        value['a'] = 2
+        self.session.add(JsonData(id=2))  # Conflicts with the row in the database
+        with self.assertRaises(IntegrityError):
+            self.session.flush()
+        self.assertIs(inspect(item).dict.get('data', value), value)
+        self.assertEqual(value, {'a': 2})
+        self.assertEqual(list(value._changes), [('a',)])
+        self.assertNotIn('coaster_json_updates', self.session.info)
+        self.session.rollback()
+
+    def test_partial_nested_update(self):
+        self.session.add(JsonData(id=1, data={'a': {'b': 1, 'c': [1, 2]}, 'd': 1}))
+        self.session.commit()
+        statements = self.updates()
+        item = JsonData.query.get(1)
+        item.data['a']['b'] = 2
+        item.data['a']['c'].append(3)
+        del item.data['a']['c'][0]
+        self.session.commit()
+        self.assertIn('jsonb_set', statements[0])
+        self.session.expunge_all()
+        self.assertEqual(JsonData.query.get(1).data, {'a': {'b': 2, 'c': [2, 3]}, 'd': 1})
+
+    def test_full_update(self):
+        self.session.add(JsonData(id=1, data={'a': 1}))
+        self.session.commit()
+        statements = self.updates()
+        item = JsonData.query.get(1)
+        # Replacing the value writes it in full
+        item.data = {'b': 2}
+        item.data['c'] = 3
+        self.session.commit()
+        self.assertNotIn('jsonb_set', statements[-1])
+        # As do changes to more keys than the limit
+        item.data.update(dict(('key%d' % i, i) for i in range(9)))
+        self.session.commit()
+        self.assertNotIn('jsonb_set', statements[-1])
+        self.session.expunge_all()
+        self.assertEqual(len(JsonData.query.get(1).data), 11)
+
+
+class TestLazyJsonDict(JsonDictTestCase):
+    """Lazy decoding applies where the database returns JSON as text"""
+
+    def test_lazy_decode(self):
+        self.session.add(CountingJsonData(id=1, data={'a': 1, 'b': 2}))
+        self.session.commit()
+        self.session.expunge_all()
+        item = CountingJsonData.query.get(1)
+        self.assertIsInstance(item.data, LazyMutableDict)
+        self.assertEqual(calls, [])
+        self.assertEqual(item.data['a'], 1)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(item.data.keys()), ['a', 'b'])
+        self.assertEqual(len(calls), 1)
+
+    def test_assign_json_string(self):
+        """JSON strings assigned to a column are decoded with the column's codec"""
+        item = CountingJsonData(id=1, data='{"a": 1}')
+        self.assertIsInstance(item.data, MutableDict)
+        self.assertEqual(item.data, {'a': 1})
+        self.assertEqual(calls, ['{"a": 1}'])
+        item.data = ''
+        self.assertEqual(item.data, {})
+
+    def test_lazy_changes(self):
+        self.session.add(CountingJsonData(id=1, data={'a': 1}))
+        self.session.commit()
+        self.session.expunge_all()
+        item = CountingJsonData.query.get(1)
+        item.data['b'] = 2
+        self.session.commit()
+        self.session.expunge_all()
+        self.assertEqual(CountingJsonData.query.get(1).data, {'a': 1, 'b': 2})
+
+    def test_lazy_passthrough(self):
+        self.session.add(CountingJsonData(id=1, data={'a': 1}))
+        self.session.commit()
+        self.session.expunge_all()
+        source = CountingJsonData.query.get(1)
+        # An undecoded value is copied as is
+        self.session.add(CountingJsonData(id=2, data=source.data))
+        self.session.commit()
+        self.assertEqual(calls, [])
+        self.session.expunge_all()
+        self.assertEqual(CountingJsonData.query.get(2).data, {'a': 1})
+
+    def test_lazy_pickle(self):
+        self.session.add(CountingJsonData(id=1, data={'a': 1}))
+        self.session.commit()
+        self.session.expunge_all()
+        data = pickle.loads(pickle.dumps(CountingJsonData.query.get(1).data))
+        self.assertEqual(type(data), MutableDict)
+        self.assertEqual(data, {'a': 1})
+
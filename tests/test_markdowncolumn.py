@@ -2,11 +2,14 @@
 
 from __future__ import absolute_import
 
+from datetime import datetime
 import unittest
 
+from sqlalchemy import Column, Integer, Unicode, event
+
 from coaster.db import db
 from coaster.gfm import markdown
-from coaster.sqlalchemy import BaseMixin, MarkdownColumn
+from coaster.sqlalchemy import BaseMixin, MarkdownColumn, rerender_markdown
 
 from .test_models import app1, app2
 
@@ -16,6 +19,13 @@ class MarkdownData(BaseMixin, db.Model):
     value = MarkdownColumn('value', nullable=False)
 
 
+class MarkdownCompositeKeyData(db.Model):
+    __tablename__ = 'md_composite_key_data'
+    section = Column(Unicode(10), primary_key=True)
+    number = Column(Integer, primary_key=True)
+    value = MarkdownColumn('value', nullable=False)
+
+
 # -- Tests --------------------------------------------------------------------
 
 
@@ -81,6 +91,81 @@ class TestMarkdownColumn(unittest.TestCase):
         data.value = text
         self.session.commit()
 
+    def test_render_deferred(self):
+        data = MarkdownData(value=u"First")
+        # HTML is not rendered until required
+        self.assertTrue(data.value._html_stale)
+        data.value.text = u"Second"
+        data.value.text = u"*Third*"
+        self.assertIsNone(data.value._html)
+        self.session.add(data)
+        self.session.commit()
+        # Only the final text was rendered, on flush
+        self.assertFalse(data.value._html_stale)
+        self.assertEqual(data.value._html, markdown(u"*Third*"))
+        # Rendering on access does not require a flush
+        data.value.text = u"Fourth"
+        self.assertEqual(data.value.html, markdown(u"Fourth"))
+        self.assertFalse(data.value._html_stale)
+        self.session.commit()
+        del data
+        data = MarkdownData.query.first()
+        self.assertEqual(data.value.html, markdown(u"Fourth"))
+
+    def test_rerender_markdown(self):
+        texts = [u"Item %d" % i for i in range(7)]
+        for text in texts:
+            data = MarkdownData(value=text)
+            data.value._html = u"Stale"
+            self.session.add(data)
+        self.session.commit()
+        self.assertEqual(rerender_markdown(MarkdownData, 'value', chunksize=3, processes=1), 7)
+        self.session.expire_all()
+        self.assertEqual(
+            [data.value.html for data in MarkdownData.query.order_by(MarkdownData.id)],
+            [markdown(text) for text in texts])
+
+
+    def test_rerender_markdown_composite_key(self):
+        keys = [(section, number) for section in (u'a', u'b') for number in range(3)]
+        for section, number in keys:
+            data = MarkdownCompositeKeyData(section=section, number=number, value=u"%s %d" % (section, number))
+            data.value._html = u"Stale"
+            self.session.add(data)
+        self.session.commit()
+        self.assertEqual(rerender_markdown(MarkdownCompositeKeyData, 'value', chunksize=4, processes=1), 6)
+        self.session.expire_all()
+        self.assertEqual(
+            [data.value.html for data in MarkdownCompositeKeyData.query.order_by(
+                MarkdownCompositeKeyData.section, MarkdownCompositeKeyData.number)],
+            [markdown(u"%s %d" % key) for key in keys])
+
+    def test_flush_unchanged(self):
+        """Flushing a row does not rewrite its Markdown columns unless they changed"""
+        data = MarkdownData(value=u"*Text*")
+        self.session.add(data)
+        self.session.commit()
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE'):
+                statements.append(statement)
+        engine = self.session.get_bind()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(data.value.html, markdown(u"*Text*"))
+        data.updated_at = datetime(2018, 1, 1)
+        self.session.commit()
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('value_html', statements[0])
+        # HTML rendered on access is saved with the text
+        data.value.text = u"_Other_"
+        self.assertEqual(data.value.html, markdown(u"_Other_"))
+        self.session.commit()
+        self.assertIn('value_html', statements[1])
+        self.session.expire_all()
+        self.assertEqual(data.value.html, markdown(u"_Other_"))
+
 
 class TestMarkdownColumn2(TestMarkdownColumn):
     app = app2
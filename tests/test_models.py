@@ -4,20 +4,30 @@ from __future__ import absolute_import, unicode_literals
 
 import unittest
 
+import base64
+import json
+import os
+import shutil
+import tempfile
 import uuid
 from time import sleep
 from datetime import datetime, timedelta
 import six
 from flask import Flask
-from sqlalchemy import Column, Integer, Unicode, UniqueConstraint, ForeignKey, func
-from sqlalchemy.orm import relationship, synonym
+from sqlalchemy import (Column, Integer, Unicode, UniqueConstraint, ForeignKey, ForeignKeyConstraint, func,
+    event, create_engine)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import relationship, sessionmaker, synonym
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import MultipleResultsFound
+from sqlalchemy.sql.expression import ClauseElement
+from werkzeug.exceptions import NotFound
 from werkzeug.routing import BuildError
 from coaster.sqlalchemy import (BaseMixin, BaseNameMixin, BaseScopedNameMixin,
     BaseIdNameMixin, BaseScopedIdMixin, BaseScopedIdNameMixin, JsonDict, failsafe_add,
-    UuidMixin, UUIDType, add_primary_relationship, auto_init_default)
-from coaster.utils import uuid2buid, uuid2suuid
+    UuidMixin, UUIDType, add_primary_relationship, auto_init_default, CountCache, Query)
+from coaster.utils import (uuid2buid, uuid2suuid, buid2uuid, suuid2uuid, uuid7_from_datetime,
+    uuid7_to_datetime)
 from coaster.db import db
 from .test_auth import LoginManager
 
@@ -82,6 +92,47 @@ class ScopedNamedDocument(BaseScopedNameMixin, db.Model):
     __table_args__ = (UniqueConstraint('container_id', 'name'),)
 
 
+class ScopedNamedDocumentChild(BaseScopedIdMixin, db.Model):
+    __tablename__ = 'scoped_named_document_child'
+    document_id = Column(Integer, ForeignKey('scoped_named_document.id'), nullable=False)
+    document = relationship(ScopedNamedDocument)
+    parent = synonym('document')
+    __table_args__ = (UniqueConstraint('document_id', 'url_id'),)
+
+
+class DeferredNamedDocument(BaseNameMixin, db.Model):
+    __tablename__ = 'deferred_named_document'
+    __name_deferred__ = True
+    reserved_names = ['new']
+
+
+class DeferredScopedNamedDocument(BaseScopedNameMixin, db.Model):
+    __tablename__ = 'deferred_scoped_named_document'
+    __name_deferred__ = True
+    container_id = Column(Integer, ForeignKey('container.id'))
+    container = relationship(Container)
+    parent = synonym('container')
+    __table_args__ = (UniqueConstraint('container_id', 'name'),)
+
+
+class CompositeContainer(db.Model):
+    __tablename__ = 'composite_container'
+    section = Column(Unicode(10), primary_key=True)
+    number = Column(Integer, primary_key=True)
+
+
+class CompositeScopedDocument(BaseScopedNameMixin, db.Model):
+    __tablename__ = 'composite_scoped_document'
+    container_section = Column(Unicode(10))
+    container_number = Column(Integer)
+    container = relationship(CompositeContainer)
+    parent = synonym('container')
+    __table_args__ = (
+        ForeignKeyConstraint([container_section, container_number],
+            [CompositeContainer.section, CompositeContainer.number]),
+        UniqueConstraint('container_section', 'container_number', 'name'))
+
+
 class IdNamedDocument(BaseIdNameMixin, db.Model):
     __tablename__ = 'id_named_document'
     container_id = Column(Integer, ForeignKey('container.id'))
@@ -100,6 +151,22 @@ class ScopedIdDocument(BaseScopedIdMixin, db.Model):
     __table_args__ = (UniqueConstraint('container_id', 'url_id'),)
 
 
+class DeferredScopedIdDocument(BaseScopedIdMixin, db.Model):
+    __tablename__ = 'deferred_scoped_id_document'
+    __url_id_deferred__ = True
+    type = Column(Unicode(30))
+    container_id = Column(Integer, ForeignKey('container.id'))
+    container = relationship(Container)
+    parent = synonym('container')
+    __table_args__ = (UniqueConstraint('container_id', 'url_id'),)
+    __mapper_args__ = {'polymorphic_on': type, 'polymorphic_identity': 'document'}
+
+
+class DeferredScopedIdSubDocument(DeferredScopedIdDocument):
+    """Shares url_ids with the parent model through single table inheritance"""
+    __mapper_args__ = {'polymorphic_identity': 'subdocument'}
+
+
 class ScopedIdNamedDocument(BaseScopedIdNameMixin, db.Model):
     __tablename__ = 'scoped_id_named_document'
     container_id = Column(Integer, ForeignKey('container.id'))
@@ -115,6 +182,12 @@ class User(BaseMixin, db.Model):
     username = Column(Unicode(80), nullable=False)
 
 
+class RankedDocument(BaseMixin, db.Model):
+    __tablename__ = 'ranked_document'
+    # The attribute and the column have different names
+    rank = Column('sort_rank', Integer, nullable=False)
+
+
 class MyData(db.Model):
     __tablename__ = 'my_data'
     id = Column(Integer, primary_key=True)
@@ -176,6 +249,24 @@ class UuidMixinKey(UuidMixin, BaseMixin, db.Model):
     __uuid_primary_key__ = True
 
 
+class CachedUuidMixinKey(UuidMixin, BaseMixin, db.Model):
+    __tablename__ = 'cached_uuid_mixin_key'
+    __uuid_primary_key__ = True
+    __uuid_cache__ = True
+
+
+class TimeOrderedUuidKey(UuidMixin, BaseMixin, db.Model):
+    __tablename__ = 'time_ordered_uuid_key'
+    __uuid_primary_key__ = True
+    __uuid_time_ordered__ = True
+
+
+class TimeOrderedUuidMixinKey(UuidMixin, BaseMixin, db.Model):
+    __tablename__ = 'time_ordered_uuid_mixin_key'
+    __uuid_primary_key__ = False
+    __uuid_time_ordered__ = True
+
+
 class ParentForPrimary(BaseMixin, db.Model):
     __tablename__ = 'parent_for_primary'
 
@@ -878,6 +969,528 @@ class TestCoasterModels(unittest.TestCase):
         self.assertFalse(UuidMixinKey.suuid == 'garbage!')
         self.assertTrue(UuidMixinKey.suuid != 'garbage!')
 
+    def test_keyset_paginate(self):
+        """
+        Query.keyset_paginate returns pages with cursors
+        """
+        c = Container()
+        # Pairs of documents share a timestamp, so the id must break ties
+        docs = [UnnamedDocument(container=c, content='%02d' % i,
+            created_at=datetime(2018, 1, 1) + timedelta(minutes=i // 2)) for i in range(25)]
+        self.session.add_all(docs)
+        self.session.commit()
+        docs.sort(key=lambda d: (d.created_at, d.id))
+
+        # TimestampMixin models are ordered by (created_at, id) by default
+        page1 = UnnamedDocument.query.keyset_paginate(per_page=10)
+        self.assertEqual(page1.items, docs[:10])
+        self.assertTrue(page1.has_next)
+        self.assertFalse(page1.has_prev)
+        page2 = UnnamedDocument.query.keyset_paginate(page1.next_cursor, per_page=10)
+        self.assertEqual(page2.items, docs[10:20])
+        self.assertTrue(page2.has_next)
+        self.assertTrue(page2.has_prev)
+        page3 = UnnamedDocument.query.keyset_paginate(page2.next_cursor, per_page=10)
+        self.assertEqual(page3.items, docs[20:])
+        self.assertFalse(page3.has_next)
+        self.assertTrue(page3.has_prev)
+
+        # Going back gets the same pages
+        back2 = UnnamedDocument.query.keyset_paginate(page3.prev_cursor, per_page=10)
+        self.assertEqual(back2.items, page2.items)
+        self.assertEqual(back2.next_cursor, page2.next_cursor)
+        back1 = UnnamedDocument.query.keyset_paginate(back2.prev_cursor, per_page=10)
+        self.assertEqual(back1.items, page1.items)
+        self.assertFalse(back1.has_prev)
+
+        # Reverse order and filtered queries
+        rpage1 = UnnamedDocument.query.keyset_paginate(per_page=10, reverse=True)
+        self.assertEqual(rpage1.items, docs[::-1][:10])
+        rpage2 = UnnamedDocument.query.keyset_paginate(rpage1.next_cursor, per_page=10, reverse=True)
+        self.assertEqual(rpage2.items, docs[::-1][10:20])
+        fpage = UnnamedDocument.query.filter(UnnamedDocument.content >= '20').keyset_paginate(
+            per_page=3, order_by=[UnnamedDocument.content.desc()])
+        self.assertEqual([d.content for d in fpage], ['24', '23', '22'])
+        fpage = UnnamedDocument.query.filter(UnnamedDocument.content >= '20').keyset_paginate(
+            fpage.next_cursor, per_page=3, order_by=[UnnamedDocument.content.desc()])
+        self.assertEqual([d.content for d in fpage], ['21', '20'])
+        self.assertFalse(fpage.has_next)
+
+        # Invalid cursors
+        with self.assertRaises(NotFound):
+            UnnamedDocument.query.keyset_paginate('garbage!')
+        self.assertEqual(UnnamedDocument.query.keyset_paginate(
+            'garbage!', per_page=10, error_out=False).items, page1.items)
+
+    def test_keyset_paginate_renamed_column(self):
+        """
+        Query.keyset_paginate reads cursor values from mapped attributes named differently from their columns
+        """
+        docs = [RankedDocument(rank=i) for i in range(5)]
+        self.session.add_all(docs)
+        self.session.commit()
+        order_by = [RankedDocument.rank.desc()]
+        page1 = RankedDocument.query.keyset_paginate(per_page=3, order_by=order_by)
+        self.assertEqual([d.rank for d in page1], [4, 3, 2])
+        page2 = RankedDocument.query.keyset_paginate(page1.next_cursor, per_page=3, order_by=order_by)
+        self.assertEqual([d.rank for d in page2], [1, 0])
+        back1 = RankedDocument.query.keyset_paginate(page2.prev_cursor, per_page=3, order_by=order_by)
+        self.assertEqual(back1.items, page1.items)
+
+    def test_keyset_paginate_cursor_types(self):
+        """
+        Cursor values of the wrong type for their column are invalid cursors, not database errors
+        """
+        self.session.add_all([RankedDocument(rank=i) for i in range(3)])
+        self.session.commit()
+        order_by = [RankedDocument.rank]
+
+        def cursor(values):
+            return base64.urlsafe_b64encode(json.dumps([0, values]).encode('utf-8')).decode('ascii').rstrip('=')
+
+        self.assertEqual([d.rank for d in RankedDocument.query.keyset_paginate(
+            cursor([0]), order_by=order_by)], [1, 2])
+        for values in (['x'], [None], [True], [1.5], [{}]):
+            with self.assertRaises(NotFound):
+                RankedDocument.query.keyset_paginate(cursor(values), order_by=order_by)
+            self.assertEqual(len(RankedDocument.query.keyset_paginate(
+                cursor(values), order_by=order_by, error_out=False).items), 3)
+        # Strings are required for text columns
+        with self.assertRaises(NotFound):
+            UnnamedDocument.query.keyset_paginate(cursor([1]), order_by=[UnnamedDocument.content])
+
+    def test_approx_count(self):
+        """
+        Query.approx_count estimates on PostgreSQL and counts elsewhere
+        """
+        c = Container()
+        self.session.add_all([UnnamedDocument(container=c, content='%02d' % i) for i in range(20)])
+        self.session.commit()
+        query = UnnamedDocument.query
+        if self.session.bind.dialect.name == 'postgresql':
+            self.assertIsInstance(query.approx_count(), int)
+        else:
+            self.assertEqual(query.approx_count(), 20)
+        self.assertEqual(query.approx_count(exact_below=1000), 20)
+        self.assertEqual(query.filter(UnnamedDocument.content < '05').approx_count(exact_below=1000), 5)
+
+    def test_cached_count(self):
+        """
+        Query.cached_count caches counts by SQL and parameters
+        """
+        cache = CountCache()
+        c = Container()
+        self.session.add_all([UnnamedDocument(container=c, content='%02d' % i) for i in range(20)])
+        self.session.commit()
+        self.assertEqual(UnnamedDocument.query.cached_count(cache=cache), 20)
+        self.assertEqual(UnnamedDocument.query.filter(
+            UnnamedDocument.content < '05').cached_count(cache=cache), 5)
+        self.assertEqual(UnnamedDocument.query.filter(
+            UnnamedDocument.content < '10').cached_count(cache=cache), 10)
+        self.session.add(UnnamedDocument(container=c, content='20'))
+        self.session.commit()
+        # The cached count is stale until it expires
+        self.assertEqual(UnnamedDocument.query.count(), 21)
+        self.assertEqual(UnnamedDocument.query.cached_count(cache=cache), 20)
+        cache.clear()
+        self.assertEqual(UnnamedDocument.query.cached_count(ttl=-1, cache=cache), 21)
+        # Expired entries are not returned
+        self.session.add(UnnamedDocument(container=c, content='21'))
+        self.session.commit()
+        self.assertEqual(UnnamedDocument.query.cached_count(cache=cache), 22)
+
+        # The same query against another database is cached separately
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        engine = create_engine('sqlite:///' + os.path.join(tempdir, 'other.db'))
+        self.addCleanup(engine.dispose)
+        db.metadata.create_all(engine, tables=[Container.__table__, UnnamedDocument.__table__])
+        other_session = sessionmaker(bind=engine)()
+        self.addCleanup(other_session.close)
+        self.assertEqual(Query(UnnamedDocument, session=other_session).cached_count(cache=cache), 0)
+        self.assertEqual(UnnamedDocument.query.cached_count(cache=cache), 22)
+
+    def test_bulk_insert(self):
+        """
+        IdMixin and UuidMixin models can be bulk inserted with pre-generated UUIDs
+        """
+        u1 = uuid.uuid4()
+        self.assertEqual(NonUuidKey._bulk_uuid_columns(), ())
+        self.assertEqual(UuidKey._bulk_uuid_columns(), ('id',))
+        self.assertEqual(UuidMixinKey._bulk_uuid_columns(), ('id',))
+        self.assertEqual(NonUuidMixinKey._bulk_uuid_columns(), ('uuid',))
+
+        rows = UuidKey.bulk_values([{}, {'id': u1}, {}])
+        self.assertEqual(rows[1]['id'], u1)
+        self.assertEqual(len(set(row['id'] for row in rows)), 3)
+        self.assertEqual(NonUuidKey.bulk_values([{}, {}]), [{}, {}])
+
+        rows = UuidKey.bulk_insert([{} for i in range(25)], chunksize=10)
+        rows2 = NonUuidMixinKey.bulk_insert([{} for i in range(5)])
+        rows3 = UuidMixinKey.bulk_insert([{} for i in range(5)], session=self.session)
+        NonUuidKey.bulk_insert([{}, {}])
+        self.session.commit()
+        self.assertEqual(set(row['id'] for row in rows), set(u.id for u in UuidKey.query.all()))
+        self.assertEqual(set(row['uuid'] for row in rows2), set(u.uuid for u in NonUuidMixinKey.query.all()))
+        self.assertEqual(set(row['id'] for row in rows3), set(u.uuid for u in UuidMixinKey.query.all()))
+        self.assertEqual(NonUuidKey.query.count(), 2)
+        # Column defaults are still applied
+        self.assertIsNotNone(UuidKey.query.first().created_at)
+
+    def test_bulk_insert_mixed_columns(self):
+        """
+        bulk_insert keeps every value when rows specify different columns
+        """
+        c = Container()
+        self.session.add(c)
+        self.session.commit()
+        UnnamedDocument.bulk_insert([
+            {'content': u'a'}, {'content': u'b', 'container_id': c.id},
+            {'content': u'c', 'container_id': c.id}, {'content': u'd'}])
+        self.session.commit()
+        self.assertEqual(
+            sorted((d.content, d.container_id) for d in UnnamedDocument.query.all()),
+            [(u'a', None), (u'b', c.id), (u'c', c.id), (u'd', None)])
+
+    def test_uuid_time_ordered(self):
+        """
+        Models with __uuid_time_ordered__ get UUID7s that sort in order of creation
+        """
+        u1 = TimeOrderedUuidKey()
+        self.assertEqual(u1.id.version, 7)
+        self.assertEqual(u1.uuid, u1.id)
+        self.assertEqual(buid2uuid(u1.buid), u1.id)
+        self.assertEqual(suuid2uuid(u1.suuid), u1.id)
+        self.assertEqual(UuidKey().id.version, 4)
+        u2 = TimeOrderedUuidMixinKey()
+        self.assertEqual(u2.uuid.version, 7)
+        self.assertIsNone(u2.id)
+        self.session.add_all([u1, u2])
+        self.session.commit()
+        self.assertTrue(abs(uuid7_to_datetime(u1.id) - u1.created_at) < timedelta(seconds=5))
+
+        rows = TimeOrderedUuidKey.bulk_insert([{} for i in range(5)])
+        self.assertEqual([row['id'].version for row in rows], [7] * 5)
+        self.session.commit()
+        # Range scans on the primary key
+        self.assertEqual(TimeOrderedUuidKey.query.filter(
+            TimeOrderedUuidKey.id >= uuid7_from_datetime(datetime.utcnow() - timedelta(minutes=1))).count(), 6)
+        self.assertEqual(TimeOrderedUuidKey.query.filter(
+            TimeOrderedUuidKey.id >= uuid7_from_datetime(datetime.utcnow() + timedelta(minutes=1))).count(), 0)
+
+    def test_parent_permissions_memo(self):
+        """
+        Children sharing a parent get inherited permissions computed once per request
+        """
+        c = self.make_container()
+        self.session.commit()
+        d1 = ScopedNamedDocument(title=u"Document 1", container=c)
+        d2 = ScopedNamedDocument(title=u"Document 2", container=c)
+        d3 = ScopedIdDocument(container=c)
+        u = User(username=u'foo')
+        self.session.add_all([d1, d2, d3, u])
+        self.session.commit()
+
+        calls = []
+
+        def permissions(actor, inherited=None):
+            calls.append(actor)
+            return set(['view'])
+        c.permissions = permissions
+
+        # Tests run in a request context, so the parent's permissions are memoized
+        self.assertEqual(d1.permissions(u), set(['view']))
+        self.assertEqual(d2.permissions(u), set(['view']))
+        self.assertEqual(d3.permissions(u), set(['view']))
+        self.assertEqual(calls, [u])
+        self.assertEqual(d1.permissions(None), set(['view']))
+        self.assertEqual(calls, [u, None])
+        # The returned sets are copies
+        d1.permissions(u).add('edit')
+        self.assertEqual(d2.permissions(u), set(['view']))
+
+        # A new request starts with a new memo
+        with self.app.test_request_context():
+            d1.permissions(u)
+            d2.permissions(u)
+        self.assertEqual(calls, [u, None, u])
+
+    def test_load_parents(self):
+        """
+        load_parents loads the parent chain for a list of instances in one query
+        """
+        c1 = self.make_container()
+        c2 = self.make_container()
+        self.session.commit()
+        docs = [ScopedNamedDocument(title=u"Document %d" % i, container=c1 if i % 2 else c2) for i in range(4)]
+        children = [ScopedNamedDocumentChild(document=doc) for doc in docs for i in range(2)]
+        self.session.add_all(docs + children)
+        self.session.commit()
+        child_ids = [child.id for child in children]
+        container_ids = set([c1.id, c2.id])
+        self.session.expunge_all()
+
+        children = ScopedNamedDocumentChild.query.filter(ScopedNamedDocumentChild.id.in_(child_ids)).all()
+        self.assertEqual(len(children), 8)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        engine = self.session.get_bind()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.assertIs(ScopedNamedDocumentChild.load_parents(children), children)
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(set(child.parent.title for child in children),
+                set(u"Document %d" % i for i in range(4)))
+            self.assertEqual(set(child.parent.parent.id for child in children), container_ids)
+            self.assertEqual(len(statements), 1)
+            # Instances with loaded parents are skipped
+            ScopedNamedDocumentChild.load_parents(children)
+            # As are instances not in a session
+            self.assertEqual(ScopedNamedDocumentChild.load_parents([ScopedNamedDocumentChild()] + children)[1:],
+                children)
+            ScopedNamedDocument.load_parents([child.parent for child in children])
+            self.assertEqual(len(statements), 1)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    def test_load_parents_composite(self):
+        """
+        load_parents matches parents on all columns of a multi-column foreign key
+        """
+        c1 = CompositeContainer(section=u'a', number=1)
+        c2 = CompositeContainer(section=u'b', number=1)
+        docs = [CompositeScopedDocument(name=u'doc%d' % i, title=u"Document %d" % i, container=c1 if i % 2 else c2)
+            for i in range(4)]
+        docs.append(CompositeScopedDocument(name=u'orphan', title=u"Orphan"))
+        self.session.add_all([c1, c2] + docs)
+        self.session.commit()
+        doc_ids = [doc.id for doc in docs]
+        self.session.expunge_all()
+
+        docs = CompositeScopedDocument.query.filter(CompositeScopedDocument.id.in_(doc_ids)).all()
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        engine = self.session.get_bind()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            CompositeScopedDocument.load_parents(docs)
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(sorted((doc.title, doc.parent and (doc.parent.section, doc.parent.number))
+                for doc in docs), [
+                    (u"Document 0", (u'b', 1)), (u"Document 1", (u'a', 1)), (u"Document 2", (u'b', 1)),
+                    (u"Document 3", (u'a', 1)), (u"Orphan", None)])
+            self.assertEqual(len(statements), 1)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    def count_selects(self):
+        """Record SELECT statements, except those refreshing expired containers"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT') and 'FROM container ' not in statement:
+                statements.append(statement)
+        engine = self.session.get_bind()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    def test_batch_names(self):
+        """
+        Models with __name_deferred__ get names in a batch when flushed
+        """
+        self.session.add(DeferredNamedDocument(title=u"Title", name=u'title'))
+        self.session.add(DeferredNamedDocument(title=u"Another", name=u'another3'))
+        self.session.commit()
+
+        d1 = DeferredNamedDocument(title=u"Title")
+        self.assertIsNone(d1.name)
+        docs = [d1] + [DeferredNamedDocument(title=title) for title in [
+            u"Title", u"Another", u"Another", u"New", u"Third title"]]
+        docs.append(DeferredNamedDocument(title=u"Title", name=u'title3'))
+        self.session.add_all(docs)
+        selects = self.count_selects()
+        self.session.flush()
+        self.assertEqual(len(selects), 1)
+        # Only the names make_name will try are looked up, not every name with the same prefix
+        self.assertNotIn('LIKE', selects[0])
+        self.assertEqual([d.name for d in docs],
+            [u'title2', u'title4', u'another', u'another2', u'new2', u'third-title', u'title3'])
+        # Names that aren't looked up in the batch are still checked
+        self.session.add(DeferredNamedDocument(title=u"Another", name=u'another5'))
+        self.session.flush()
+        docs = [DeferredNamedDocument(title=u"Another") for i in range(2)]
+        self.session.add_all(docs)
+        self.session.flush()
+        self.assertEqual([d.name for d in docs], [u'another4', u'another6'])
+
+        c1 = self.make_container()
+        c2 = self.make_container()
+        self.session.commit()
+        self.session.add(DeferredScopedNamedDocument(title=u"Title", container=c1))
+        self.session.commit()
+        # Names are made for each parent
+        docs = [DeferredScopedNamedDocument(title=u"Title", container=c) for c in (c1, c1, c2, c2)]
+        self.session.add_all(docs)
+        del selects[:]
+        self.session.flush()
+        self.assertEqual(len(selects), 2)
+        self.assertEqual([d.name for d in docs], [u'title2', u'title3', u'title', u'title2'])
+
+        # New parents have no existing children to check
+        c3 = Container(title=u"Parent")
+        docs = [DeferredScopedNamedDocument(title=u"Parent title", container=c3) for i in range(2)]
+        self.session.add_all(docs)
+        del selects[:]
+        self.session.flush()
+        self.assertEqual(len(selects), 0)
+        self.assertEqual([d.name for d in docs], [u'title', u'title2'])
+
+    def test_batch_url_ids(self):
+        """
+        New instances of models with __url_id_deferred__ are numbered in a batch when flushed
+        """
+        c1 = self.make_container()
+        c2 = self.make_container()
+        self.session.add(DeferredScopedIdDocument(container=c1))
+        self.session.commit()
+        self.session.add(DeferredScopedIdDocument(container=c2, url_id=2))
+        docs = [DeferredScopedIdDocument(container=c) for c in (c1, c2, c1, c2, c1)]
+        # Single table inheritance shares the parent model's numbering
+        docs.append(DeferredScopedIdSubDocument(container=c1))
+        self.assertIsNone(docs[0].url_id)
+        self.session.add_all(docs)
+        selects = self.count_selects()
+        self.session.flush()
+        # One query per parent
+        self.assertEqual(len(selects), 2)
+        self.assertEqual([d.url_id for d in docs], [2, 1, 3, 3, 4, 5])
+
+        # Other models are numbered by SQL when inserted
+        doc = ScopedIdDocument(container=c1)
+        self.assertIsInstance(doc.url_id, ClauseElement)
+        self.session.add(doc)
+        self.session.commit()
+        self.assertEqual(doc.url_id, 1)
+
+    def test_get_cache(self):
+        """
+        Repeated get lookups in a request are served from the identity map
+        when the model opts in
+        """
+        for model in (NamedDocument, ScopedNamedDocument, ScopedIdDocument):
+            model.__get_cache__ = True
+            self.addCleanup(delattr, model, '__get_cache__')
+        c1 = self.make_container()
+        c2 = self.make_container()
+        self.session.commit()
+        d1 = NamedDocument(title=u"Hello")
+        d2 = ScopedNamedDocument(title=u"Hello", container=c1)
+        d3 = ScopedIdDocument(container=c1)
+        self.session.add_all([d1, d2, d3])
+        self.session.commit()
+        self.assertEqual(NamedDocument.get(u'hello'), d1)
+        self.assertEqual(ScopedNamedDocument.get(c1, u'hello'), d2)
+        self.assertEqual(ScopedIdDocument.get(c1, 1), d3)
+
+        selects = self.count_selects()
+        self.assertEqual(NamedDocument.get(u'hello'), d1)
+        self.assertEqual(ScopedNamedDocument.get(c1, u'hello'), d2)
+        self.assertEqual(ScopedIdDocument.get(c1, 1), d3)
+        self.assertEqual(selects, [])
+        # Misses are not cached
+        self.assertIsNone(NamedDocument.get(u'missing'))
+        self.assertIsNone(ScopedNamedDocument.get(c2, u'hello'))
+        self.assertIsNone(ScopedIdDocument.get(c2, 1))
+        self.assertEqual(len(selects), 3)
+
+        # Renamed and deleted instances are looked up again
+        d1.name = u'renamed'
+        self.assertIsNone(NamedDocument.get(u'hello'))
+        self.assertEqual(NamedDocument.get(u'renamed'), d1)
+        self.session.delete(d2)
+        self.assertIsNone(ScopedNamedDocument.get(c1, u'hello'))
+
+        # Each request has its own cache
+        with self.app.test_request_context():
+            del selects[:]
+            self.assertEqual(ScopedIdDocument.get(c1, 1), d3)
+            self.assertEqual(len(selects), 1)
+
+    def test_get_null(self):
+        """
+        get matches None values and a None parent with IS NULL
+        """
+        c = self.make_container()
+        d1 = ScopedNamedDocument(name=u'orphan', title=u"Orphan")
+        d2 = ScopedNamedDocument(name=u'orphan', title=u"Orphan", container=c)
+        self.session.add_all([d1, d2])
+        self.session.commit()
+        self.assertEqual(ScopedNamedDocument.get(None, u'orphan'), d1)
+        self.assertEqual(ScopedNamedDocument.get(c, u'orphan'), d2)
+        self.assertIsNone(ScopedNamedDocument.get(None, u'missing'))
+        self.assertIsNone(NamedDocument.get(None))
+        self.assertFalse(NamedDocument.__get_cache__)
+
+    def test_get_composite_parent(self):
+        """
+        get supports parents with multi-column keys
+        """
+        c1 = CompositeContainer(section=u'a', number=1)
+        c2 = CompositeContainer(section=u'a', number=2)
+        d1 = CompositeScopedDocument(name=u'doc', title=u"Doc", container=c1)
+        d2 = CompositeScopedDocument(name=u'doc', title=u"Doc", container=c2)
+        self.session.add_all([c1, c2, d1, d2])
+        self.session.commit()
+        self.assertEqual(CompositeScopedDocument.get(c1, u'doc'), d1)
+        self.assertEqual(CompositeScopedDocument.get(c2, u'doc'), d2)
+        self.assertIsNone(CompositeScopedDocument.get(None, u'doc'))
+
+    def test_uuid_in_large_list(self):
+        """
+        IN queries with long lists of encoded UUIDs
+        """
+        objs = [NonUuidMixinKey() for i in range(120)] + [UuidMixinKey() for i in range(120)]
+        db.session.add_all(objs)
+        db.session.commit()
+        suuids = [o.suuid for o in objs[:120]] + ['garbage!', None]
+        buids = [o.buid for o in objs[120:]] + ['garbage!']
+        self.assertEqual(NonUuidMixinKey.query.filter(NonUuidMixinKey.suuid.in_(suuids)).count(), 120)
+        self.assertEqual(NonUuidMixinKey.query.filter(~NonUuidMixinKey.suuid.in_(suuids[:110] + ['garbage!'])).count(), 10)
+        self.assertEqual(UuidMixinKey.query.filter(UuidMixinKey.buid.in_(buids)).count(), 120)
+        self.assertEqual(UuidMixinKey.query.filter(
+            UuidMixinKey.url_id.in_([o.url_id for o in objs[120:]])).count(), 120)
+        self.assertEqual(NonUuidMixinKey.query.filter(
+            NonUuidMixinKey.url_id.in_([o.url_id for o in objs[:120]])).count(), 120)
+
+        # PostgreSQL gets a single array parameter
+        self.assertEqual(
+            six.text_type(UuidMixinKey.suuid.in_(suuids).compile(dialect=postgresql.dialect())),
+            "uuid_mixin_key.id = ANY (CAST(%(param_1)s AS UUID[]))")
+
+    def test_uuid_cache(self):
+        """
+        UuidMixin can cache huuid, buid and suuid on the instance
+        """
+        u1 = CachedUuidMixinKey(uuid=uuid.UUID('33203dd2-f2ef-422f-aeb0-058d6f5f7089'))
+        self.assertEqual(u1.huuid, '33203dd2f2ef422faeb0058d6f5f7089')
+        self.assertEqual(u1.buid, 'MyA90vLvQi-usAWNb19wiQ')
+        self.assertEqual(u1.suuid, 'LoGtYR49yWJT7tusksAW7B')
+        self.assertIs(u1.suuid, u1.suuid)
+        db.session.add(u1)
+        db.session.commit()
+
+        # Reloading the UUID discards the cache
+        cached_suuid = u1.suuid
+        db.session.expire(u1)
+        self.assertEqual(u1.suuid, cached_suuid)
+        self.assertIsNot(u1.suuid, cached_suuid)
+        self.assertEqual(CachedUuidMixinKey.query.filter_by(suuid='LoGtYR49yWJT7tusksAW7B').one(), u1)
+
     def test_uuid_url_id_name_suuid(self):
         """
         BaseIdNameMixin models with UUID primary or secondary keys should
@@ -3,8 +3,9 @@
 from __future__ import absolute_import
 
 import unittest
+from weakref import WeakKeyDictionary
 from werkzeug.routing import BuildError
-from flask import Flask
+from flask import Flask, url_for
 from coaster.db import db
 
 from .test_models import Container, NamedDocument, ScopedNamedDocument
@@ -193,6 +194,60 @@ class TestUrlFor(TestUrlForBase):
         # url_for is given an object and extracts an attribute from it
         assert doc1.url_for('with', other=doc2) == '/document1/with/document2'
 
+    def test_url_for_compiled(self):
+        """Registrations are compiled once and reused"""
+        doc1 = NamedDocument(name=u'document1', title=u"Document 1")
+        doc2 = NamedDocument(name=u'document2', title=u"Document 2")
+        self.session.add_all([doc1, doc2])
+        self.session.commit()
+
+        assert doc1.url_for('edit') == '/document1/edit'
+        endpoint = NamedDocument._url_for_endpoint('edit', {})
+        assert endpoint is NamedDocument._url_for_endpoint('edit', {})
+        assert doc2.url_for('edit') == '/document2/edit'
+        assert endpoint is NamedDocument._url_for_endpoint('edit', {})
+        # Compiled endpoints don't keep apps alive
+        assert isinstance(NamedDocument.__dict__['_url_for_compiled'], WeakKeyDictionary)
+
+    def test_url_for_matches_flask(self):
+        """URLs built from the compiled endpoint match those from Flask's url_for"""
+        doc1 = NamedDocument(name=u'document 1', title=u"Document 1")
+        c1 = Container()
+        doc2 = ScopedNamedDocument(container=c1, name=u'document2', title=u"Document 2")
+        self.session.add_all([doc1, c1, doc2])
+        self.session.commit()
+
+        assert doc1.url_for() == url_for('doc_view', doc=doc1.name)
+        assert doc1.url_for(extra=u'value') == url_for('doc_view', doc=doc1.name, extra=u'value')
+        assert doc1.url_for(_external=True) == url_for('doc_view', doc=doc1.name, _external=True)
+        assert doc1.url_for(_anchor='top') == url_for('doc_view', doc=doc1.name, _anchor='top')
+        assert doc2.url_for('edit') == url_for('sdoc_edit', container=c1.id, doc=doc2.name, _external=True)
+        # Parameters with a value of None are dropped, as in Flask
+        assert doc1.url_for(extra=None) == '/document%201'
+
+    def test_url_for_many(self):
+        """url_for_many returns the same URLs as url_for on each instance"""
+        docs = [NamedDocument(name=u'document%d' % i, title=u"Document %d" % i) for i in range(1, 4)]
+        other = NamedDocument(name=u'other', title=u"Other")
+        c1 = Container()
+        sdocs = [ScopedNamedDocument(container=c1, name=u'sdoc%d' % i, title=u"Sdoc %d" % i) for i in range(1, 3)]
+        self.session.add_all(docs + sdocs + [other, c1])
+        self.session.commit()
+
+        assert NamedDocument.url_for_many(docs) == [d.url_for() for d in docs]
+        assert NamedDocument.url_for_many(docs, 'edit') == ['/document1/edit', '/document2/edit', '/document3/edit']
+        assert NamedDocument.url_for_many(docs, _external=True) == [d.absolute_url for d in docs]
+        assert NamedDocument.url_for_many(docs, 'with', other=other) == [
+            d.url_for('with', other=other) for d in docs]
+        assert NamedDocument.url_for_many(docs[:1], 'edit', doc=u'shared') == ['/shared/edit']
+        assert ScopedNamedDocument.url_for_many(sdocs, 'edit') == [
+            'http://localhost/1/sdoc1/edit', 'http://localhost/1/sdoc2/edit']
+        assert ScopedNamedDocument.url_for_many(sdocs, 'edit', _external=False) == [
+            '/1/sdoc1/edit', '/1/sdoc2/edit']
+        assert NamedDocument.url_for_many([]) == []
+        with self.assertRaises(BuildError):
+            NamedDocument.url_for_many(docs, 'unknown')
+
 
 class TestUrlFor2(TestUrlForBase):
     app = app2
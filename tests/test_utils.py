@@ -135,6 +135,23 @@ class TestCoasterUtils(unittest.TestCase):
         s2 = uuid2suuid(u1)
         self.assertEqual(s1, s2)
 
+    def test_suuid_short(self):
+        """
+        Short ShortUUIDs decode as having leading zeroes, matching the encoder
+        """
+        u1 = uuid.UUID(int=12345)
+        s1 = uuid2suuid(u1)
+        # Leading zeroes are encoded last, as the first character of the alphabet
+        digits = s1.rstrip('2')
+        self.assertEqual(len(digits), 3)
+        for length in range(len(digits), 23):
+            self.assertEqual(suuid2uuid(s1[:length]), u1)
+        self.assertEqual(suuid2uuid(''), uuid.UUID(int=0))
+        with self.assertRaises(ValueError):
+            suuid2uuid(s1 + '2')
+        with self.assertRaises(ValueError):
+            suuid2uuid('0' * 10)
+
     def test_require_one_of(self):
         # Valid scenarios
         require_one_of(solo='solo')
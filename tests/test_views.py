@@ -6,7 +6,7 @@ from flask import Flask, session, json
 from coaster.app import load_config_from_file
 from coaster.auth import current_auth, add_auth_attribute
 from coaster.views import (get_current_url, get_next_url, jsonp, requestargs, requestquery, requestform,
-    requires_permission)
+    requires_permission, RequestTypeError)
 
 
 def index():
@@ -47,6 +47,18 @@ def requestcombo_test(query1, form1):
     return query1, form1
 
 
+@requestquery('query1')
+@requires_permission('admin')
+@requestform('form1')
+def requestcombo_permission_test(query1, form1):
+    return query1, form1
+
+
+@requestargs('p1')
+def requestargs_typeerror(p1):
+    return len(p1)
+
+
 @requires_permission('allow-this')
 def permission1():
     return 'allowed1'
@@ -149,6 +161,39 @@ class TestCoasterViews(unittest.TestCase):
         # Calling without a request context works as well
         self.assertEqual(requestargs_test1(p1='1', p2=3, p3=[1, 2]), ('1', 3, [1, 2]))
 
+    def test_requestargs_errors(self):
+        # Missing parameters are reported by name
+        with self.app.test_request_context('/?p2=2'):
+            with self.assertRaises(RequestTypeError) as cm:
+                requestargs_test1()
+            self.assertIn('p1', str(cm.exception))
+        # Positional arguments are accepted
+        with self.app.test_request_context('/'):
+            self.assertEqual(requestargs_test1('1'), ('1', None, None))
+        # Invalid values are ignored
+        with self.app.test_request_context('/?p1=1&p2=two'):
+            self.assertEqual(requestargs_test1(), ('1', None, None))
+        with self.app.test_request_context('/?p1=1&p3=1&p3=two'):
+            self.assertEqual(requestargs_test1(), ('1', None, [1]))
+        # Stacked decorators check for missing parameters once all are loaded
+        with self.app.test_request_context('/', query_string='query1=foo', method='POST'):
+            with self.assertRaises(RequestTypeError):
+                requestcombo_test()
+        # Stacked decorators are only combined when directly stacked
+        with self.app.test_request_context('/', query_string='query1=foo', data={'form1': 'bar'},
+                method='POST'):
+            with self.assertRaises(Forbidden):
+                requestcombo_permission_test()
+            add_auth_attribute('permissions', set(['admin']))
+            self.assertEqual(requestcombo_permission_test(), ('foo', 'bar'))
+        # A TypeError from within the view is not a bad request
+        with self.app.test_request_context('/?p1=1'):
+            self.assertEqual(requestargs_typeerror(), 1)
+        with self.app.test_request_context('/'):
+            with self.assertRaises(TypeError) as cm:
+                requestargs_typeerror(p1=1)
+            self.assertNotIsInstance(cm.exception, BadRequest)
+
     def test_requires_permission(self):
         with self.app.test_request_context():
             with self.assertRaises(Forbidden):
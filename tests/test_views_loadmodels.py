@@ -3,12 +3,13 @@
 from __future__ import absolute_import
 
 import unittest
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, event
 from sqlalchemy.orm import relationship
 
 from werkzeug.exceptions import Forbidden, NotFound
 from flask import Flask, g
 
+from coaster.auth import cached_permissions, current_auth
 from coaster.views import load_model, load_models
 from coaster.sqlalchemy import BaseMixin, BaseNameMixin, BaseScopedIdMixin
 from coaster.db import db
@@ -94,6 +95,12 @@ def t_single_model_in_loadmodels(user):
     return user
 
 
+@load_models(
+    (Container, {'name': 'container'}, 'container'))
+def t_container_by_name(container):
+    return container
+
+
 @load_models(
     (Container, {'name': 'container'}, 'container'),
     (NamedDocument, {'name': 'document', 'container': 'container'}, 'document')
@@ -187,6 +194,63 @@ def t_dotted_document_delete(document, child):
     return child
 
 
+@load_models(
+    (Container, {'name': 'container'}, 'container'),
+    (NamedDocument, {'name': 'document', 'container': 'container'}, 'document'),
+    join=True
+    )
+def t_named_document_join(container, document):
+    return document
+
+
+@load_models(
+    (Container, {'name': 'container'}, 'container'),
+    ((NamedDocument, RedirectDocument), {'name': 'document', 'container': 'container'}, 'document'),
+    join=True
+    )
+def t_redirect_document_join(container, document):
+    return document
+
+
+@load_models(
+    (Container, {'name': 'container'}, 'container'),
+    (ScopedIdNamedDocument, {'url_name': 'document', 'container': 'container'}, 'document'),
+    urlcheck=['url_name'],
+    join=True
+    )
+def t_scoped_id_named_document_join(container, document):
+    return document
+
+
+@load_models(
+    (ParentDocument, {'name': 'document'}, 'document'),
+    (ChildDocument, {'id': 'child', 'parent': lambda r, p: r['document'].middle}, 'child'),
+    join=True
+    )
+def t_callable_document_join(document, child):
+    return child
+
+
+@load_models(
+    (ParentDocument, {'name': 'document'}, 'document'),
+    (ChildDocument, {'id': 'child', 'parent': 'document.middle'}, 'child'),
+    permission='edit',
+    join=True
+    )
+def t_dotted_document_edit_join(document, child):
+    return child
+
+
+@load_models(
+    (ParentDocument, {'name': 'document'}, 'document'),
+    (ChildDocument, {'id': 'child', 'parent': 'document.middle'}, 'child'),
+    permission='delete',
+    join=True
+    )
+def t_dotted_document_delete_join(document, child):
+    return child
+
+
 # --- Tests -------------------------------------------------------------------
 
 class TestLoadModels(unittest.TestCase):
@@ -340,6 +404,26 @@ class TestLoadModels(unittest.TestCase):
             self.assertEqual(t_dotted_document_edit(document=u'parent', child=1), self.child1)
             self.assertRaises(Forbidden, t_dotted_document_delete, document=u'parent', child=1)
 
+    def test_loadmodel_permissions_cached(self):
+        """Permissions computed by load_models are cached for the request"""
+        calls = []
+        permissions = self.pc.permissions
+
+        def counting_permissions(actor, inherited=None):
+            calls.append(actor)
+            return permissions(actor, inherited)
+        self.pc.permissions = counting_permissions
+
+        with self.app.test_request_context():
+            login_manager.set_user_for_testing(User(username='foo'), load=True)
+            self.assertEqual(t_dotted_document_view(document=u'parent', child=1), self.child1)
+            self.assertEqual(t_dotted_document_edit(document=u'parent', child=1), self.child1)
+            self.assertEqual(cached_permissions(self.pc, current_auth.actor), set(['view', 'edit', 'delete']))
+            self.assertEqual(len(calls), 1)
+            # current_permissions is not cached, so it reflects changes within the request
+            self.assertEqual(self.pc.current_permissions, set(['view', 'edit', 'delete']))
+            self.assertEqual(len(calls), 2)
+
     def test_load_user_to_g(self):
         with self.app.test_request_context():
             user = User(username=u'baz')
@@ -357,5 +441,73 @@ class TestLoadModels(unittest.TestCase):
             self.assertEqual(t_single_model_in_loadmodels(username=u'user1'), g.user)
 
 
+    def test_compiled_filters(self):
+        """Column filters are bound on each call, and a missing value matches NULL"""
+        unnamed = Container()
+        self.session.add(unnamed)
+        self.session.commit()
+        self.assertEqual(t_container_by_name(container=u'c'), self.container)
+        self.assertEqual(t_container_by_name(), unnamed)
+        self.assertRaises(NotFound, t_container_by_name, container=u'x')
+
+    def selects(self):
+        """Record SELECT statements"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+        engine = db.get_engine(type(self).app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    def test_named_document_join(self):
+        nd1_id, nd2_id = self.nd1.id, self.nd2.id
+        self.session.expunge_all()
+        statements = self.selects()
+        document = t_named_document_join(container=u'c', document=u'named-document')
+        self.assertEqual(document.id, nd1_id)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(t_named_document_join(container=u'c', document=u'another-named-document').id,
+            nd2_id)
+        self.assertRaises(NotFound, t_named_document_join, container=u'x', document=u'named-document')
+        self.assertRaises(NotFound, t_named_document_join, container=u'c', document=u'no-such-document')
+
+    def test_redirect_document_join(self):
+        """Multiple candidate models are loaded sequentially after the joined prefix"""
+        with self.app.test_request_context('/c/named-document'):
+            self.assertEqual(t_redirect_document_join(container=u'c', document=u'named-document'), self.nd1)
+        with self.app.test_request_context('/c/redirect-document'):
+            response = t_redirect_document_join(container=u'c', document=u'redirect-document')
+            self.assertEqual(response.status_code, 307)
+            self.assertEqual(response.headers['Location'], '/c/named-document')
+
+    def test_scoped_id_named_document_join(self):
+        self.assertEqual(t_scoped_id_named_document_join(
+            container=u'c', document=u'1-scoped-id-named-document'), self.sind1)
+        with self.app.test_request_context('/c/1-wrong-name'):
+            r = t_scoped_id_named_document_join(container=u'c', document=u'1-wrong-name')
+            self.assertEqual(r.status_code, 302)
+            self.assertEqual(r.location, '/c/1-scoped-id-named-document')
+        self.assertRaises(NotFound, t_scoped_id_named_document_join,
+            container=u'c', document=u'random-non-integer')
+
+    def test_callable_document_join(self):
+        self.assertEqual(t_callable_document_join(document=u'parent', child=1), self.child1)
+        self.assertEqual(t_callable_document_join(document=u'parent', child=2), self.child2)
+
+    def test_dotted_document_join(self):
+        child1_id = self.child1.id
+        self.session.expunge_all()
+        with self.app.test_request_context():
+            login_manager.set_user_for_testing(User(username='foo'), load=True)
+            statements = self.selects()
+            child = t_dotted_document_edit_join(document=u'parent', child=1)
+            self.assertEqual(child.id, child1_id)
+            self.assertEqual(len(statements), 1)
+            self.assertRaises(Forbidden, t_dotted_document_delete_join, document=u'parent', child=1)
+            self.assertRaises(NotFound, t_dotted_document_edit_join, document=u'parent', child=3)
+
 class TestLoadModels2(TestLoadModels):
     app = app2
@@ -4,6 +4,7 @@ import unittest
 from flask import Flask, Response
 from jinja2 import TemplateNotFound
 from coaster.views import render_with, jsonp
+from coaster.views.decorators import _MimetypeNegotiator
 import six
 # --- Test setup --------------------------------------------------------------
 
@@ -60,6 +61,14 @@ def view_for_star():
     return {'data': 'value'}, 201
 
 
+@app.route('/renderedview6')
+@render_with({
+    'Text/Plain': viewcallable,
+    'text/html': 'renderedview6.html'})
+def view_with_mixed_case():
+    return {'data': 'value'}
+
+
 # --- Tests -------------------------------------------------------------------
 
 class TestLoadModels(unittest.TestCase):
@@ -108,3 +117,26 @@ class TestLoadModels(unittest.TestCase):
         self.assertEqual(resp.headers['Referrer'], "http://example.com")
         # resp = self.app.get('/renderedview5', headers=[('Accept', 'text/plain')])
         # self.assertEqual(resp.status_code, 201)
+
+    def test_mixed_case_mimetypes(self):
+        """Template mimetypes are matched regardless of case"""
+        response = self.app.get('/renderedview6', headers=[('Accept', 'TEXT/plain')])
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertEqual(response.headers['Vary'], 'Accept')
+
+    def test_negotiation_cache(self):
+        """Common Accept headers are precomputed and others are cached by raw header"""
+        negotiate = _MimetypeNegotiator(['text/html', 'Application/JSON'], maxsize=2)
+        self.assertEqual(negotiate.table, {
+            '': '*/*', '*/*': '*/*', 'text/html': 'text/html', 'application/json': 'application/json'})
+        self.assertEqual(negotiate('text/xml;q=0.9,application/json;q=0.8'), 'application/json')
+        self.assertEqual(negotiate('text/xml'), '*/*')
+        self.assertEqual(list(negotiate._data), ['text/xml;q=0.9,application/json;q=0.8', 'text/xml'])
+        # Precomputed headers don't use the cache
+        self.assertEqual(negotiate('text/html'), 'text/html')
+        self.assertEqual(len(negotiate._data), 2)
+        # The least recently used header is evicted
+        self.assertEqual(negotiate('text/xml;q=0.9,application/json;q=0.8'), 'application/json')
+        self.assertEqual(negotiate('text/plain,text/html;q=0.5'), 'text/html')
+        self.assertEqual(list(negotiate._data), [
+            'text/xml;q=0.9,application/json;q=0.8', 'text/plain,text/html;q=0.5'])